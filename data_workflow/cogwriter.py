@@ -0,0 +1,74 @@
+import os
+
+import numpy
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+
+# the largest and smallest size of the tiles in the cloud optimized GeoTIFFs (GeoTIFF tiles are multiples of 16).
+# The forecast grids are small (Hispaniola is 29x15 cells) so the tiles are sized to the grid, see cog_blocksize, and
+# overviews are made until the smallest one fits in a tile
+COG_BLOCKSIZE = 256
+COG_MIN_BLOCKSIZE = 16
+
+
+def cog_blocksize(width, height):
+    """
+    The tile size for a raster: the largest power of two that is at most half the raster's longer side, so there is
+    at least one overview, between COG_MIN_BLOCKSIZE and COG_BLOCKSIZE
+    """
+    blocksize = COG_MIN_BLOCKSIZE
+    while blocksize * 2 <= min(max(width, height) / 2, COG_BLOCKSIZE):
+        blocksize *= 2
+    return blocksize
+
+
+def overview_factors(width, height, blocksize=COG_BLOCKSIZE):
+    """
+    The decimation factors of the overviews a raster needs: halve it until it fits in a single tile
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / (factor / 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def write_cog(path, array, transform, blocksize=None):
+    """
+    Writes a raster as a cloud optimized GeoTIFF: DEFLATE compressed square tiles with internal overviews (averaged)
+    stored ahead of the full resolution data, so clients can read a window or a low zoom level with a few range
+    requests. The file is built in memory and copied to a .part file that replaces path when complete. The tiles are
+    sized to the raster (cog_blocksize) unless a blocksize is given.
+    Dependencies: os, numpy, rasterio
+    """
+    height, width = array.shape
+    if blocksize is None:
+        blocksize = cog_blocksize(width, height)
+    profile = {
+        'driver': 'GTiff',
+        'height': height,
+        'width': width,
+        'count': 1,
+        'dtype': 'float32',
+        'nodata': numpy.nan,
+        'crs': '+proj=latlong',
+        'transform': transform,
+        'tiled': True,
+        'blockxsize': blocksize,
+        'blockysize': blocksize,
+    }
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as mem:
+            mem.write(array.astype(numpy.float32), 1)
+            factors = overview_factors(width, height, blocksize)
+            if factors:
+                mem.build_overviews(factors, Resampling.average)
+                mem.update_tags(ns='rio_overview', resampling='average')
+        # copying lays the file out with the overviews first, which writing it directly can't do
+        with memfile.open() as mem:
+            rasterio.shutil.copy(mem, path + '.part', driver='GTiff', tiled=True, blockxsize=blocksize,
+                                 blockysize=blocksize, compress='DEFLATE', predictor=3, copy_src_overviews=True)
+    os.replace(path + '.part', path)
@@ -6,4 +6,6 @@ python /home/civil/apps/ffgs/data_workflow/gfsworkflow.py /home/civil/thredds_da
 python /home/civil/apps/ffgs/data_workflow/wrfprworkflow.py /home/civil/thredds_data/ffgs/
 
 # then run this command from crontab with a command like:
-# 0 4 * * * bash /path/to/workflow/ffgs_workflow.sh
\ No newline at end of file
+# 0 4 * * * bash /path/to/workflow/ffgs_workflow.sh
+# or, to process each GFS forecast as soon as it is published, keep the scheduler running instead of the gfs line:
+# python /home/civil/apps/ffgs/data_workflow/scheduler.py /home/civil/thredds_data/ffgs/
\ No newline at end of file
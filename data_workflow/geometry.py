@@ -0,0 +1,128 @@
+import json
+import logging
+import math
+import os
+import sys
+
+import fiona
+import shapely
+from shapely.geometry import mapping, shape
+
+# the zoom levels a simplified copy of each region's watersheds is made for. The app serves the most detailed level
+# that isn't more detailed than the map's zoom (see GEOMETRY_ZOOMS in the app's leaflet.js)
+GEOMETRY_ZOOMS = (4, 6, 8, 10)
+
+
+def geometry_dir(wrksppath, region):
+    """
+    The folder holding the simplified watersheds of a region, one z<zoom>.geojson per level
+    """
+    return os.path.join(wrksppath, region, 'geometry')
+
+
+def level_tolerance(zoom):
+    """
+    Half the width, in degrees, of a 256 pixel map tile's pixel at the zoom level. Simplifying by this much moves no
+    point far enough to be seen at that zoom.
+    """
+    return 360 / (256 * 2 ** zoom) / 2
+
+
+def quantize_ring(ring, digits):
+    """
+    Rounds the ring's coordinates and drops the points that round onto the previous point. Returns None if there aren't
+    enough points left to make a ring.
+    """
+    points = []
+    for x, y in ring:
+        point = [round(x, digits), round(y, digits)]
+        if not points or point != points[-1]:
+            points.append(point)
+    if len(points) < 4:
+        return None
+    return points
+
+
+def quantize(geometry, digits):
+    """
+    The geojson geometry of a shapely polygon or multipolygon with its coordinates rounded to a number of digits
+    Dependencies: shapely
+    """
+    geojson = mapping(geometry)
+    polygons = [geojson['coordinates']] if geojson['type'] == 'Polygon' else geojson['coordinates']
+    quantized = []
+    for polygon in polygons:
+        exterior = quantize_ring(polygon[0], digits)
+        if exterior is None:
+            # keep the polygon, even a watershed smaller than a pixel still needs to be clickable
+            exterior = [[round(x, digits), round(y, digits)] for x, y in polygon[0]]
+        holes = [hole for hole in (quantize_ring(ring, digits) for ring in polygon[1:]) if hole is not None]
+        quantized.append([exterior] + holes)
+    if len(quantized) == 1:
+        return {'type': 'Polygon', 'coordinates': quantized[0]}
+    return {'type': 'MultiPolygon', 'coordinates': quantized}
+
+
+def build_geometry(wrksppath, region, zooms=GEOMETRY_ZOOMS):
+    """
+    Writes a simplified, quantized geojson of the region's ffgs_<region>.shp for each zoom level, keeping only the
+    cat_id of each watershed. The watersheds are simplified together as a coverage so the border two neighbours share
+    is simplified once and stays shared, no slivers or overlaps open up between them, and rounding the shared points
+    the same way on both sides keeps it shared. Nothing is done if the files are newer than the shapefile.
+    Dependencies: json, logging, math, os, fiona, shapely (2.1 or newer)
+    """
+    shp_path = os.path.join(wrksppath, region, 'shapefiles', 'ffgs_' + region + '.shp')
+    directory = geometry_dir(wrksppath, region)
+    paths = {zoom: os.path.join(directory, 'z' + str(zoom) + '.geojson') for zoom in zooms}
+    shp_modified = os.path.getmtime(shp_path)
+    if all(os.path.exists(path) and os.path.getmtime(path) >= shp_modified for path in paths.values()):
+        logging.info('the simplified watersheds of ' + region + ' are up to date')
+        return paths
+
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+        os.chmod(directory, 0o777)
+
+    with fiona.open(shp_path) as shapes:
+        watersheds = [(int(feature['properties']['cat_id']), shape(feature['geometry'])) for feature in shapes]
+    watersheds = [(cat_id, geometry if geometry.is_valid else geometry.buffer(0))
+                  for cat_id, geometry in watersheds if not geometry.is_empty]
+
+    cat_ids = [cat_id for cat_id, _ in watersheds]
+    geometries = [geometry for _, geometry in watersheds]
+    # the coverage simplification needs polygons that meet edge to edge without overlapping, if the shapefile's don't
+    # each watershed is simplified on its own, which keeps it valid but not the borders it shares
+    coverage = bool(shapely.coverage_is_valid(geometries))
+    if not coverage:
+        logging.info('the watersheds of ' + region + ' overlap or their shared borders don\'t match, simplifying each '
+                     'watershed on its own')
+
+    for zoom, path in paths.items():
+        tolerance = level_tolerance(zoom)
+        # enough digits that rounding moves a point less than half the tolerance
+        digits = int(math.ceil(-math.log10(tolerance / 2)))
+        if coverage:
+            simplified = shapely.coverage_simplify(geometries, tolerance)
+        else:
+            simplified = [geometry.simplify(tolerance, preserve_topology=True) for geometry in geometries]
+        features = []
+        for cat_id, geometry in zip(cat_ids, simplified):
+            features.append({
+                'type': 'Feature',
+                'properties': {'cat_id': cat_id},
+                'geometry': quantize(geometry, digits),
+            })
+        logging.info('writing the watersheds of ' + region + ' simplified for zoom ' + str(zoom) + ' to ' + path)
+        with open(path + '.part', 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f, separators=(',', ':'))
+        os.replace(path + '.part', path)
+
+    return paths
+
+
+if __name__ == '__main__':
+    # python geometry.py <app workspace path> builds the levels for every region with a shapefile in the workspace
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    for folder in sorted(os.listdir(sys.argv[1])):
+        if os.path.exists(os.path.join(sys.argv[1], folder, 'shapefiles', 'ffgs_' + folder + '.shp')):
+            build_geometry(sys.argv[1], folder)
@@ -3,46 +3,100 @@ import shutil
 import sys
 import datetime
 import os
+import queue
+import threading
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
 
-import netCDF4
 import numpy
-import pandas as pd
 import rasterio
-import rasterstats
-import requests
+import rasterio.windows
 import xarray
-from rasterio.enums import Resampling
-
-FFGS_REGIONS = [('Hispaniola', 'hispaniola'), ('Central America', 'centralamerica')]
 
+from geometry import build_geometry
+from cogwriter import write_cog
+from gribdownloads import download_gribs, iter_gribs
+from ncwriter import cube_name, grib_metadata, lead_hours, write_forecast_cube, write_netcdf
+from publish import cleanup, publish_run, published_run, run_dir, write_atomic
+from resultstore import write_pixel_cube, write_results
+from zonalstats import cube_statistics, load_coverage, zonal_statistics
 
-def setenvironment(threddspath, wrksppath):
+FFGS_REGIONS = [('Hispaniola', 'hispaniola'), ('Central America', 'centralamerica')]
+# the extents of the GFS data used for each region (leftlon, rightlon, toplat, bottomlat)
+GFS_SUBREGIONS = {
+    'hispaniola': (-75, -68, 20.5, 17),
+    'centralamerica': (-94.25, -75.5, 19.5, 5.5),
+}
+# where the GFS forecasts are downloaded from, set the GFS_BASE_URL environment variable (or the scheduler's base url)
+# to test the workflow against a local copy of the server
+GFS_BASE_URL = os.environ.get('GFS_BASE_URL', 'https://nomads.ncep.noaa.gov')
+# the forecast steps (hours after the forecast timestamp) downloaded, 7 days in 6 hour increments
+GFS_STEPS = ['006', '012', '018', '024', '030', '036', '042', '048', '054', '060', '066', '072', '078', '084',
+             '090', '096', '102', '108', '114', '120', '126', '132', '138', '144', '150', '156', '162', '168']
+# download each forecast step once for the box containing every region then crop each region out of those gribs
+GFS_UNION_DOWNLOAD = True
+# write the GeoTIFFs of each forecast step to the app workspace for debugging. Otherwise the rasters decoded from the
+# gribs are passed to the zonal statistics in memory and no intermediate GeoTIFFs are written
+WRITE_GEOTIFFS = False
+# write every step of a forecast to one chunked netcdf that the ncml points to instead of one netcdf per step that
+# THREDDS has to find by scanning the processed folder. Its chunks are CUBE_CHUNKS (time, lat, lon) values, a few
+# steps of a block of cells, so reading a map of one step or the timeseries of one cell only touches a few chunks.
+AGGREGATE_OUTPUT = False
+CUBE_CHUNKS = (4, 64, 64)
+# also write each forecast step and the forecast's total as cloud optimized GeoTIFFs to <timestamp>/cogs in the thredds
+# directory for GIS users and tile servers
+WRITE_COGS = False
+# also append each forecast to a zarr archive (see zarrarchive.py, needs the zarr package) that keeps every cycle
+ARCHIVE_ZARR = False
+# how many regions are processed at the same time, each in its own process
+REGION_WORKERS = 2
+# how many forecast steps of a region are converted at the same time, each in its own process
+STEP_WORKERS = 4
+# process each forecast step (decode, netcdf/GeoTIFF, statistics) as soon as it is downloaded instead of waiting for
+# every step to finish each stage. The queues between the stages hold at most PIPELINE_QUEUE_SIZE steps.
+PIPELINED = False
+PIPELINE_QUEUE_SIZE = 4
+
+
+def setenvironment(threddspath, wrksppath, timestamp=None):
     """
+    Creates the folders a new run is built in. The live run's folders are left alone, it stays published until the
+    new run replaces it (see new_ncml and publish.py). The run is of the forecast timestamp (YYYYMMDDHH) given, e.g.
+    by the scheduler once it is published, otherwise of the newest forecast that should be published by now.
     Dependencies: os, shutil, datetime, urllib.request, app_settings (options)
     """
     logging.info('\nSetting the Environment for the GFS Workflow')
     # determine the most day and hour of the day timestamp of the most recent GFS forecast
-    now = datetime.datetime.utcnow()
-    if now.hour > 21:
-        timestamp = now.strftime("%Y%m%d") + '18'
-    elif now.hour > 15:
-        timestamp = now.strftime("%Y%m%d") + '12'
-    elif now.hour > 9:
-        timestamp = now.strftime("%Y%m%d") + '06'
-    elif now.hour > 3:
-        timestamp = now.strftime("%Y%m%d") + '00'
-    else:
-        now = now - datetime.timedelta(days=1)
-        timestamp = now.strftime("%Y%m%d") + '18'
+    if timestamp is None:
+        now = datetime.datetime.utcnow()
+        if now.hour > 21:
+            timestamp = now.strftime("%Y%m%d") + '18'
+        elif now.hour > 15:
+            timestamp = now.strftime("%Y%m%d") + '12'
+        elif now.hour > 9:
+            timestamp = now.strftime("%Y%m%d") + '06'
+        elif now.hour > 3:
+            timestamp = now.strftime("%Y%m%d") + '00'
+        else:
+            now = now - datetime.timedelta(days=1)
+            timestamp = now.strftime("%Y%m%d") + '18'
     logging.info('determined the timestamp to download: ' + timestamp)
 
-    # perform a redundancy check, if the last timestamp is the same as current, abort the workflow
     timefile = os.path.join(threddspath, 'gfs_timestamp.txt')
+    # a region is done with the forecast once its run is published and the published run's folder is never removed
+    # since THREDDS and the app read from it (see publish.py)
+    pending = [region for region in FFGS_REGIONS if published_run(threddspath, region[1], 'gfs') != timestamp]
+    if not pending:
+        logging.info('Every region has already published this timestamp, aborting workflow')
+        write_atomic(timefile, timestamp)
+        return timestamp, True
+
+    # perform a redundancy check, if the last timestamp is the same as current, abort the workflow
+    # the file is only written once every region has finished (see the end of the workflow) so a failed run is retried
+    lasttime = None
     if not os.path.exists(timefile):
         redundant = False
-        with open(timefile, 'w') as tf:
-            tf.write(timestamp)
-        os.chmod(timefile, 0o777)
     else:
         with open(timefile, 'r') as file:
             lasttime = file.readline()
@@ -57,139 +111,207 @@ def setenvironment(threddspath, wrksppath):
             else:
                 # check to see if there are remnants of partially completed runs and dont destroy old folders
                 redundant = False
-                chk_hisp = os.path.join(wrksppath, 'hispaniola', 'gfs_GeoTIFFs_resampled')
-                chk_centr = os.path.join(wrksppath, 'centralamerica', 'gfs_GeoTIFFs_resampled')
+                chk_hisp = os.path.join(wrksppath, 'hispaniola', 'gfs_GeoTIFFs')
+                chk_centr = os.path.join(wrksppath, 'centralamerica', 'gfs_GeoTIFFs')
                 if os.path.exists(chk_hisp) and os.path.exists(chk_centr):
                     logging.info('There are data for this timestep but the workflow wasn\'t finished. Analyzing...')
                     return timestamp, redundant
 
     # create the file structure and their permissions for the new data
-    for region in FFGS_REGIONS:
+    for region in pending:
         logging.info('Creating APP WORKSPACE (GeoTIFF) file structure for ' + region[1])
         new_dir = os.path.join(wrksppath, region[1], 'gfs_GeoTIFFs')
         if os.path.exists(new_dir):
             shutil.rmtree(new_dir)
         os.mkdir(new_dir)
         os.chmod(new_dir, 0o777)
-        new_dir = os.path.join(wrksppath, region[1], 'gfs_GeoTIFFs_resampled')
-        if os.path.exists(new_dir):
-            shutil.rmtree(new_dir)
-        os.mkdir(new_dir)
-        os.chmod(new_dir, 0o777)
         logging.info('Creating THREDDS file structure for ' + region[1])
         new_dir = os.path.join(threddspath, region[1], 'gfs')
-        if os.path.exists(new_dir):
-            shutil.rmtree(new_dir)
-        os.mkdir(new_dir)
-        os.chmod(new_dir, 0o777)
+        if not os.path.exists(new_dir):
+            os.mkdir(new_dir)
+            os.chmod(new_dir, 0o777)
         new_dir = os.path.join(threddspath, region[1], 'gfs', timestamp)
         if os.path.exists(new_dir):
             shutil.rmtree(new_dir)
         os.mkdir(new_dir)
         os.chmod(new_dir, 0o777)
-        for filetype in ('gribs', 'netcdfs', 'processed'):
+        for filetype in ('gribs', 'processed'):
             new_dir = os.path.join(threddspath, region[1], 'gfs', timestamp, filetype)
             if os.path.exists(new_dir):
                 shutil.rmtree(new_dir)
             os.mkdir(new_dir)
             os.chmod(new_dir, 0o777)
 
+    if GFS_UNION_DOWNLOAD:
+        logging.info('Creating THREDDS file structure for the shared GFS downloads')
+        new_dir = os.path.join(threddspath, 'gfs_union')
+        # the shared gribs of this timestamp are kept when regions failed on the last run, the regions being retried
+        # are cropped from them and the downloads only fetch the steps that are missing (see gribdownloads.iter_gribs)
+        kept = timestamp if lasttime != 'clobbered' else None
+        if os.path.exists(new_dir):
+            for folder in os.listdir(new_dir):
+                if folder != kept:
+                    shutil.rmtree(os.path.join(new_dir, folder))
+        for new_dir in (new_dir, os.path.join(new_dir, timestamp), os.path.join(new_dir, timestamp, 'gribs')):
+            if not os.path.exists(new_dir):
+                os.mkdir(new_dir)
+                os.chmod(new_dir, 0o777)
+
     logging.info('All done setting up folders, on to do work')
     return timestamp, redundant
 
 
+def union_bbox(regions):
+    """
+    The smallest box (leftlon, rightlon, toplat, bottomlat) that contains the GFS subregions of every region
+    """
+    boxes = [GFS_SUBREGIONS[region] for region in regions]
+    return (
+        min(box[0] for box in boxes),
+        max(box[1] for box in boxes),
+        max(box[2] for box in boxes),
+        min(box[3] for box in boxes),
+    )
+
+
+def gfs_cycle_dir(timestamp):
+    """
+    The folder of a GFS cycle's files on the server, /gfs.<YYYYMMDD>/<HH>/atmos. The grib filter's dir parameter and
+    the paths of the inventories the scheduler checks (see scheduler.inventory_url) are both made from it.
+    """
+    return '/gfs.' + timestamp[:8] + '/' + timestamp[8:] + '/atmos'
+
+
+def gfs_file(timestamp, step):
+    """
+    The name of the 0.25 degree grib of a forecast step of a GFS cycle
+    """
+    return 'gfs.t' + timestamp[8:] + 'z.pgrb2.0p25.f' + step
+
+
+def gfs_downloads(timestamp, bbox, gribsdir):
+    """
+    Lists the (url, filepath) of each GFS forecast step to download for a subregion box, in the order of GFS_STEPS
+    Dependencies: datetime, os, urllib.parse
+    """
+    subregion = 'subregion=&leftlon=' + str(bbox[0]) + '&rightlon=' + str(bbox[1]) + \
+                '&toplat=' + str(bbox[2]) + '&bottomlat=' + str(bbox[3])
+
+    cycle_dir = urllib.parse.quote(gfs_cycle_dir(timestamp), safe='')
+
+    downloads = []
+    for step in GFS_STEPS:
+        url = GFS_BASE_URL + '/cgi-bin/filter_gfs_0p25.pl?file=' + gfs_file(timestamp, step) + \
+              '&lev_surface=on&var_APCP=on&' + subregion + '&dir=' + cycle_dir
+
+        fc_timestamp = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
+        file_timestep = fc_timestamp + datetime.timedelta(hours=int(step))
+        filename_timestep = datetime.datetime.strftime(file_timestep, "%Y%m%d%H")
+
+        filename = filename_timestep + '.grb'
+        downloads.append((url, os.path.join(gribsdir, filename)))
+    return downloads
+
+
+def fetch_gribs(downloads, gribsdir):
+    """
+    Downloads the gribs (see gribdownloads.download_gribs) and logs any that failed
+    """
+    # download the steps concurrently, skipping any that a previous attempt already finished
+    failed = download_gribs(downloads, gribsdir)
+    if failed:
+        logging.info('\nCould not download ' + str(len(failed)) + ' forecast steps:')
+        for url, filepath in failed:
+            logging.info(os.path.basename(filepath) + ' from ' + url)
+        return False
+    logging.info('Finished Downloads')
+    return True
+
+
 def download_gfs(threddspath, timestamp, region, model):
     logging.info('\nStarting GFS grib Downloads for ' + region)
     # set filepaths
     gribsdir = os.path.join(threddspath, region, model, timestamp, 'gribs')
 
-    # if you already have a folder with data for this timestep, quit this function (you dont need to download it)
+    # if the gribs folder is gone the later stages already used the downloads, you dont need to download them again
     if not os.path.exists(gribsdir):
         logging.info('There is no download folder, you must have already processed them. Skipping download stage.')
         return True
-    elif len(os.listdir(gribsdir)) >= 28:
-        logging.info('There are already 28 forecast steps in here. Dont need to download them')
-        return True
-    # otherwise, remove anything in the folder before starting (in case there was a partial download)
-    else:
-        shutil.rmtree(gribsdir)
-        os.mkdir(gribsdir)
-        os.chmod(gribsdir, 0o777)
-
-    # # get the parts of the timestamp to put into the url
-    time = datetime.datetime.strptime(timestamp, "%Y%m%d%H").strftime("%H")
-    fc_date = datetime.datetime.strptime(timestamp, "%Y%m%d%H").strftime("%Y%m%d")
-
-    # This is the List of forecast timesteps for 5 days (6-hr increments). download them all
-    fc_steps = ['006', '012', '018', '024', '030', '036', '042', '048', '054', '060', '066', '072', '078', '084',
-                '090', '096', '102', '108', '114', '120', '126', '132', '138', '144', '150', '156', '162', '168']
-
-    # this is where the actual downloads happen. set the url, filepath, then download
-    subregions = {
-        'hispaniola': 'subregion=&leftlon=-75&rightlon=-68&toplat=20.5&bottomlat=17',
-        'centralamerica': 'subregion=&leftlon=-94.25&rightlon=-75.5&toplat=19.5&bottomlat=5.5',
-    }
-    for step in fc_steps:
-        url = 'https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl?file=gfs.t' + time + 'z.pgrb2.0p25.f' + step + \
-              '&lev_surface=on&var_APCP=on&' + subregions[region] + '&dir=%2Fgfs.' + fc_date + '%2F' + time
 
-        fc_timestamp = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
-        file_timestep = fc_timestamp + datetime.timedelta(hours=int(step))
-        filename_timestep = datetime.datetime.strftime(file_timestep, "%Y%m%d%H")
+    return fetch_gribs(gfs_downloads(timestamp, GFS_SUBREGIONS[region], gribsdir), gribsdir)
 
-        filename = filename_timestep + '.grb'
-        logging.info('downloading the file ' + filename)
-        filepath = os.path.join(gribsdir, filename)
-        try:
-            with requests.get(url, stream=True) as r:
-                r.raise_for_status()
-                with open(filepath, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:  # filter out keep-alive new chunks
-                            f.write(chunk)
-        except requests.HTTPError as e:
-            errorcode = e.response.status_code
-            logging.info('\nHTTPError ' + str(errorcode) + ' downloading ' + filename + ' from\n' + url)
-            if errorcode == 404:
-                logging.info('The file was not found on the server, trying an older forecast time')
-            elif errorcode == 500:
-                logging.info('Probably a problem with the URL. Check the log and try the link')
-            return False
-    logging.info('Finished Downloads')
-    return True
 
+def download_gfs_union(threddspath, timestamp):
+    """
+    Downloads each GFS forecast step once for the box containing every region in FFGS_REGIONS so the number of
+    requests doesn't grow with the number of regions. gfs_tiffs crops each region's window out of these gribs.
+    Dependencies: datetime, os, gribdownloads
+    """
+    logging.info('\nStarting GFS grib Downloads for all regions')
+    gribsdir = os.path.join(threddspath, 'gfs_union', timestamp, 'gribs')
 
-def gfs_tiffs(threddspath, wrksppath, timestamp, region, model):
+    if not os.path.exists(gribsdir):
+        logging.info('There is no download folder, you must have already processed them. Skipping download stage.')
+        return True
+
+    bbox = union_bbox([region[1] for region in FFGS_REGIONS])
+    logging.info('downloading the box leftlon, rightlon, toplat, bottomlat = ' + str(bbox))
+    return fetch_gribs(gfs_downloads(timestamp, bbox, gribsdir), gribsdir)
+
+
+def region_window(gribpath, region):
     """
-    Script to combine 6-hr accumulation grib files into 24-hr accumulation geotiffs.
-    Dependencies: datetime, os, numpy, rasterio
+    Finds the rows and columns of a grib that hold the grid points inside a region's GFS subregion
+    Dependencies: numpy, xarray, rasterio
+    """
+    leftlon, rightlon, toplat, bottomlat = GFS_SUBREGIONS[region]
+    obj = xarray.open_dataset(gribpath, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'surface'}})
+    lats = obj['latitude'].values
+    lons = obj['longitude'].values % 360
+    obj.close()
+    # a little tolerance since the grid points and the region edges are both multiples of .25 degrees
+    rows = numpy.where((lats <= toplat + 1e-6) & (lats >= bottomlat - 1e-6))[0]
+    cols = numpy.where((lons >= leftlon % 360 - 1e-6) & (lons <= rightlon % 360 + 1e-6))[0]
+    return rasterio.windows.Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+
+
+def prepare_conversion(threddspath, wrksppath, timestamp, region, model):
+    """
+    Empties the folders the converted forecast steps are written to, in case there was a partial conversion.
+    Returns False if there is no gribs folder because the conversions have already been done.
     """
-    logging.info('\nStarting to process the ' + model + ' gribs into GeoTIFFs')
-    # declare the environment
     tiffs = os.path.join(wrksppath, region, model + '_GeoTIFFs')
     gribs = os.path.join(threddspath, region, model, timestamp, 'gribs')
-    netcdfs = os.path.join(threddspath, region, model, timestamp, 'netcdfs')
+    processed = os.path.join(threddspath, region, model, timestamp, 'processed')
 
-    # if you already have gfs netcdfs in the netcdfs folder, quit the function
+    # if the gribs are gone, the netcdfs in the processed folder are already done, quit the function
     if not os.path.exists(gribs):
         logging.info('There is no gribs folder, you must have already run this step. Skipping conversions')
-        return
+        return False
     # otherwise, remove anything in the folder before starting (in case there was a partial conversion)
-    else:
-        shutil.rmtree(netcdfs)
-        os.mkdir(netcdfs)
-        os.chmod(netcdfs, 0o777)
-        shutil.rmtree(tiffs)
-        os.mkdir(tiffs)
-        os.chmod(tiffs, 0o777)
+    shutil.rmtree(processed)
+    os.mkdir(processed)
+    os.chmod(processed, 0o777)
+    if WRITE_COGS:
+        cogs = os.path.join(threddspath, region, model, timestamp, 'cogs')
+        if os.path.exists(cogs):
+            shutil.rmtree(cogs)
+        os.mkdir(cogs)
+        os.chmod(cogs, 0o777)
+    shutil.rmtree(tiffs)
+    os.mkdir(tiffs)
+    os.chmod(tiffs, 0o777)
+    return True
 
-    # create a list of all the files of type grib and convert to a list of their file paths
-    files = os.listdir(gribs)
-    files = [grib for grib in files if grib.endswith('.grb')]
-    files.sort()
 
+def gfs_grid(path, region):
+    """
+    Reads the grid of a grib once to apply to all the forecast steps
+    Returns (geotransform, window) where window is the part of the shared gribs covering the region, or None when the
+    gribs are the region's own downloads
+    Dependencies: rasterio
+    """
     # Read raster dimensions only once to apply to all rasters
-    path = os.path.join(gribs, files[0])
     raster_dim = rasterio.open(path)
     width = raster_dim.width
     height = raster_dim.height
@@ -201,392 +323,362 @@ def gfs_tiffs(threddspath, wrksppath, timestamp, region, model):
     # Geotransform for each 24-hr raster (east, south, west, north, width, height)
     geotransform = rasterio.transform.from_bounds(lon_min, lat_min, lon_max, lat_max, width, height)
 
-    # Add rasters together to form 24-hr raster
-    for i in files:
-        logging.info('working on file ' + i)
-        path = os.path.join(gribs, i)
-        src = rasterio.open(path)
-        file_array = src.read(1)
-
-        # using the last grib file for the day (path) convert it to a netcdf and set the variable to file_array
-        logging.info('opening grib file ' + path)
-        obj = xarray.open_dataset(path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'surface'}})
-        logging.info('converting it to a netcdf')
-        ncname = i.replace('.grb', '.nc')
-        logging.info('saving it to the path ' + path)
-        ncpath = os.path.join(netcdfs, ncname)
-        obj.to_netcdf(ncpath, mode='w')
-        logging.info('converted')
-        logging.info('writing the correct values to the tp array')
-        nc = netCDF4.Dataset(ncpath, 'a')
-        nc['tp'][:] = file_array
-        nc.close()
-        logging.info('created a netcdf')
-
-        # Specify the GeoTIFF filepath
-        tif_filename = i.replace('grb', 'tif')
-        tif_filepath = os.path.join(tiffs, tif_filename)
-
-        # Save the 24-hr raster
-        with rasterio.open(
-                tif_filepath,
-                'w',
-                driver='GTiff',
-                height=file_array.shape[0],
-                width=file_array.shape[1],
-                count=1,
-                dtype=file_array.dtype,
-                nodata=numpy.nan,
-                crs='+proj=latlong',
-                transform=geotransform,
-        ) as dst:
-            dst.write(file_array, 1)
-        logging.info('wrote it to a GeoTIFF\n')
-
-    # clear the gribs folder now that we're done with this
-    shutil.rmtree(gribs)
-
-    return
+    # when the gribs are shared, only read the window of the gribs covering this region
+    window = None
+    if GFS_UNION_DOWNLOAD:
+        window = region_window(path, region)
+        geotransform = rasterio.windows.transform(window, geotransform)
+        logging.info('cropping the shared gribs to the window ' + str(window))
+    return geotransform, window
 
 
-def resample(wrksppath, region, model):
+def convert_step(path, window, geotransform, metadata, timestamp, processed, tiffs, cogs):
     """
-    Script to resample rasters from .25 o .0025 degree in order for rasterstats to work
-    Dependencies: datetime, os, numpy, rasterio
+    Decodes the raster of one forecast step's grib and writes it to the THREDDS ready netcdf in the processed folder
+    (and a GeoTIFF if WRITE_GEOTIFFS is set and a cloud optimized GeoTIFF in cogs if WRITE_COGS is set). metadata is
+    the grib_metadata shared by every step.
+    Returns the raster for the zonal statistics
+    Dependencies: os, numpy, rasterio, ncwriter, cogwriter
     """
-    logging.info('\nResampling the rasters for ' + region)
-    # Define app workspace and sub-paths
-    tiffs = os.path.join(wrksppath, region, model + '_GeoTIFFs')
-    resampleds = os.path.join(wrksppath, region, model + '_GeoTIFFs_resampled')
-
-    # Create directory for the resampled GeoTIFFs
-    if not os.path.exists(tiffs):
-        logging.info('There is no tiffs folder. You must have already resampled them. Skipping resampling')
-        return
-
-    # List all Resampled GeoTIFFs
-    files = os.listdir(tiffs)
-    files = [tif for tif in files if tif.endswith('.tif')]
-    files.sort()
-
-    # Read raster dimensions
-    path = os.path.join(tiffs, files[0])
-    raster_dim = rasterio.open(path)
-    width = raster_dim.width
-    height = raster_dim.height
-    lon_min = raster_dim.bounds.left
-    lon_max = raster_dim.bounds.right
-    lat_min = raster_dim.bounds.bottom
-    lat_max = raster_dim.bounds.top
-
-    # Geotransform for each resampled raster (east, south, west, north, width, height)
-    geotransform_res = rasterio.transform.from_bounds(lon_min, lat_min, lon_max, lat_max, width * 100, height * 100)
-
-    # Resample each GeoTIFF
-    for file in files:
-        path = os.path.join(tiffs, file)
-        logging.info(path)
-        with rasterio.open(path) as dataset:
-            data = dataset.read(
-                out_shape=(int(dataset.height * 100), int(dataset.width * 100)),
-                # Reduce 100 to 10 if using the whole globe
-                resampling=Resampling.nearest
-            )
-
-        # Convert new resampled array from 3D to 2D
-        data = numpy.squeeze(data, axis=0)
-
-        # Specify the filepath of the resampled raster
-        resample_filename = file.replace('.tif', '_resampled.tif')
-        resample_filepath = os.path.join(resampleds, resample_filename)
-
-        # Save the GeoTIFF
-        with rasterio.open(
-                resample_filepath,
-                'w',
-                driver='GTiff',
-                height=data.shape[0],
-                width=data.shape[1],
-                count=1,
-                dtype=data.dtype,
-                nodata=numpy.nan,
-                crs='+proj=latlong',
-                transform=geotransform_res,
-        ) as dst:
-            dst.write(data, 1)
-
-    # delete the non-resampled tiffs now that we dont need them
-    shutil.rmtree(tiffs)
-
-    return
-
+    i = os.path.basename(path)
+    logging.info('working on file ' + i)
+    src = rasterio.open(path)
+    file_array = src.read(1, window=window)
+
+    # write the raster straight to its final netcdf, unless every step is written to one netcdf afterwards
+    if not AGGREGATE_OUTPUT:
+        ncpath = os.path.join(processed, 'processed_' + i.replace('.grb', '.nc'))
+        logging.info('saving it to the path ' + ncpath)
+        write_netcdf(ncpath, file_array, metadata, timestamp, lead_hours(timestamp, i[:10]))
+        logging.info('created a netcdf')
 
-def zonal_statistics(wrksppath, timestamp, region, model):
+    if WRITE_COGS:
+        write_cog(os.path.join(cogs, i.replace('.grb', '.tif')), file_array, geotransform)
+        logging.info('wrote it to a cloud optimized GeoTIFF')
+
+    if not WRITE_GEOTIFFS:
+        return file_array
+
+    # Specify the GeoTIFF filepath
+    tif_filename = i.replace('grb', 'tif')
+    tif_filepath = os.path.join(tiffs, tif_filename)
+
+    # Save the 24-hr raster
+    with rasterio.open(
+            tif_filepath,
+            'w',
+            driver='GTiff',
+            height=file_array.shape[0],
+            width=file_array.shape[1],
+            count=1,
+            dtype=file_array.dtype,
+            nodata=numpy.nan,
+            crs='+proj=latlong',
+            transform=geotransform,
+    ) as dst:
+        dst.write(file_array, 1)
+    logging.info('wrote it to a GeoTIFF\n')
+    return file_array
+
+
+def grib_source(threddspath, timestamp, region, model):
     """
-    Script to calculate average precip over FFGS polygon shapefile
-    Dependencies: datetime, os, pandas, rasterstats
+    The folder of gribs a region's rasters are read from: its own downloads or the shared downloads that each region
+    is cropped out of
     """
-    logging.info('\nDoing Zonal Statistics on ' + region)
-    # Define app workspace and sub-paths
-    resampleds = os.path.join(wrksppath, region, model + '_GeoTIFFs_resampled')
-    shp_path = os.path.join(wrksppath, region, 'shapefiles', 'ffgs_' + region + '.shp')
-
-    stat_file = os.path.join(wrksppath, region, model + 'results.csv')
-
-    # check that there are resampled tiffs to do zonal statistics on
-    if not os.path.exists(resampleds):
-        logging.info('There are no resampled tiffs to do zonal statistics on. Skipping Zonal Statistics')
-        return
-
-    # List all Resampled GeoTIFFs
-    files = os.listdir(resampleds)
-    files = [tif for tif in files if tif.endswith('.tif')]
-    files.sort()
-
-    # do zonal statistics for each resampled tiff file and put it in the stats dataframe
-    stats_df = pd.DataFrame()
-    for i in range(len(files)):
-        logging.info('starting zonal statistics for ' + files[i])
-        ras_path = os.path.join(resampleds, files[i])
-        stats = rasterstats.zonal_stats(
-            shp_path,
-            ras_path,
-            stats=['count', 'max', 'mean'],
-            geojson_out=True
-            )
-
-        timestep = files[i][:10]
+    if GFS_UNION_DOWNLOAD:
+        return os.path.join(threddspath, 'gfs_union', timestamp, 'gribs')
+    return os.path.join(threddspath, region, model, timestamp, 'gribs')
 
-        # for each stat that you get out, write it to the dataframe
-        logging.info('writing the statistics for this file to the dataframe')
-        for j in range(len(stats)):
 
-            temp_data = stats[j]['properties']
-            temp_data.update({'Forecast Timestamp': timestamp})
-            temp_data.update({'Timestep': timestep})
-
-            temp_df = pd.DataFrame([temp_data])
-            stats_df = stats_df.append(temp_df, ignore_index=True)
-
-    # write the resulting dataframe to a csv
-    logging.info('\ndone with zonal statistics, rounding values, writing to a csv file')
-    stats_df = stats_df.round({'max': 1, 'mean': 1})
-    stats_df.to_csv(stat_file, index=False)
-
-    # delete the resampled tiffs now that we dont need them
-    logging.info('deleting the resampled tiffs directory')
-    shutil.rmtree(resampleds)
-
-    return
-
-
-def nc_georeference(threddspath, timestamp, region, model):
+def gfs_tiffs(threddspath, wrksppath, timestamp, region, model):
     """
-    Description: Intended to make a THREDDS data server compatible netcdf file out of an incorrectly structured
-        netcdf file.
-    Author: Riley Hales, 2019
-    Dependencies: netCDF4, os, datetime
-    see github/rileyhales/datatools for more details
+    Script to combine 6-hr accumulation grib files into 24-hr accumulation geotiffs.
+    Returns the (timesteps, geotransform, cube) of the decoded rasters for the zonal statistics.
+    Dependencies: datetime, os, numpy, rasterio
     """
-    logging.info('\nProcessing the netCDF files')
-
-    # setting the environment file paths
-    netcdfs = os.path.join(threddspath, region, model, timestamp, 'netcdfs')
+    logging.info('\nStarting to process the ' + model + ' gribs into GeoTIFFs')
+    # declare the environment
+    tiffs = os.path.join(wrksppath, region, model + '_GeoTIFFs')
+    gribs = os.path.join(threddspath, region, model, timestamp, 'gribs')
     processed = os.path.join(threddspath, region, model, timestamp, 'processed')
-
-    # if you already have processed netcdfs files, skip this and quit the function
-    if not os.path.exists(netcdfs):
-        logging.info('There are no netcdfs to be converted. Skipping netcdf processing.')
+    cogs = os.path.join(threddspath, region, model, timestamp, 'cogs')
+    if not prepare_conversion(threddspath, wrksppath, timestamp, region, model):
         return
-    # otherwise, remove anything in the folder before starting (in case there was a partial processing)
-    else:
-        shutil.rmtree(processed)
-        os.mkdir(processed)
-        os.chmod(processed, 0o777)
-
-    # list the files that need to be converted
-    net_files = os.listdir(netcdfs)
-    files = [file for file in net_files if file.endswith('.nc')]
-    logging.info('There are ' + str(len(files)) + ' compatible files.')
-
-    # read the first file that we'll copy data from in the next blocks of code
-    logging.info('Preparing the reference file')
-    path = os.path.join(netcdfs, net_files[0])
-    netcdf_obj = netCDF4.Dataset(path, 'r', clobber=False, diskless=True)
-
-    # get a dictionary of the dimensions and their size and rename the north/south and east/west ones
-    dimensions = {}
-    for dimension in netcdf_obj.dimensions.keys():
-        dimensions[dimension] = netcdf_obj.dimensions[dimension].size
-    dimensions['lat'] = dimensions['latitude']
-    dimensions['lon'] = dimensions['longitude']
-    dimensions['time'] = 1
-    del dimensions['latitude'], dimensions['longitude']
-
-    # get a list of the variables and remove the one's i'm going to 'manually' correct
-    variables = netcdf_obj.variables
-    del variables['valid_time'], variables['step'], variables['latitude'], variables['longitude'], variables['surface']
-    variables = variables.keys()
-
-    # min lat and lon and the interval between values (these are static values
-    netcdf_obj.close()
-
-    # this is where the files start getting copied
-    for file in files:
-        logging.info('Working on file ' + str(file))
-        openpath = os.path.join(netcdfs, file)
-        savepath = os.path.join(processed, 'processed_' + file)
-        # open the file to be copied
-        original = netCDF4.Dataset(openpath, 'r', clobber=False, diskless=True)
-        duplicate = netCDF4.Dataset(savepath, 'w', clobber=True, format='NETCDF4', diskless=False)
-        # set the global netcdf attributes - important for georeferencing
-        duplicate.setncatts(original.__dict__)
-
-        # specify dimensions from what we copied before
-        for dimension in dimensions:
-            duplicate.createDimension(dimension, dimensions[dimension])
-
-        # 'Manually' create the dimensions that need to be set carefully
-        duplicate.createVariable(varname='lat', datatype='f4', dimensions='lat')
-        duplicate.createVariable(varname='lon', datatype='f4', dimensions='lon')
-
-        # create the lat and lon values as a 1D array
-        duplicate['lat'][:] = original['latitude'][:]
-        duplicate['lon'][:] = original['longitude'][:]
-
-        # set the attributes for lat and lon (except fill value, you just can't copy it)
-        for attr in original['latitude'].__dict__:
-            if attr != "_FillValue":
-                duplicate['lat'].setncattr(attr, original['latitude'].__dict__[attr])
-        for attr in original['longitude'].__dict__:
-            if attr != "_FillValue":
-                duplicate['lon'].setncattr(attr, original['longitude'].__dict__[attr])
-
-        # copy the rest of the variables
-        hour = 6
-        for variable in variables:
-            # check to use the lat/lon dimension names
-            dimension = original[variable].dimensions
-            if 'latitude' in dimension:
-                dimension = list(dimension)
-                dimension.remove('latitude')
-                dimension.append('lat')
-                dimension = tuple(dimension)
-            if 'longitude' in dimension:
-                dimension = list(dimension)
-                dimension.remove('longitude')
-                dimension.append('lon')
-                dimension = tuple(dimension)
-            if len(dimension) == 2:
-                dimension = ('time', 'lat', 'lon')
-            if variable == 'time':
-                dimension = ('time',)
-
-            # create the variable
-            duplicate.createVariable(varname=variable, datatype='f4', dimensions=dimension)
-
-            # copy the arrays of data and set the timestamp/properties
-            date = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
-            date = datetime.datetime.strftime(date, "%Y-%m-%d %H:00:00")
-            if variable == 'time':
-                duplicate[variable][:] = [hour]
-                hour = hour + 6
-                duplicate[variable].long_name = original[variable].long_name
-                duplicate[variable].units = "hours since " + date
-                duplicate[variable].axis = "T"
-                # also set the begin date of this data
-                duplicate[variable].begin_date = timestamp
-            if variable == 'lat':
-                duplicate[variable][:] = original[variable][:]
-                duplicate[variable].axis = "Y"
-            if variable == 'lon':
-                duplicate[variable][:] = original[variable][:]
-                duplicate[variable].axis = "X"
-            else:
-                duplicate[variable][:] = original[variable][:]
-                duplicate[variable].axis = "lat lon"
-            duplicate[variable].long_name = original[variable].long_name
-            duplicate[variable].begin_date = timestamp
-            duplicate[variable].units = original[variable].units
 
-        # close the files, delete the one you just did, start again
-        original.close()
-        duplicate.sync()
-        duplicate.close()
+    # create a list of all the files of type grib and convert to a list of their file paths
+    source = grib_source(threddspath, timestamp, region, model)
+    files = os.listdir(source)
+    files = [grib for grib in files if grib.endswith('.grb')]
+    files.sort()
+    geotransform, window = gfs_grid(os.path.join(source, files[0]), region)
+    metadata = grib_metadata(os.path.join(source, files[0]), window)
 
-    # delete the netcdfs now that we're done with them triggering future runs to skip this step
-    shutil.rmtree(netcdfs)
+    # convert the steps in parallel and keep the rasters, in order, for the zonal statistics
+    with ProcessPoolExecutor(max_workers=STEP_WORKERS) as pool:
+        tasks = [pool.submit(convert_step, os.path.join(source, i), window, geotransform, metadata, timestamp,
+                             processed, tiffs, cogs) for i in files]
+        rasters = [task.result() for task in tasks]
 
-    logging.info('Finished File Conversions')
-    return
+    timesteps = [file[:10] for file in files]
+    cube = numpy.stack(rasters)
+    if AGGREGATE_OUTPUT:
+        write_forecast_cube(threddspath, timestamp, region, model, timesteps, cube, metadata, CUBE_CHUNKS)
+    if WRITE_COGS:
+        write_cog(os.path.join(cogs, 'total.tif'), numpy.nansum(cube, axis=0), geotransform)
+    if ARCHIVE_ZARR:
+        # zarr is only needed when the archive is used
+        from zarrarchive import archive_forecast
+        archive_forecast(threddspath, timestamp, region, model, timesteps, cube, metadata)
+
+    # the gribs are only needed again if the statistics can't be computed from the GeoTIFFs, see cleanup
+    if WRITE_GEOTIFFS:
+        shutil.rmtree(gribs)
+
+    return timesteps, geotransform, cube
 
 
 def new_ncml(threddspath, timestamp, region, model):
     logging.info('\nWriting a new ncml file for this date')
     # create a new ncml file by filling in the template with the right dates and writing to a file
-    ncml = os.path.join(threddspath, region, model, 'wms.ncml')
+    ncml = os.path.join(run_dir(threddspath, region, model, timestamp), 'wms.ncml')
     date = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
     date = datetime.datetime.strftime(date, "%Y-%m-%d %H:00:00")
-    with open(ncml, 'w') as file:
-        file.write(
-            '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2">\n'
-            '    <variable name="time" type="int" shape="time">\n'
-            '        <attribute name="units" value="hours since ' + date + '"/>\n'
+    # the ncml is in the run's folder with the files it points to, THREDDS serves it through the current link
+    if AGGREGATE_OUTPUT:
+        # every step is in one netcdf with its own time coordinate, nothing needs to be scanned or joined
+        write_atomic(ncml, (
+            '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2" '
+            'location="' + cube_name(model, timestamp) + '">\n'
+            '    <variable name="time">\n'
             '        <attribute name="_CoordinateAxisType" value="Time" />\n'
-            '        <values start="6" increment="6" />\n'
             '    </variable>\n'
-            '    <aggregation dimName="time" type="joinExisting" recheckEvery="1 hour">\n'
-            '        <scan location="' + timestamp + '/processed/"/>\n'
-            '    </aggregation>\n'
             '</netcdf>'
-        )
+        ))
+        logging.info('Wrote New .ncml')
+        return
+    write_atomic(ncml, (
+        '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2">\n'
+        '    <variable name="time" type="int" shape="time">\n'
+        '        <attribute name="units" value="hours since ' + date + '"/>\n'
+        '        <attribute name="_CoordinateAxisType" value="Time" />\n'
+        '        <values start="6" increment="6" />\n'
+        '    </variable>\n'
+        '    <aggregation dimName="time" type="joinExisting" recheckEvery="1 hour">\n'
+        '        <scan location="processed/"/>\n'
+        '    </aggregation>\n'
+        '</netcdf>'
+    ))
     logging.info('Wrote New .ncml')
     return
 
 
-def new_colorscales(wrksppath, region, model):
-    # set the environment
-    logging.info('\nGenerating a new color scale csv for the ' + model + ' results')
-    colorscales = os.path.join(wrksppath, region, model + 'colorscales.csv')
-    results = os.path.join(wrksppath, region, model + 'results.csv')
-    logging.info(results)
-    answers = pd.DataFrame(columns=['cat_id', 'cum_mean', 'mean', 'max'])
-
-    res_df = pd.read_csv(results, index_col=False)[['cat_id', 'mean', 'max']]
-    ids = res_df.cat_id.unique()
-    for catid in ids:
-        df = res_df.query("cat_id == @catid")
-        cum_mean = round(sum(df['mean'].values), 1)
-        mean = max(df['mean'].values)
-        maximum = max(df['max'].values)
-        answers = answers.append(
-            {'cat_id': catid, 'cum_mean': cum_mean, 'mean': mean, 'max': maximum},
-            ignore_index=True)
-
-    answers.to_csv(colorscales, mode='w', index=False)
-    logging.info('Wrote new rules to csv')
-    return
+def publish_steps(downloads, gribsdir, queues, published=None):
+    """
+    Downloads the gribs and puts the path of each step on every queue as soon as it is available, then None when
+    there are no more. Blocks while a queue is full so the downloads don't get too far ahead of the processing.
+    published lets the run start before the whole forecast is on the server: it is called with how many of the
+    downloads (in the order of GFS_STEPS, the order the server publishes them) have been fetched, waits until more
+    are published and returns how many are (see scheduler.published_steps). The steps it can't wait for fail.
+    Returns the list of (url, filepath) pairs that could not be downloaded.
+    Dependencies: gribdownloads
+    """
+    failed = []
+    try:
+        done = 0
+        while done < len(downloads):
+            ready = len(downloads) if published is None else min(published(done), len(downloads))
+            if ready <= done:
+                failed.extend(downloads[done:])
+                logging.info('Gave up waiting for ' + str(len(downloads) - done) + ' forecast steps to be published')
+                break
+            for url, filepath, succeeded in iter_gribs(downloads[done:ready], gribsdir):
+                if not succeeded:
+                    logging.info('Could not download ' + os.path.basename(filepath) + ' from ' + url)
+                    failed.append((url, filepath))
+                    continue
+                for steps in queues:
+                    steps.put(filepath)
+            done = ready
+    finally:
+        for steps in queues:
+            steps.put(None)
+    return failed
+
+
+def drain(steps):
+    """
+    Takes everything off a queue of steps until the None that ends it so whatever is filling it isn't blocked
+    """
+    while steps.get() is not None:
+        pass
+
 
+def pipeline_region(threddspath, wrksppath, timestamp, region, model, steps, expected):
+    """
+    The pipelined version of gfs_tiffs and zonal_statistics. steps is a queue of the paths of the region's gribs in
+    the order they were downloaded, ending with None. Each one is decoded and converted in one thread while the
+    statistics of the steps already decoded are computed in this one.
+    Returns False if fewer than the expected number of steps arrived, i.e. some downloads failed.
+    Dependencies: os, queue, threading, numpy, zonalstats, resultstore
+    """
+    logging.info('\nStarting to process the ' + model + ' gribs of ' + region + ' as they are downloaded')
+    tiffs = os.path.join(wrksppath, region, model + '_GeoTIFFs')
+    gribs = os.path.join(threddspath, region, model, timestamp, 'gribs')
+    processed = os.path.join(threddspath, region, model, timestamp, 'processed')
+    cogs = os.path.join(threddspath, region, model, timestamp, 'cogs')
+    shp_path = os.path.join(wrksppath, region, 'shapefiles', 'ffgs_' + region + '.shp')
+    coverage_path = os.path.join(wrksppath, region, model + '_coverage.npz')
+
+    try:
+        prepared = prepare_conversion(threddspath, wrksppath, timestamp, region, model)
+    except Exception:
+        drain(steps)
+        raise
+    # the conversions are already done, only the statistics could be missing
+    if not prepared:
+        drain(steps)
+        zonal_statistics(threddspath, wrksppath, timestamp, region, model)
+        return True
+
+    # an error in a stage is passed along and the stages keep emptying their queues so nothing upstream is blocked
+    decoded = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    grid = {}
 
-def cleanup(threddspath, timestamp, region, model):
-    # delete anything that isn't the new folder of data (named for the timestamp) or the new wms.ncml file
-    logging.info('Getting rid of old ' + model + ' data folders')
-    path = os.path.join(threddspath, region, model)
-    files = os.listdir(path)
-    files.remove(timestamp)
-    files.remove('wms.ncml')
-    for file in files:
+    def decode():
+        failed = False
         try:
-            shutil.rmtree(os.path.join(path, file))
-        except:
-            os.remove(os.path.join(path, file))
-    logging.info('Done')
-    return
+            for path in iter(steps.get, None):
+                if failed:
+                    continue
+                try:
+                    if not grid:
+                        grid['geotransform'], grid['window'] = gfs_grid(path, region)
+                        grid['metadata'] = grib_metadata(path, grid['window'])
+                    raster = convert_step(path, grid['window'], grid['geotransform'], grid['metadata'], timestamp,
+                                          processed, tiffs, cogs)
+                    decoded.put((os.path.basename(path)[:10], grid['geotransform'], raster))
+                except Exception as e:
+                    failed = True
+                    decoded.put(e)
+        finally:
+            decoded.put(None)
+
+    decoder = threading.Thread(target=decode, daemon=True)
+    decoder.start()
+
+    error = None
+    timesteps, means, maxima, rasters = [], [], [], []
+    for item in iter(decoded.get, None):
+        if error is not None:
+            continue
+        if isinstance(item, Exception):
+            error = item
+            continue
+        try:
+            timestep, transform, raster = item
+            if not timesteps:
+                cat_ids, matrix = load_coverage(coverage_path, shp_path, transform, raster.shape[1], raster.shape[0])
+            mean, maximum, count = cube_statistics(matrix, raster[numpy.newaxis])
+            logging.info('computed the statistics of ' + timestep)
+            timesteps.append(timestep)
+            means.append(mean[0])
+            maxima.append(maximum[0])
+            rasters.append(raster)
+        except Exception as e:
+            error = e
+    decoder.join()
+    if error is not None:
+        raise error
+
+    if not timesteps or len(timesteps) < expected:
+        logging.info('Only ' + str(len(timesteps)) + ' of ' + str(expected) + ' forecast steps were downloaded')
+        return False
+
+    # the steps finish downloading in any order, the results are written in forecast order
+    order = numpy.argsort(timesteps)
+    logging.info('\ndone with zonal statistics, writing the results and color scales')
+    rundir = run_dir(threddspath, region, model, timestamp)
+    write_results(rundir, wrksppath, region, model, timestamp, cat_ids, [timesteps[index] for index in order],
+                  numpy.stack(means)[order], numpy.stack(maxima)[order], count)
+    cube = numpy.stack(rasters)[order]
+    timesteps = [timesteps[index] for index in order]
+    write_pixel_cube(rundir, timestamp, timesteps, cube, grid['geotransform'])
+    if AGGREGATE_OUTPUT:
+        write_forecast_cube(threddspath, timestamp, region, model, timesteps, cube, grid['metadata'],
+                            CUBE_CHUNKS)
+    if WRITE_COGS:
+        write_cog(os.path.join(cogs, 'total.tif'), numpy.nansum(cube, axis=0), grid['geotransform'])
+    if ARCHIVE_ZARR:
+        # zarr is only needed when the archive is used
+        from zarrarchive import archive_forecast
+        archive_forecast(threddspath, timestamp, region, model, timesteps, cube, grid['metadata'])
+
+    # the same cleanup gfs_tiffs and zonal_statistics do
+    if WRITE_GEOTIFFS:
+        shutil.rmtree(gribs)
+    if os.path.exists(tiffs):
+        shutil.rmtree(tiffs)
+    return True
+
+
+def init_region_logging(logpath):
+    """
+    Sends the logging of a region's process to the workflow's log file
+    """
+    if not logging.getLogger().handlers:
+        logging.basicConfig(filename=logpath, filemode='a', level=logging.INFO, format='%(message)s')
 
 
-def run_gfs_workflow(threddspath):
+def process_region(threddspath, wrksppath, timestamp, region, model, steps=None, expected=None):
     """
-    The controller for running the workflow to download and process data
+    Runs every step of the workflow for one region, in its own process when called by run_gfs_workflow. When
+    PIPELINED is set, steps is the queue of the shared gribs as they are downloaded (see publish_steps) and expected
+    is how many there should be, or None to have the region download its own gribs.
+    Returns (region, status) where status is 'Finished' or what went wrong
+    """
+    logging.info('\nBeginning to process ' + region + ' on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    try:
+        if PIPELINED:
+            if steps is None:
+                # the region's own downloads feed its pipeline
+                gribsdir = os.path.join(threddspath, region, model, timestamp, 'gribs')
+                downloads = []
+                if os.path.exists(gribsdir):
+                    downloads = gfs_downloads(timestamp, GFS_SUBREGIONS[region], gribsdir)
+                steps = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+                expected = len(downloads)
+                threading.Thread(target=publish_steps, args=(downloads, gribsdir, [steps]), daemon=True).start()
+            if not pipeline_region(threddspath, wrksppath, timestamp, region, model, steps, expected):
+                return region, 'Downloading Errors Occurred'
+        else:
+            # download each forecast model, convert them to netcdfs and tiffs
+            if not GFS_UNION_DOWNLOAD:
+                succeeded = download_gfs(threddspath, timestamp, region, model)
+                if not succeeded:
+                    return region, 'Downloading Errors Occurred'
+            forecast = gfs_tiffs(threddspath, wrksppath, timestamp, region, model)
+            # the geoprocessing functions
+            zonal_statistics(threddspath, wrksppath, timestamp, region, model, forecast)
+        # generate the ncml aggregation files (the color scales are written with the zonal statistics)
+        new_ncml(threddspath, timestamp, region, model)
+        # switch THREDDS and the app to the new run in one step then remove the old runs
+        publish_run(threddspath, region, model, timestamp)
+        cleanup(threddspath, timestamp, region, model)
+        # remake the simplified watersheds the map draws if the shapefile has changed
+        build_geometry(wrksppath, region)
+    except Exception as e:
+        logging.exception('processing ' + region + ' failed')
+        return region, 'Failed- ' + repr(e)
+    logging.info('\nFinished processing ' + region + ' on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    return region, 'Finished'
+
+
+def run_gfs_workflow(threddspath, workers=REGION_WORKERS, timestamp=None, published=None):
+    """
+    The controller for running the workflow to download and process data. timestamp is the forecast (YYYYMMDDHH) to
+    process, see setenvironment. published is passed on to publish_steps when PIPELINED and GFS_UNION_DOWNLOAD are
+    set so the scheduler can start the run before every step is on the server.
     """
     wrksppath = os.path.join(
         os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tethysapp', 'ffgs', 'workspaces', 'app_workspace')
@@ -597,39 +689,61 @@ def run_gfs_workflow(threddspath):
     logging.info('Workflow initiated on ' + datetime.datetime.utcnow().strftime("%D at %R"))
 
     # start the workflow by setting the environment
-    timestamp, redundant = setenvironment(threddspath, wrksppath)
+    timestamp, redundant = setenvironment(threddspath, wrksppath, timestamp)
     model = 'gfs'
 
     # if this has already been done for the most recent forecast, abort the workflow
     if redundant:
         logging.info('\nWorkflow aborted on ' + datetime.datetime.utcnow().strftime("%D at %R"))
         return 'Workflow Aborted- already run for most recent data'
+    # the regions that already published this forecast are left alone, their run is live
+    regions = [region[1] for region in FFGS_REGIONS if published_run(threddspath, region[1], model) != timestamp]
 
-    # run the workflow for each region, for each model in that region
-    for region in FFGS_REGIONS:
-        logging.info('\nBeginning to process ' + region[1] + ' on ' + datetime.datetime.utcnow().strftime("%D at %R"))
-        # download each forecast model, convert them to netcdfs and tiffs
-        succeeded = download_gfs(threddspath, timestamp, region[1], model)
+    # download the forecast once for all the regions
+    if GFS_UNION_DOWNLOAD and not PIPELINED:
+        succeeded = download_gfs_union(threddspath, timestamp)
         if not succeeded:
             return 'Workflow Aborted- Downloading Errors Occurred'
-        gfs_tiffs(threddspath, wrksppath, timestamp, region[1], model)
-        resample(wrksppath, region[1], model)
-        # the geoprocessing functions
-        zonal_statistics(wrksppath, timestamp, region[1], model)
-        nc_georeference(threddspath, timestamp, region[1], model)
-        # generate color scales and ncml aggregation files
-        new_ncml(threddspath, timestamp, region[1], model)
-        new_colorscales(wrksppath, region[1], model)
-        # cleanup the workspace by removing old files
-        cleanup(threddspath, timestamp, region[1], model)
+
+    # run the workflow for each region at the same time, a region that fails doesn't stop the others being published
+    if GFS_UNION_DOWNLOAD and PIPELINED:
+        # every region has to be running to take the steps off its queue, otherwise the downloads would stop
+        gribsdir = os.path.join(threddspath, 'gfs_union', timestamp, 'gribs')
+        downloads = []
+        if os.path.exists(gribsdir):
+            downloads = gfs_downloads(timestamp, union_bbox([region[1] for region in FFGS_REGIONS]), gribsdir)
+        with Manager() as manager, ProcessPoolExecutor(
+                max_workers=len(regions), initializer=init_region_logging, initargs=(logpath,)) as pool:
+            queues = {region: manager.Queue(maxsize=PIPELINE_QUEUE_SIZE) for region in regions}
+            futures = [pool.submit(process_region, threddspath, wrksppath, timestamp, region, model,
+                                   queues[region], len(downloads)) for region in regions]
+            publish_steps(downloads, gribsdir, list(queues.values()), published)
+            statuses = dict(future.result() for future in futures)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_region_logging, initargs=(logpath,)) as pool:
+            futures = [pool.submit(process_region, threddspath, wrksppath, timestamp, region, model)
+                       for region in regions]
+            statuses = dict(future.result() for future in futures)
+    for region, status in statuses.items():
+        logging.info(region + ': ' + status)
+    failed = [region for region, status in statuses.items() if status != 'Finished']
+
+    if failed:
+        # the regions that finished are published, the cycle isn't marked as done so the next run retries the others
+        # (see setenvironment) from the shared gribs, which are kept so they don't have to be downloaded again
+        logging.info('\nWorkflow stopped on ' + datetime.datetime.utcnow().strftime("%D at %R") +
+                     ', these regions are retried on the next run: ' + ', '.join(failed))
+        return 'GFS Workflow Incomplete- these regions failed and are retried on the next run: ' + ', '.join(failed)
+
+    # every region has been cropped out of the shared gribs so they can be deleted
+    if GFS_UNION_DOWNLOAD:
+        shutil.rmtree(os.path.join(threddspath, 'gfs_union', timestamp), ignore_errors=True)
 
     logging.info('\nAll regions finished- writing the timestamp used on this run to a txt file')
-    with open(os.path.join(threddspath, 'gfs_timestamp.txt'), 'w') as file:
-        file.write(timestamp)
+    write_atomic(os.path.join(threddspath, 'gfs_timestamp.txt'), timestamp)
 
     logging.info('\n\nGFS Workflow completed successfully on ' + datetime.datetime.utcnow().strftime("%D at %R"))
     logging.info('If you have configured other models, they will begin processing now.\n\n\n')
-
     return 'GFS Workflow Completed- Normal Finish'
 
 
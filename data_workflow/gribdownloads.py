@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# how many forecast steps to download at once and how persistently to retry a step that fails
+DOWNLOAD_WORKERS = 6
+DOWNLOAD_RETRIES = 4
+DOWNLOAD_BACKOFF = 5  # seconds to wait after the first failed attempt, doubled after each one after that
+DOWNLOAD_TIMEOUT = (15, 180)  # seconds to (connect, read) before giving up on an attempt
+CHUNK_SIZE = 1024 * 1024
+MANIFEST_NAME = 'manifest.json'
+
+
+def new_session(workers=DOWNLOAD_WORKERS):
+    """
+    Creates a requests session whose connection pool is large enough for every download worker to reuse a connection
+    Dependencies: requests
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def is_valid_grib(filepath):
+    """
+    A fast check that a file is a complete grib: it must start with the GRIB indicator and end with the 7777 trailer
+    Dependencies: os
+    """
+    try:
+        if os.path.getsize(filepath) < 8:
+            return False
+        with open(filepath, 'rb') as f:
+            head = f.read(4)
+            f.seek(-4, os.SEEK_END)
+            tail = f.read(4)
+    except OSError:
+        return False
+    return head == b'GRIB' and tail == b'7777'
+
+
+def download_file(session, url, filepath, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF, validator=None):
+    """
+    Downloads a single file, retrying with an exponential backoff. The data are written to a .part file and renamed
+    when complete so a partial download never looks like a finished one. If a validator function is given, a file it
+    rejects is treated like a failed attempt.
+    Dependencies: logging, os, time, requests
+    """
+    filename = os.path.basename(filepath)
+    partpath = filepath + '.part'
+    for attempt in range(1, retries + 1):
+        logging.info('downloading the file ' + filename + ' (attempt ' + str(attempt) + ' of ' + str(retries) + ')')
+        try:
+            with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                r.raise_for_status()
+                with open(partpath, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        if chunk:  # filter out keep-alive new chunks
+                            f.write(chunk)
+            if validator is None or validator(partpath):
+                os.replace(partpath, filepath)
+                return True
+            logging.info('\nThe file ' + filename + ' downloaded from\n' + url + '\nis incomplete or corrupt')
+        except requests.HTTPError as e:
+            errorcode = e.response.status_code
+            logging.info('\nHTTPError ' + str(errorcode) + ' downloading ' + filename + ' from\n' + url)
+            if errorcode == 404:
+                logging.info('The file was not found on the server, it may not have been published yet')
+            elif errorcode == 500:
+                logging.info('Probably a problem with the URL. Check the log and try the link')
+        except requests.RequestException as e:
+            logging.info('\nConnection problem downloading ' + filename + ': ' + str(e))
+
+        if os.path.exists(partpath):
+            os.remove(partpath)
+        if attempt < retries:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+    logging.info('Giving up on ' + filename + ' after ' + str(retries) + ' attempts')
+    return False
+
+
+def iter_downloads(downloads, workers=DOWNLOAD_WORKERS, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF,
+                   validator=None):
+    """
+    Downloads a list of (url, filepath) pairs with a bounded pool of workers sharing one pooled session. Each file is
+    retried on its own so one slow or failing step doesn't affect the others.
+    Yields (url, filepath, succeeded) for each file in the order they finish.
+    Dependencies: concurrent.futures, requests
+    """
+    if not downloads:
+        return
+
+    with new_session(workers) as session:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(download_file, session, url, filepath, retries, backoff, validator): (url, filepath)
+                for url, filepath in downloads
+            }
+            for future in as_completed(futures):
+                url, filepath = futures[future]
+                yield url, filepath, future.result()
+
+
+def read_manifest(directory):
+    """
+    Reads the download manifest of a directory, a dictionary of {filename: {'url', 'size', 'valid'}}
+    Dependencies: json, os
+    """
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        logging.info('The download manifest ' + path + ' is unreadable, starting a new one')
+        return {}
+
+
+def write_manifest(directory, manifest):
+    """
+    Replaces the download manifest of a directory without ever leaving a half written file behind
+    Dependencies: json, os
+    """
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + '.part', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.part', path)
+
+
+def is_complete(filepath, url, entry):
+    """
+    Checks a file against its manifest entry: same url, same size and still a valid grib
+    Dependencies: os
+    """
+    if not entry or entry.get('url') != url or not os.path.exists(filepath):
+        return False
+    return os.path.getsize(filepath) == entry.get('size') and is_valid_grib(filepath)
+
+
+def iter_gribs(downloads, directory, workers=DOWNLOAD_WORKERS, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF):
+    """
+    Resumable download of a list of (url, filepath) grib files that all belong in one directory. A manifest in that
+    directory records the url, size and validity of every step as it finishes so a rerun only fetches the steps that
+    are missing or corrupt.
+    Yields (url, filepath, succeeded) for every file, first the ones a previous attempt already finished and then the
+    others as they finish downloading, so each step can be processed as soon as it is available.
+    Dependencies: logging, os, json
+    """
+    manifest = read_manifest(directory)
+    missing = []
+    for url, filepath in downloads:
+        if is_complete(filepath, url, manifest.get(os.path.basename(filepath))):
+            yield url, filepath, True
+            continue
+        manifest.pop(os.path.basename(filepath), None)
+        missing.append((url, filepath))
+
+    if len(missing) < len(downloads):
+        logging.info(str(len(downloads) - len(missing)) + ' forecast steps were already downloaded, fetching the '
+                     'other ' + str(len(missing)))
+
+    failed = 0
+    for url, filepath, succeeded in iter_downloads(missing, workers, retries, backoff, validator=is_valid_grib):
+        if succeeded:
+            manifest[os.path.basename(filepath)] = {'url': url, 'size': os.path.getsize(filepath), 'valid': True}
+            write_manifest(directory, manifest)
+        else:
+            failed += 1
+        yield url, filepath, succeeded
+
+    logging.info('Downloaded ' + str(len(missing) - failed) + ' of ' + str(len(missing)) + ' missing files')
+
+
+def download_gribs(downloads, directory, workers=DOWNLOAD_WORKERS, retries=DOWNLOAD_RETRIES,
+                   backoff=DOWNLOAD_BACKOFF):
+    """
+    Downloads every grib (see iter_gribs) before returning
+    Returns the list of (url, filepath) pairs that could not be downloaded.
+    """
+    return [(url, filepath) for url, filepath, succeeded in iter_gribs(downloads, directory, workers, retries, backoff)
+            if not succeeded]
@@ -0,0 +1,102 @@
+import datetime
+import logging
+import os
+import sqlite3
+
+import numpy
+
+# how many days of forecast cycles the history keeps, older cycles are deleted when a new one is added
+HISTORY_RETENTION_DAYS = 30
+# the statistics are stored as integer tenths of a millimeter, the precision the results are rounded to
+HISTORY_SCALE = 10
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cycles (
+    model TEXT NOT NULL,
+    cycle INTEGER NOT NULL,
+    basins INTEGER NOT NULL,
+    leads INTEGER NOT NULL,
+    written TEXT NOT NULL,
+    PRIMARY KEY (model, cycle)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stats (
+    model TEXT NOT NULL,
+    cat_id INTEGER NOT NULL,
+    cycle INTEGER NOT NULL,
+    lead INTEGER NOT NULL,
+    mean INTEGER,
+    max INTEGER,
+    cum_mean INTEGER,
+    PRIMARY KEY (model, cat_id, cycle, lead)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS stats_cycle ON stats (model, cycle);
+'''
+
+
+def history_path(wrksppath, region):
+    """
+    The sqlite database holding the per basin statistics of every model's recent forecast cycles in a region. The
+    stats table's primary key (model, cat_id, cycle, lead) keeps each basin's rows together, so the history of a basin
+    is one range read of the index, and the stats_cycle index finds a cycle's rows when it is replaced or expires.
+    """
+    return os.path.join(wrksppath, region, 'history.sqlite')
+
+
+def connect(path):
+    """
+    Opens (and creates if needed) a history database. WAL mode lets the app read while the workflow writes.
+    Dependencies: sqlite3
+    """
+    connection = sqlite3.connect(path, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def scaled(values):
+    """
+    The values as integer tenths, None for missing values
+    """
+    values = numpy.round(numpy.asarray(values, dtype=numpy.float64) * HISTORY_SCALE)
+    return [None if value != value else int(value) for value in values.tolist()]
+
+
+def archive_cycle(wrksppath, region, model, timestamp, stats_df, retention_days=HISTORY_RETENTION_DAYS):
+    """
+    Adds a forecast cycle's results (the dataframe write_results makes: cat_id, lead, mean, max, cum_mean) to the
+    region's history, replacing the cycle if it was already there, and deletes the model's cycles more than
+    retention_days older than the newest one.
+    Dependencies: datetime, logging, os, sqlite3, numpy
+    """
+    path = history_path(wrksppath, region)
+    cycle = int(timestamp)
+    rows = zip(
+        [model] * len(stats_df),
+        stats_df['cat_id'].astype('int64').tolist(),
+        [cycle] * len(stats_df),
+        stats_df['lead'].astype('int64').tolist(),
+        scaled(stats_df['mean']),
+        scaled(stats_df['max']),
+        scaled(stats_df['cum_mean']),
+    )
+    logging.info('adding ' + str(len(stats_df)) + ' rows of results to the history ' + path)
+
+    connection = connect(path)
+    try:
+        with connection:
+            connection.execute('DELETE FROM stats WHERE model = ? AND cycle = ?', (model, cycle))
+            connection.executemany('INSERT INTO stats VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            connection.execute('INSERT OR REPLACE INTO cycles VALUES (?, ?, ?, ?, ?)', (
+                model, cycle, int(stats_df['cat_id'].nunique()), int(stats_df['lead'].nunique()),
+                datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
+
+            newest = connection.execute('SELECT MAX(cycle) FROM cycles WHERE model = ?', (model,)).fetchone()[0]
+            cutoff = datetime.datetime.strptime(str(newest), '%Y%m%d%H') - datetime.timedelta(days=retention_days)
+            cutoff = int(cutoff.strftime('%Y%m%d%H'))
+            expired = connection.execute('DELETE FROM cycles WHERE model = ? AND cycle < ?', (model, cutoff)).rowcount
+            if expired:
+                logging.info('deleting ' + str(expired) + ' ' + model + ' cycles older than ' + str(cutoff))
+                connection.execute('DELETE FROM stats WHERE model = ? AND cycle < ?', (model, cutoff))
+    finally:
+        connection.close()
+    return path
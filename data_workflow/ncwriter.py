@@ -0,0 +1,109 @@
+import datetime
+import logging
+import os
+
+import netCDF4
+import xarray
+
+
+def grib_metadata(path, window=None):
+    """
+    Reads the coordinates and attributes the netcdfs of a forecast need from one of its gribs, optionally cropped to a
+    rasterio window. The result is reused for every step so the gribs don't each have to be opened with cfgrib.
+    Dependencies: xarray, cfgrib
+    """
+    obj = xarray.open_dataset(path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'surface'}})
+    if window is not None:
+        obj = obj.isel(latitude=slice(window.row_off, window.row_off + window.height),
+                       longitude=slice(window.col_off, window.col_off + window.width))
+    metadata = {
+        'attrs': dict(obj.attrs),
+        'lat': obj['latitude'].values,
+        'lat_attrs': dict(obj['latitude'].attrs),
+        'lon': obj['longitude'].values,
+        'lon_attrs': dict(obj['longitude'].attrs),
+        'tp_attrs': dict(obj['tp'].attrs),
+    }
+    obj.close()
+    return metadata
+
+
+def lead_hours(timestamp, timestep):
+    """
+    The number of hours between the forecast timestamp and one of its timesteps, both YYYYMMDDHH strings
+    Dependencies: datetime
+    """
+    lead = datetime.datetime.strptime(timestep, "%Y%m%d%H") - datetime.datetime.strptime(timestamp, "%Y%m%d%H")
+    return lead // datetime.timedelta(hours=1)
+
+
+def cube_name(model, timestamp):
+    """
+    The name of the netcdf holding every step of a forecast when they are aggregated, kept in the timestamp's folder
+    """
+    return model + '_' + timestamp + '.nc'
+
+
+def write_netcdf(path, array, metadata, timestamp, lead):
+    """
+    Writes one forecast step's precipitation raster straight to a THREDDS ready netcdf, see write_cube.
+    lead is the number of hours between the forecast timestamp and this step.
+    """
+    write_cube(path, array.reshape((1,) + array.shape), [lead], metadata, timestamp)
+
+
+def write_cube(path, cube, leads, metadata, timestamp, chunksizes=None):
+    """
+    Writes a (time, lat, lon) cube of precipitation rasters to a THREDDS ready, CF style netcdf: lat, lon and time
+    coordinates and a (time, lat, lon) tp variable with each variable's begin_date set to the forecast timestamp.
+    leads are the hours between the forecast timestamp and each step. chunksizes is the (time, lat, lon) size of the
+    compressed chunks tp is stored in, or None to store it contiguously.
+    Dependencies: datetime, netCDF4
+    """
+    date = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
+    date = datetime.datetime.strftime(date, "%Y-%m-%d %H:00:00")
+
+    with netCDF4.Dataset(path, 'w', clobber=True, format='NETCDF4') as new_nc:
+        # set the global netcdf attributes - important for georeferencing
+        new_nc.setncatts(metadata['attrs'])
+        new_nc.createDimension('time', len(leads))
+        new_nc.createDimension('lat', len(metadata['lat']))
+        new_nc.createDimension('lon', len(metadata['lon']))
+
+        # the coordinates, with the grib's attributes (except fill value, you just can't copy it)
+        for name, axis in (('lat', 'Y'), ('lon', 'X')):
+            variable = new_nc.createVariable(varname=name, datatype='f4', dimensions=(name,))
+            variable[:] = metadata[name]
+            variable.setncatts({key: value for key, value in metadata[name + '_attrs'].items() if key != '_FillValue'})
+            variable.axis = axis
+
+        time = new_nc.createVariable(varname='time', datatype='f4', dimensions=('time',))
+        time[:] = leads
+        time.long_name = 'time'
+        time.standard_name = 'time'
+        time.units = 'hours since ' + date
+        time.axis = 'T'
+        time.begin_date = timestamp
+
+        if chunksizes is None:
+            tp = new_nc.createVariable(varname='tp', datatype='f4', dimensions=('time', 'lat', 'lon'))
+        else:
+            chunksizes = tuple(min(size, length) for size, length in zip(chunksizes, cube.shape))
+            tp = new_nc.createVariable(varname='tp', datatype='f4', dimensions=('time', 'lat', 'lon'), zlib=True,
+                                       complevel=4, shuffle=True, chunksizes=chunksizes)
+        tp[:] = cube
+        tp.long_name = metadata['tp_attrs'].get('long_name', 'Total Precipitation')
+        tp.units = metadata['tp_attrs'].get('units', 'kg m**-2')
+        tp.begin_date = timestamp
+
+
+def write_forecast_cube(threddspath, timestamp, region, model, timesteps, cube, metadata, chunksizes=None):
+    """
+    Writes every step of a forecast to the one netcdf the ncml points to when a workflow's AGGREGATE_OUTPUT is set,
+    <thredds>/<region>/<model>/<timestamp>/<cube_name>. See write_cube for chunksizes.
+    Dependencies: logging, os, netCDF4
+    """
+    path = os.path.join(threddspath, region, model, timestamp, cube_name(model, timestamp))
+    logging.info('writing the ' + str(len(timesteps)) + ' forecast steps to ' + path)
+    leads = [lead_hours(timestamp, timestep) for timestep in timesteps]
+    write_cube(path, cube, leads, metadata, timestamp, chunksizes)
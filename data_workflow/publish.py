@@ -0,0 +1,95 @@
+import logging
+import os
+import shutil
+
+# how many runs are kept when a new one is published: the new run and the one it replaced, which THREDDS or the app
+# may still be reading from if they opened it just before the swap
+KEEP_RUNS = 2
+# the symlink in a model's thredds folder that points to the folder of the published run
+CURRENT_LINK = 'current'
+
+# each run of a model in a region is built in <thredds>/<region>/<model>/<timestamp>, everything THREDDS and the app
+# read from a run is in that folder:
+#   wms.ncml, processed/ (or the aggregated netcdf) and cogs/ for THREDDS
+#   results.parquet, colorscales.csv, charts/, cube.npy and cube.json for the app
+# and it is published by pointing <thredds>/<region>/<model>/current at it in one rename, see publish_run
+
+
+def run_dir(threddspath, region, model, timestamp):
+    """
+    The folder a run of a model in a region is built in and served from once it is published
+    """
+    return os.path.join(threddspath, region, model, timestamp)
+
+
+def write_atomic(path, text):
+    """
+    Writes a text file to path + '.part' and renames it over path, so readers see the old file or the new one but
+    never a partly written one
+    Dependencies: os
+    """
+    with open(path + '.part', 'w') as file:
+        file.write(text)
+    os.replace(path + '.part', path)
+
+
+def publish_run(threddspath, region, model, timestamp):
+    """
+    Publishes a run whose folder is complete by pointing the model's current symlink at it. The new link is made next
+    to the old one and renamed over it so THREDDS and the app see either the whole previous run or the whole new one.
+    Dependencies: logging, os
+    """
+    path = os.path.join(threddspath, region, model)
+    link = os.path.join(path, CURRENT_LINK + '.link')
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(timestamp, link)
+    os.replace(link, os.path.join(path, CURRENT_LINK))
+    logging.info('published the ' + model + ' run ' + timestamp + ' for ' + region)
+
+
+def published_run(threddspath, region, model):
+    """
+    The timestamp of the published run of a model in a region, or None
+    Dependencies: os
+    """
+    try:
+        return os.readlink(os.path.join(threddspath, region, model, CURRENT_LINK))
+    except OSError:
+        return None
+
+
+def expired_runs(path, timestamp, keep=KEEP_RUNS):
+    """
+    The files and folders in a model's thredds folder that cleanup can delete once the run of timestamp is published:
+    anything that isn't the current link, the run's folder, the folders of the keep - 1 runs before it or the folders
+    of newer runs (when an older cycle is rerun)
+    Dependencies: os
+    """
+    files = os.listdir(path)
+    runs = [file for file in files if file.isdigit() and len(file) == 10]
+    older = sorted(file for file in runs if file < timestamp)
+    kept = {CURRENT_LINK, timestamp}
+    kept.update(older[max(len(older) - keep + 1, 0):])
+    kept.update(file for file in runs if file > timestamp)
+    return [file for file in files if file not in kept]
+
+
+def cleanup(threddspath, timestamp, region, model):
+    """
+    Deletes the gribs of a published run and the runs and files that are no longer needed, see expired_runs
+    Dependencies: logging, os, shutil
+    """
+    logging.info('Getting rid of old ' + model + ' data folders')
+    path = os.path.join(threddspath, region, model)
+    # the gribs are kept until the statistics have been saved in case the workflow is interrupted
+    gribs = os.path.join(path, timestamp, 'gribs')
+    if os.path.exists(gribs):
+        shutil.rmtree(gribs)
+    for file in expired_runs(path, timestamp):
+        file = os.path.join(path, file)
+        if os.path.isdir(file) and not os.path.islink(file):
+            shutil.rmtree(file)
+        else:
+            os.remove(file)
+    logging.info('Done')
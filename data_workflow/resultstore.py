@@ -0,0 +1,145 @@
+import calendar
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+
+import numpy
+import pandas as pd
+
+from history import archive_cycle
+
+# rows are sorted by cat_id and written in groups so readers can skip every group that can't hold the basin they want
+BASINS_PER_ROW_GROUP = 64
+# the threshold columns of ffgs_thresholds.csv, <duration in hours>FFG<issue time YYYYMMDDHH>
+THRESHOLD_COLUMN = re.compile(r'^(\d\d)FFG(\d{10})$')
+
+
+def write_results(rundir, wrksppath, region, model, timestamp, cat_ids, timesteps, mean, maximum, count):
+    """
+    Writes the zonal statistics of a forecast cycle and everything aggregated from them in one pass to the run's folder
+    (see publish.py): results.parquet (including each basin's cumulative series), colorscales.csv and the charts, and
+    adds the cycle to the region's history. mean and maximum are
+    (timesteps, basins) arrays, count has one value per basin. The timesteps are stored as integer hours after the
+    forecast timestamp.
+    Dependencies: datetime, os, numpy, pandas, pyarrow, history
+    """
+    start = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
+    leads = [(datetime.datetime.strptime(step, "%Y%m%d%H") - start) // datetime.timedelta(hours=1)
+             for step in timesteps]
+    cat_ids = numpy.asarray(cat_ids, dtype=numpy.int64)
+
+    # every aggregate is computed on the rounded values so they agree with the values shown in the charts
+    mean = numpy.round(numpy.asarray(mean, dtype=numpy.float64), 1)
+    maximum = numpy.round(numpy.asarray(maximum, dtype=numpy.float64), 1)
+    cum_mean = numpy.round(numpy.nancumsum(mean, axis=0), 1)
+
+    # sort by basin first so each basin's rows are together in the file
+    stats_df = pd.DataFrame({
+        'cat_id': numpy.repeat(cat_ids, len(leads)),
+        'lead': numpy.tile(numpy.asarray(leads, dtype=numpy.int16), len(cat_ids)),
+        'mean': mean.T.ravel().astype(numpy.float32),
+        'max': maximum.T.ravel().astype(numpy.float32),
+        'cum_mean': cum_mean.T.ravel().astype(numpy.float32),
+        'count': numpy.repeat(numpy.asarray(count, dtype=numpy.int32), len(leads)),
+    }).sort_values(['cat_id', 'lead'], kind='mergesort')
+
+    # the run isn't published until everything is written so the files are written in place
+    path = os.path.join(rundir, 'results.parquet')
+    logging.info('writing ' + str(len(stats_df)) + ' rows of results to ' + path)
+    stats_df.to_parquet(path, engine='pyarrow', index=False, row_group_size=BASINS_PER_ROW_GROUP * max(len(leads), 1))
+    archive_cycle(wrksppath, region, model, timestamp, stats_df)
+
+    # the values used to color each basin on the map: total precipitation, largest mean and largest max of any step
+    colorscales = os.path.join(rundir, 'colorscales.csv')
+    logging.info('writing the color scales to ' + colorscales)
+    pd.DataFrame({
+        'cat_id': cat_ids,
+        'cum_mean': cum_mean[-1],
+        'mean': numpy.fmax.reduce(mean, axis=0),
+        'max': numpy.fmax.reduce(maximum, axis=0),
+    }).to_csv(colorscales, mode='w', index=False)
+
+    write_charts(rundir, wrksppath, region, timestamp, cat_ids, leads, mean, cum_mean)
+    return path
+
+
+def write_pixel_cube(rundir, timestamp, timesteps, cube, transform):
+    """
+    Saves the run's (time, lat, lon) cube as cube.npy, which the app memory maps to read the series of any cell, with
+    cube.json holding the times (milliseconds since the epoch) and the affine transform (a, b, c, d, e, f) of the grid.
+    Dependencies: calendar, datetime, json, os, numpy
+    """
+    cube_path = os.path.join(rundir, 'cube.npy')
+    logging.info('saving the precipitation cube to ' + cube_path)
+    times = []
+    for step in timesteps:
+        step = datetime.datetime.strptime(step, "%Y%m%d%H")
+        times.append(calendar.timegm(step.utctimetuple()) * 1000)
+    with open(cube_path, 'wb') as f:
+        numpy.save(f, numpy.ascontiguousarray(cube, dtype=numpy.float32))
+    with open(os.path.join(rundir, 'cube.json'), 'w') as f:
+        json.dump({'timestamp': timestamp, 'times': times, 'transform': list(transform)[:6]}, f)
+
+
+def read_thresholds(wrksppath, region, duration=1):
+    """
+    The flash flood threshold of each basin as a pandas Series indexed by BASIN. The csv's threshold columns are named
+    <duration>FFG<issue time>, e.g. 01FFG2018021312, the most recently issued column of the duration is used.
+    Dependencies: os, re, pandas
+    """
+    threshold_table = os.path.join(wrksppath, region, 'ffgs_thresholds.csv')
+    columns = pd.read_csv(threshold_table, nrows=0).columns
+    issues = {}
+    for column in columns:
+        match = THRESHOLD_COLUMN.match(column)
+        if match is not None and int(match.group(1)) == duration:
+            issues[match.group(2)] = column
+    if not issues:
+        logging.warning('there are no ' + str(duration) + ' hour thresholds in ' + threshold_table)
+        return pd.Series(dtype='float64')
+    column = issues[max(issues)]
+    return pd.read_csv(threshold_table, usecols=['BASIN', column], index_col=0)[column]
+
+
+def chart_payload(times, series, threshold):
+    """
+    The json the app's getFloodChart and getCumFloodChart endpoints return for one basin's series
+    Dependencies: json, numpy
+    """
+    values = [[time, None if numpy.isnan(value) else round(float(value), 1)] for time, value in zip(times, series)]
+    # zoom the chart to the largest value or the threshold, whichever is larger
+    maximum = max([value[1] for value in values if value[1] is not None] + [0])
+    if threshold is not None and threshold > maximum:
+        maximum = threshold
+    return json.dumps({'values': values, 'threshold': threshold, 'max': maximum}, separators=(',', ':'))
+
+
+def write_charts(rundir, wrksppath, region, timestamp, cat_ids, leads, mean, cum_mean):
+    """
+    Writes the chart data for every basin to the run's charts folder, <cat_id>_intervals.json and
+    <cat_id>_cumulative.json, so the app only has to return the file when someone clicks on a basin.
+    mean and cum_mean are (timesteps, basins) arrays.
+    Dependencies: calendar, datetime, json, logging, os, shutil, numpy, pandas
+    """
+    directory = os.path.join(rundir, 'charts')
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.mkdir(directory)
+    os.chmod(directory, 0o777)
+    logging.info('writing the chart data for ' + str(len(cat_ids)) + ' basins to ' + directory)
+
+    thresholds = read_thresholds(wrksppath, region)
+    start = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
+    start = calendar.timegm(start.utctimetuple()) * 1000
+    times = [start + int(lead) * 3600000 for lead in leads]
+
+    for index, cat_id in enumerate(cat_ids):
+        threshold = thresholds.get(cat_id)
+        threshold = None if threshold is None or numpy.isnan(threshold) else round(float(threshold), 1)
+        for charttype, series in (('intervals', mean[:, index]), ('cumulative', cum_mean[:, index])):
+            path = os.path.join(directory, str(cat_id) + '_' + charttype + '.json')
+            with open(path, 'w') as f:
+                f.write(chart_payload(times, series, threshold))
@@ -0,0 +1,160 @@
+import datetime
+import functools
+import logging
+import os
+import sys
+import time
+
+import requests
+
+import gfsworkflow
+from gribdownloads import DOWNLOAD_TIMEOUT, new_session
+
+# how many seconds to wait between checks of the server for a new forecast
+POLL_INTERVAL = 300
+# how many of the most recent cycles are checked for one that is published, a day of them
+LOOKBACK_CYCLES = 4
+CYCLE_HOURS = 6
+# where the server keeps the GFS cycles the grib filter cuts the downloads from
+GFS_PROD_PATH = '/pub/data/nccf/com/gfs/prod'
+# when a run is started before its forecast is complete (see run_scheduler), how many seconds to wait between checks
+# for the next step and how long to wait for one before giving up on the rest
+STEP_POLL_INTERVAL = 60
+STEP_TIMEOUT = 3600
+
+logger = logging.getLogger('scheduler')
+
+
+def inventory_url(base_url, timestamp, step):
+    """
+    The url of the inventory (.idx) the server publishes next to a GFS 0.25 degree grib once the grib is complete
+    """
+    return base_url + GFS_PROD_PATH + gfsworkflow.gfs_cycle_dir(timestamp) + '/' + \
+        gfsworkflow.gfs_file(timestamp, step) + '.idx'
+
+
+def recent_cycles(now=None, lookback=LOOKBACK_CYCLES):
+    """
+    The timestamps (YYYYMMDDHH) of the lookback most recent GFS cycles that have started by now, newest first
+    Dependencies: datetime
+    """
+    now = datetime.datetime.utcnow() if now is None else now
+    latest = now.replace(hour=now.hour - now.hour % CYCLE_HOURS, minute=0, second=0, microsecond=0)
+    return [(latest - datetime.timedelta(hours=CYCLE_HOURS * i)).strftime("%Y%m%d%H") for i in range(lookback)]
+
+
+def step_published(session, base_url, timestamp, step):
+    """
+    Whether a forecast step's inventory is on the server, False if the server can't be reached
+    Dependencies: requests
+    """
+    try:
+        response = session.head(inventory_url(base_url, timestamp, step), timeout=DOWNLOAD_TIMEOUT,
+                                allow_redirects=True)
+    except requests.RequestException as e:
+        logger.info('could not check ' + timestamp + ' f' + step + ': ' + str(e))
+        return False
+    return response.status_code == 200
+
+
+def published_steps(session, base_url, timestamp, done, interval=STEP_POLL_INTERVAL, timeout=STEP_TIMEOUT):
+    """
+    How many of a cycle's steps (see GFS_STEPS) have been published, waiting until there are more than done or
+    timeout seconds have passed. The server publishes the steps in order so only the steps after done are checked and
+    the check stops at the first one that is missing. This is what run_gfs_workflow's published argument expects.
+    Dependencies: time, requests
+    """
+    steps = gfsworkflow.GFS_STEPS
+    deadline = time.time() + timeout
+    while True:
+        count = done
+        while count < len(steps) and step_published(session, base_url, timestamp, steps[count]):
+            count += 1
+        if count > done or time.time() >= deadline:
+            logger.info(timestamp + ': ' + str(count) + ' of ' + str(len(steps)) + ' steps published')
+            return count
+        time.sleep(interval)
+
+
+def newest_cycle(session, base_url, step, after=None, now=None):
+    """
+    The newest of the recent cycles that a step has been published for, or None if there isn't one newer than after
+    (the last one processed). Older cycles that were missed are skipped.
+    Dependencies: datetime, requests
+    """
+    for timestamp in recent_cycles(now):
+        if after is not None and timestamp <= after:
+            break
+        if step_published(session, base_url, timestamp, step):
+            return timestamp
+    return None
+
+
+def newest_complete_cycle(session, base_url, after=None, now=None):
+    """
+    The newest of the recent cycles whose every step has been published (see newest_cycle), the last step is
+    published last so if it's there the whole cycle is
+    """
+    return newest_cycle(session, base_url, gfsworkflow.GFS_STEPS[-1], after, now)
+
+
+def last_cycle(threddspath):
+    """
+    The timestamp of the last forecast the workflow finished, from gfs_timestamp.txt, or None
+    Dependencies: os
+    """
+    try:
+        with open(os.path.join(threddspath, 'gfs_timestamp.txt')) as file:
+            timestamp = file.readline().strip()
+    except OSError:
+        return None
+    return timestamp if timestamp.isdigit() and len(timestamp) == 10 else None
+
+
+def run_scheduler(threddspath, base_url=None, interval=POLL_INTERVAL, once=False):
+    """
+    Runs the GFS workflow for each new forecast as soon as it is published instead of at fixed times. When the
+    workflow's PIPELINED and GFS_UNION_DOWNLOAD are set a run starts once the first step is on the server and each
+    step is downloaded and processed when it is published (see published_steps), otherwise once every step is.
+    The server is checked every interval seconds. When more than one cycle has been published since the last run
+    only the newest is processed. base_url replaces GFS_BASE_URL, e.g. to run against a local copy of the server.
+    once checks the server a single time, for testing or for running from cron.
+    Dependencies: datetime, functools, logging, os, time, requests, gfsworkflow, gribdownloads
+    """
+    if base_url is not None:
+        # the environment variable reaches the region processes however they are started
+        os.environ['GFS_BASE_URL'] = base_url.rstrip('/')
+        gfsworkflow.GFS_BASE_URL = base_url.rstrip('/')
+    base_url = gfsworkflow.GFS_BASE_URL
+
+    handler = logging.FileHandler(os.path.join(threddspath, 'scheduler.log'))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.info('checking ' + base_url + ' for new GFS forecasts every ' + str(interval) + ' seconds')
+
+    early = gfsworkflow.PIPELINED and gfsworkflow.GFS_UNION_DOWNLOAD
+    with new_session(1) as session:
+        while True:
+            published = None
+            if early:
+                timestamp = newest_cycle(session, base_url, gfsworkflow.GFS_STEPS[0], after=last_cycle(threddspath))
+                if timestamp is not None:
+                    published = functools.partial(published_steps, session, base_url, timestamp)
+            else:
+                timestamp = newest_complete_cycle(session, base_url, after=last_cycle(threddspath))
+            if timestamp is not None:
+                logger.info(timestamp + ' is published, running the workflow')
+                try:
+                    logger.info(gfsworkflow.run_gfs_workflow(threddspath, timestamp=timestamp, published=published))
+                except Exception:
+                    logger.exception('the workflow for ' + timestamp + ' failed')
+            if once:
+                return
+            time.sleep(interval)
+
+
+if __name__ == '__main__':
+    # python scheduler.py <thredds path> [<base url of the server to download from>]
+    run_scheduler(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
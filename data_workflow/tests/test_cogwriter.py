@@ -0,0 +1,26 @@
+import pytest
+
+numpy = pytest.importorskip('numpy')
+rasterio = pytest.importorskip('rasterio')
+from rasterio.transform import from_origin
+
+import cogwriter
+
+
+@pytest.mark.parametrize('width, height', [(29, 15), (75, 57), (700, 400)])
+def test_forecast_grids_get_overviews(width, height):
+    blocksize = cogwriter.cog_blocksize(width, height)
+    assert blocksize % 16 == 0
+    assert cogwriter.overview_factors(width, height, blocksize)
+
+
+def test_written_cog_has_internal_overviews(tmp_path):
+    # the size of the Hispaniola grid
+    array = numpy.arange(29 * 15, dtype=numpy.float32).reshape(15, 29)
+    path = str(tmp_path / 'total.tif')
+    cogwriter.write_cog(path, array, from_origin(-75, 20.5, 0.25, 0.25))
+
+    with rasterio.open(path) as src:
+        assert src.overviews(1) == [2]
+        assert src.block_shapes[0] == (16, 16)
+        numpy.testing.assert_array_equal(src.read(1), array)
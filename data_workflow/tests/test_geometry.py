@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+fiona = pytest.importorskip('fiona')
+shapely = pytest.importorskip('shapely', minversion='2.1')
+from shapely.geometry import Polygon, mapping, shape
+
+import geometry
+
+REGION = 'testregion'
+# the border the two watersheds share zigzags by less than the simplification tolerance of the low zoom levels
+BORDER = [(1 + (0.01 if i % 2 else -0.01), i * 0.02) for i in range(101)]
+WATERSHEDS = {
+    1: Polygon([(0, 0)] + BORDER + [(0, 2)]),
+    2: Polygon(list(reversed(BORDER)) + [(2, 0), (2, 2)]),
+}
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    directory = tmp_path / REGION / 'shapefiles'
+    directory.mkdir(parents=True)
+    schema = {'geometry': 'Polygon', 'properties': {'cat_id': 'int'}}
+    with fiona.open(str(directory / ('ffgs_' + REGION + '.shp')), 'w', driver='ESRI Shapefile', schema=schema,
+                    crs='EPSG:4326') as shapes:
+        for cat_id, polygon in WATERSHEDS.items():
+            shapes.write({'geometry': mapping(polygon), 'properties': {'cat_id': cat_id}})
+    return str(tmp_path)
+
+
+def test_neighbours_keep_their_shared_border(workspace):
+    assert shapely.coverage_is_valid(list(WATERSHEDS.values()))
+    paths = geometry.build_geometry(workspace, REGION)
+    for zoom, path in paths.items():
+        with open(path) as f:
+            features = json.load(f)['features']
+        first, second = (shape(feature['geometry']) for feature in features)
+        # no overlaps and no slivers between the neighbours
+        assert first.intersection(second).area < 1e-9
+        union = first.union(second)
+        assert union.geom_type == 'Polygon' and not union.interiors
+        assert union.area == pytest.approx(4, rel=1e-3)
+    # the zigzag is simplified away at the lowest zoom
+    with open(paths[4]) as f:
+        assert len(json.load(f)['features'][0]['geometry']['coordinates'][0]) < len(BORDER)
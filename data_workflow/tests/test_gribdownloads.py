@@ -0,0 +1,117 @@
+import functools
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+pytest.importorskip('requests')
+
+import gribdownloads
+
+GRIB = b'GRIB' + b'\0' * 16 + b'7777'
+# what a previous attempt left behind, different from the server's copy so a new download can be told apart
+OLD_GRIB = b'GRIB' + b'\1' * 16 + b'7777'
+
+
+class CountingHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves the files of a directory and records the path of every request in the server's requested list
+    """
+    def do_GET(self):
+        self.server.requested.append(self.path)
+        return super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    served = tmp_path / 'server'
+    served.mkdir()
+    for name in ('006.grb', '012.grb', '018.grb'):
+        (served / name).write_bytes(GRIB)
+    handler = functools.partial(CountingHandler, directory=str(served))
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    httpd.requested = []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:' + str(httpd.server_address[1]), httpd.requested
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def gribsdir(tmp_path):
+    directory = tmp_path / 'gribs'
+    directory.mkdir()
+    return str(directory)
+
+
+def downloads(base_url, gribsdir, names=('006.grb', '012.grb', '018.grb')):
+    return [(base_url + '/' + name, os.path.join(gribsdir, name)) for name in names]
+
+
+def write_previous(gribsdir, name, data, url, size=None):
+    """
+    Leaves a file and its manifest entry the way an earlier attempt would have
+    """
+    with open(os.path.join(gribsdir, name), 'wb') as f:
+        f.write(data)
+    manifest = gribdownloads.read_manifest(gribsdir)
+    manifest[name] = {'url': url, 'size': len(data) if size is None else size, 'valid': True}
+    gribdownloads.write_manifest(gribsdir, manifest)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_corrupt_files_are_downloaded_again(server, gribsdir):
+    base_url, requested = server
+    steps = downloads(base_url, gribsdir)
+    # a complete step, one cut off before the 7777 trailer and one that isn't a grib at all
+    write_previous(gribsdir, '006.grb', OLD_GRIB, steps[0][0])
+    write_previous(gribsdir, '012.grb', OLD_GRIB[:-4], steps[1][0])
+    write_previous(gribsdir, '018.grb', b'<html>error</html>', steps[2][0])
+
+    assert gribdownloads.download_gribs(steps, gribsdir, retries=1, backoff=0) == []
+    assert sorted(requested) == ['/012.grb', '/018.grb']
+    assert read(steps[0][1]) == OLD_GRIB
+    assert read(steps[1][1]) == GRIB
+    assert read(steps[2][1]) == GRIB
+
+
+def test_manifest_mismatches_are_downloaded_again(server, gribsdir):
+    base_url, requested = server
+    steps = downloads(base_url, gribsdir)
+    write_previous(gribsdir, '006.grb', OLD_GRIB, steps[0][0])
+    # a valid grib whose size isn't the one recorded, and one downloaded from a different url (another subregion)
+    write_previous(gribsdir, '012.grb', OLD_GRIB, steps[1][0], size=len(OLD_GRIB) + 1)
+    write_previous(gribsdir, '018.grb', OLD_GRIB, steps[2][0] + '?leftlon=0')
+
+    assert gribdownloads.download_gribs(steps, gribsdir, retries=1, backoff=0) == []
+    assert sorted(requested) == ['/012.grb', '/018.grb']
+    assert [read(filepath) for _, filepath in steps] == [OLD_GRIB, GRIB, GRIB]
+    with open(os.path.join(gribsdir, gribdownloads.MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    assert manifest['018.grb'] == {'url': steps[2][0], 'size': len(GRIB), 'valid': True}
+
+
+def test_a_missing_step_fails_on_its_own(server, gribsdir):
+    base_url, requested = server
+    steps = downloads(base_url, gribsdir, ('006.grb', '024.grb', '012.grb'))
+
+    results = {os.path.basename(filepath): succeeded
+               for _, filepath, succeeded in gribdownloads.iter_gribs(steps, gribsdir, retries=2, backoff=0)}
+    assert results == {'006.grb': True, '024.grb': False, '012.grb': True}
+    # the missing step was retried and left nothing behind, the others were downloaded once
+    assert sorted(requested) == ['/006.grb', '/012.grb', '/024.grb', '/024.grb']
+    assert sorted(os.listdir(gribsdir)) == ['006.grb', '012.grb', gribdownloads.MANIFEST_NAME]
+
+    # a rerun only asks for the missing step again
+    del requested[:]
+    assert gribdownloads.download_gribs(steps, gribsdir, retries=1, backoff=0) == [steps[1]]
+    assert requested == ['/024.grb']
@@ -0,0 +1,53 @@
+import os
+
+import publish
+
+REGION = 'hispaniola'
+MODEL = 'gfs'
+
+
+def make_run(threddspath, timestamp):
+    rundir = publish.run_dir(str(threddspath), REGION, MODEL, timestamp)
+    os.makedirs(os.path.join(rundir, 'gribs'))
+    with open(os.path.join(rundir, 'wms.ncml'), 'w') as file:
+        file.write(timestamp)
+    return rundir
+
+
+def test_publish_swaps_the_current_link(tmp_path):
+    make_run(tmp_path, '2020010100')
+    make_run(tmp_path, '2020010106')
+    assert publish.published_run(str(tmp_path), REGION, MODEL) is None
+
+    publish.publish_run(str(tmp_path), REGION, MODEL, '2020010100')
+    assert publish.published_run(str(tmp_path), REGION, MODEL) == '2020010100'
+    publish.publish_run(str(tmp_path), REGION, MODEL, '2020010106')
+    assert publish.published_run(str(tmp_path), REGION, MODEL) == '2020010106'
+
+    # the ncml is read through the link
+    with open(os.path.join(str(tmp_path), REGION, MODEL, publish.CURRENT_LINK, 'wms.ncml')) as file:
+        assert file.read() == '2020010106'
+    assert not os.path.lexists(os.path.join(str(tmp_path), REGION, MODEL, publish.CURRENT_LINK + '.link'))
+
+
+def test_expired_runs_keeps_the_previous_and_newer_runs(tmp_path):
+    path = tmp_path / REGION / MODEL
+    for timestamp in ('2020010100', '2020010106', '2020010112', '2020010118'):
+        make_run(tmp_path, timestamp)
+    (path / 'wms.ncml').write_text('left by an older version of the workflow')
+
+    # rerunning an older cycle doesn't delete the runs made after it
+    assert sorted(publish.expired_runs(str(path), '2020010112')) == ['2020010100', 'wms.ncml']
+    assert sorted(publish.expired_runs(str(path), '2020010112', keep=1)) == ['2020010100', '2020010106', 'wms.ncml']
+
+
+def test_cleanup_deletes_expired_runs_and_gribs(tmp_path):
+    for timestamp in ('2020010100', '2020010106', '2020010112'):
+        make_run(tmp_path, timestamp)
+    publish.publish_run(str(tmp_path), REGION, MODEL, '2020010112')
+
+    publish.cleanup(str(tmp_path), '2020010112', REGION, MODEL)
+    path = tmp_path / REGION / MODEL
+    assert sorted(os.listdir(str(path))) == ['2020010106', '2020010112', publish.CURRENT_LINK]
+    assert not (path / '2020010112' / 'gribs').exists()
+    assert (path / '2020010106' / 'gribs').exists()
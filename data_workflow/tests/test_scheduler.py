@@ -0,0 +1,126 @@
+import datetime
+import functools
+import http.server
+import os
+import queue
+import threading
+import urllib.parse
+
+import pytest
+
+requests = pytest.importorskip('requests')
+for module in ('numpy', 'pandas', 'scipy', 'fiona', 'shapely', 'netCDF4', 'rasterio', 'xarray'):
+    pytest.importorskip(module)
+
+import gfsworkflow
+import scheduler
+from gribdownloads import new_session
+
+# the cycles the scheduler looks at at this time are 2020010200, 2020010118, 2020010112 and 2020010106
+NOW = datetime.datetime(2020, 1, 2, 1, 30)
+GRIB = b'GRIB' + b'\0' * 16 + b'7777'
+
+
+class StandInHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves the files of a directory laid out like the GFS server and answers the grib filter from the same files
+    """
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/cgi-bin/filter_gfs_0p25.pl':
+            return super().do_GET()
+        query = urllib.parse.parse_qs(url.query)
+        path = os.path.join(self.directory, scheduler.GFS_PROD_PATH.strip('/'), query['dir'][0].strip('/'),
+                            query['file'][0])
+        if not os.path.exists(path):
+            return self.send_error(404)
+        with open(path, 'rb') as file:
+            data = file.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    handler = functools.partial(StandInHandler, directory=str(tmp_path))
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    base_url = 'http://127.0.0.1:' + str(httpd.server_address[1])
+    monkeypatch.setattr(gfsworkflow, 'GFS_BASE_URL', base_url)
+    yield base_url
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def publish(root, timestamp, steps):
+    """
+    Puts a cycle's gribs and inventories where the server keeps them
+    """
+    directory = os.path.join(str(root), scheduler.GFS_PROD_PATH.strip('/'), gfsworkflow.gfs_cycle_dir(timestamp)[1:])
+    os.makedirs(directory, exist_ok=True)
+    for step in steps:
+        with open(os.path.join(directory, gfsworkflow.gfs_file(timestamp, step)), 'wb') as file:
+            file.write(GRIB)
+        with open(os.path.join(directory, gfsworkflow.gfs_file(timestamp, step) + '.idx'), 'w') as file:
+            file.write('1:0:d=' + timestamp + ':APCP:surface:\n')
+
+
+def test_inventories_and_downloads_use_the_same_layout(server, tmp_path):
+    publish(tmp_path, '2020010118', gfsworkflow.GFS_STEPS[:1])
+    with new_session(1) as session:
+        assert scheduler.step_published(session, server, '2020010118', gfsworkflow.GFS_STEPS[0])
+        url, _ = gfsworkflow.gfs_downloads('2020010118', gfsworkflow.GFS_SUBREGIONS['hispaniola'], str(tmp_path))[0]
+        response = session.get(url)
+    assert response.status_code == 200
+    assert response.content == GRIB
+
+
+def test_newest_complete_cycle_skips_ahead(server, tmp_path):
+    publish(tmp_path, '2020010112', gfsworkflow.GFS_STEPS)
+    publish(tmp_path, '2020010118', gfsworkflow.GFS_STEPS)
+    publish(tmp_path, '2020010200', gfsworkflow.GFS_STEPS[:3])
+    with new_session(1) as session:
+        assert scheduler.newest_complete_cycle(session, server, now=NOW) == '2020010118'
+        # the cycle after the last one processed is skipped when a newer one is complete
+        assert scheduler.newest_complete_cycle(session, server, after='2020010106', now=NOW) == '2020010118'
+        assert scheduler.newest_cycle(session, server, gfsworkflow.GFS_STEPS[0], after='2020010118',
+                                      now=NOW) == '2020010200'
+
+
+def test_newest_complete_cycle_stops_at_the_last_processed(server, tmp_path):
+    publish(tmp_path, '2020010112', gfsworkflow.GFS_STEPS)
+    publish(tmp_path, '2020010200', gfsworkflow.GFS_STEPS[:3])
+    with new_session(1) as session:
+        assert scheduler.newest_complete_cycle(session, server, after='2020010112', now=NOW) is None
+        assert scheduler.newest_complete_cycle(session, server, after='2020010200', now=NOW) is None
+        assert scheduler.newest_cycle(session, server, gfsworkflow.GFS_STEPS[0], after='2020010200', now=NOW) is None
+
+
+def test_steps_are_fed_as_they_are_published(server, tmp_path):
+    publish(tmp_path, '2020010200', gfsworkflow.GFS_STEPS[:3])
+    gribsdir = str(tmp_path / 'gribs')
+    os.mkdir(gribsdir)
+    downloads = gfsworkflow.gfs_downloads('2020010200', gfsworkflow.GFS_SUBREGIONS['hispaniola'], gribsdir)
+    steps = queue.Queue()
+    with new_session(1) as session:
+        assert scheduler.published_steps(session, server, '2020010200', 0, interval=0, timeout=0) == 3
+
+        def published(done):
+            return scheduler.published_steps(session, server, '2020010200', done, interval=0, timeout=0)
+
+        failed = gfsworkflow.publish_steps(downloads, gribsdir, [steps], published)
+
+    fed = []
+    while True:
+        path = steps.get_nowait()
+        if path is None:
+            break
+        fed.append(path)
+    assert sorted(fed) == [filepath for _, filepath in downloads[:3]]
+    assert failed == downloads[3:]
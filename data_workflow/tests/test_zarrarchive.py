@@ -0,0 +1,41 @@
+import pytest
+
+numpy = pytest.importorskip('numpy')
+zarr = pytest.importorskip('zarr')
+
+import zarrarchive
+
+LEADS = [6, 12]
+LATS = numpy.array([18.0, 17.75, 17.5])
+LONS = numpy.array([285.0, 285.25])
+
+
+def forecast(value):
+    return numpy.full((len(LEADS), len(LATS), len(LONS)), value, dtype=numpy.float32)
+
+
+def test_interrupted_append_is_trimmed(tmp_path):
+    path = str(tmp_path / 'gfs_archive.zarr')
+    assert zarrarchive.append_forecast(path, '2024010100', LEADS, forecast(1), LATS, LONS)
+
+    # an append that stopped after writing the data but before its cycle
+    root = zarr.open_group(path, mode='a')
+    root['tp'].append(forecast(99)[numpy.newaxis], axis=0)
+
+    assert zarrarchive.append_forecast(path, '2024010106', LEADS, forecast(2), LATS, LONS)
+    root = zarr.open_group(path, mode='r')
+    assert root['tp'].shape[0] == root['cycle'].shape[0] == 2
+
+    cycles, leads, values = zarrarchive.pixel_history(path, 17.75, -74.75)
+    assert cycles == ['2024010100', '2024010106']
+    assert leads.tolist() == LEADS
+    numpy.testing.assert_array_equal(values, [[1, 1], [2, 2]])
+
+
+def test_rerun_cycle_is_replaced(tmp_path):
+    path = str(tmp_path / 'gfs_archive.zarr')
+    zarrarchive.append_forecast(path, '2024010100', LEADS, forecast(1), LATS, LONS)
+    zarrarchive.append_forecast(path, '2024010100', LEADS, forecast(3), LATS, LONS)
+    cycles, _, values = zarrarchive.pixel_history(path, 18.0, 285.0)
+    assert cycles == ['2024010100']
+    numpy.testing.assert_array_equal(values, [[3, 3]])
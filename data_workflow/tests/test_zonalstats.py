@@ -0,0 +1,135 @@
+import os
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+fiona = pytest.importorskip('fiona')
+pytest.importorskip('scipy')
+pytest.importorskip('shapely')
+from affine import Affine
+from shapely.geometry import Polygon, mapping
+
+import zonalstats
+
+# a 6x4 grid of 1 degree cells whose top left corner is at (10, 4)
+TRANSFORM = Affine(1.0, 0.0, 10.0, 0.0, -1.0, 4.0)
+WIDTH = 6
+HEIGHT = 4
+POLYGONS = {
+    # a box that partly covers 9 cells
+    7: Polygon([(10.5, 0.5), (12.5, 0.5), (12.5, 2.75), (10.5, 2.75)]),
+    # a triangle, its edge cuts cells diagonally
+    11: Polygon([(12.2, 3.8), (15.8, 3.8), (15.8, 0.3)]),
+    # much smaller than a cell
+    13: Polygon([(11.1, 3.1), (11.3, 3.1), (11.3, 3.3), (11.1, 3.3)]),
+}
+SAMPLES = 200
+
+
+def write_shapefile(path):
+    schema = {'geometry': 'Polygon', 'properties': {'cat_id': 'int'}}
+    with fiona.open(path, 'w', driver='ESRI Shapefile', schema=schema, crs='EPSG:4326') as shapes:
+        for cat_id, polygon in POLYGONS.items():
+            shapes.write({'geometry': mapping(polygon), 'properties': {'cat_id': cat_id}})
+
+
+def inside(polygon, x, y):
+    """
+    Whether each point is in a convex polygon, from the side of each edge the points are on
+    """
+    coords = numpy.array(polygon.exterior.coords)
+    sides = []
+    for (x0, y0), (x1, y1) in zip(coords[:-1], coords[1:]):
+        sides.append((x1 - x0) * (y - y0) - (y1 - y0) * (x - x0))
+    sides = numpy.array(sides)
+    return numpy.all(sides >= 0, axis=0) | numpy.all(sides <= 0, axis=0)
+
+
+def brute_force_fractions(polygon):
+    """
+    The fraction of each cell covered by the polygon, from SAMPLES x SAMPLES points spread over each cell
+    """
+    offsets = (numpy.arange(SAMPLES) + 0.5) / SAMPLES
+    fractions = numpy.zeros((HEIGHT, WIDTH))
+    for row in range(HEIGHT):
+        for col in range(WIDTH):
+            x, y = numpy.meshgrid(col + offsets, row + offsets)
+            x, y = TRANSFORM * (x, y)
+            fractions[row, col] = inside(polygon, x, y).mean()
+    return fractions
+
+
+def brute_force_statistics(cube):
+    mean = numpy.full((cube.shape[0], len(POLYGONS)), numpy.nan)
+    maximum = numpy.full((cube.shape[0], len(POLYGONS)), numpy.nan)
+    for index, polygon in enumerate(POLYGONS.values()):
+        fractions = brute_force_fractions(polygon)
+        for step, raster in enumerate(cube):
+            weights = numpy.where(numpy.isfinite(raster), fractions, 0)
+            mean[step, index] = numpy.nansum(raster * weights) / weights.sum()
+            maximum[step, index] = numpy.nanmax(numpy.where(fractions > 0, raster, numpy.nan))
+    return mean, maximum
+
+
+@pytest.fixture
+def shapefile(tmp_path):
+    path = str(tmp_path / 'ffgs_test.shp')
+    write_shapefile(path)
+    return path
+
+
+def test_statistics_match_brute_force(shapefile):
+    random = numpy.random.RandomState(0)
+    cube = random.gamma(2.0, 3.0, size=(3, HEIGHT, WIDTH))
+    # missing cells are left out of the means and the maxes
+    cube[1, 2, 1] = numpy.nan
+
+    cat_ids, matrix = zonalstats.coverage_matrix(shapefile, TRANSFORM, WIDTH, HEIGHT)
+    mean, maximum, count = zonalstats.cube_statistics(matrix, cube)
+    expected_mean, expected_max = brute_force_statistics(cube)
+
+    assert cat_ids.tolist() == list(POLYGONS)
+    assert count.tolist() == [9, 10, 1]
+    numpy.testing.assert_allclose(mean, expected_mean, rtol=1e-2)
+    numpy.testing.assert_allclose(maximum, expected_max)
+
+
+def test_fractions_match_brute_force(shapefile):
+    _, matrix = zonalstats.coverage_matrix(shapefile, TRANSFORM, WIDTH, HEIGHT)
+    for index, polygon in enumerate(POLYGONS.values()):
+        fractions = matrix.getrow(index).toarray().reshape(HEIGHT, WIDTH)
+        numpy.testing.assert_allclose(fractions, brute_force_fractions(polygon), atol=1e-2)
+
+
+def test_cache_is_rebuilt_when_the_signature_changes(shapefile, tmp_path, monkeypatch):
+    cache = str(tmp_path / 'coverage.npz')
+    calls = []
+    compute = zonalstats.coverage_matrix
+
+    def counted(*args):
+        calls.append(args)
+        return compute(*args)
+
+    monkeypatch.setattr(zonalstats, 'coverage_matrix', counted)
+    cat_ids, matrix = zonalstats.load_coverage(cache, shapefile, TRANSFORM, WIDTH, HEIGHT)
+    assert len(calls) == 1
+
+    # the same grid and shapefile are read from the cache
+    cached_ids, cached = zonalstats.load_coverage(cache, shapefile, TRANSFORM, WIDTH, HEIGHT)
+    assert len(calls) == 1
+    assert cached_ids.tolist() == cat_ids.tolist()
+    assert (cached != matrix).nnz == 0
+
+    # a different grid
+    zonalstats.load_coverage(cache, shapefile, TRANSFORM * Affine.translation(1, 0), WIDTH, HEIGHT)
+    assert len(calls) == 2
+    zonalstats.load_coverage(cache, shapefile, TRANSFORM, WIDTH - 1, HEIGHT)
+    assert len(calls) == 3
+
+    # a newer shapefile
+    modified = os.path.getmtime(shapefile) + 60
+    os.utime(shapefile, (modified, modified))
+    zonalstats.load_coverage(cache, shapefile, TRANSFORM, WIDTH - 1, HEIGHT)
+    assert len(calls) == 4
+    zonalstats.load_coverage(cache, shapefile, TRANSFORM, WIDTH - 1, HEIGHT)
+    assert len(calls) == 4
@@ -3,19 +3,38 @@ import shutil
 import sys
 import datetime
 import os
+from concurrent.futures import ProcessPoolExecutor
 
-import netCDF4
 import numpy
-import pandas as pd
 import rasterio
-import rasterstats
-import requests
-import xarray
-from rasterio.enums import Resampling
+
+from cogwriter import write_cog
+from gribdownloads import download_gribs
+from ncwriter import cube_name, grib_metadata, lead_hours, write_forecast_cube, write_netcdf
+from publish import cleanup, publish_run, published_run, run_dir, write_atomic
+from zonalstats import zonal_statistics
+
+# write the GeoTIFFs of each forecast step to the app workspace for debugging. Otherwise the rasters decoded from the
+# gribs are passed to the zonal statistics in memory and no intermediate GeoTIFFs are written
+WRITE_GEOTIFFS = False
+# write every step of a forecast to one chunked netcdf that the ncml points to instead of one netcdf per step that
+# THREDDS has to find by scanning the processed folder. Its chunks are CUBE_CHUNKS (time, lat, lon) values, a few
+# steps of a block of cells, so reading a map of one step or the timeseries of one cell only touches a few chunks.
+AGGREGATE_OUTPUT = False
+CUBE_CHUNKS = (4, 64, 64)
+# also write each forecast step and the forecast's total as cloud optimized GeoTIFFs to <timestamp>/cogs in the thredds
+# directory for GIS users and tile servers
+WRITE_COGS = False
+# also append each forecast to a zarr archive (see zarrarchive.py, needs the zarr package) that keeps every cycle
+ARCHIVE_ZARR = False
+# how many forecast steps are converted at the same time, each in its own process
+STEP_WORKERS = 4
 
 
 def setenvironment(threddspath, wrksppath):
     """
+    Creates the folders a new run is built in. The live run's folders are left alone, it stays published until the
+    new run replaces it (see new_ncml and publish.py).
     Dependencies: os, shutil, datetime, urllib.request, app_settings (options)
     """
     logging.info('\nSetting the Environment for a WRFPR model run')
@@ -30,13 +49,19 @@ def setenvironment(threddspath, wrksppath):
         timestamp = now.strftime("%Y%m%d") + '18'
     logging.info('determined the timestamp to download: ' + timestamp)
 
-    # perform a redundancy check, if the last timestamp is the same as current, abort the workflow
     timefile = os.path.join(threddspath, 'wrfpr_timestamp.txt')
+    # the published run's folder is never removed since THREDDS and the app read from it (see publish.py), once the
+    # run is published the forecast is done even if the workflow stopped before writing the timestamp file
+    region = 'hispaniola'
+    if published_run(threddspath, region, 'wrfpr') == timestamp:
+        logging.info('The run of this timestamp is already published, aborting workflow')
+        write_atomic(timefile, timestamp)
+        return timestamp, True
+
+    # perform a redundancy check, if the last timestamp is the same as current, abort the workflow
+    # the file is only written once a run has finished (see the end of the workflow) so a failed run is retried
     if not os.path.exists(timefile):
         redundant = False
-        with open(timefile, 'w') as tf:
-            tf.write(timestamp)
-        os.chmod(timefile, 0o777)
     else:
         with open(timefile, 'r') as file:
             lasttime = file.readline()
@@ -50,36 +75,29 @@ def setenvironment(threddspath, wrksppath):
             else:
                 # if the file structure already exists, quit
                 redundant = False
-                chk_hisp = os.path.join(wrksppath, 'hispaniola', 'wrfpr_GeoTIFFs_resampled')
+                chk_hisp = os.path.join(wrksppath, 'hispaniola', 'wrfpr_GeoTIFFs')
                 if os.path.exists(chk_hisp):
                     logging.info('There are data for this timestep but the workflow wasn\'t finished. Analyzing...')
                     return timestamp, redundant
 
     # create the file structure and their permissions for the new data
-    region = 'hispaniola'
     logging.info('Creating APP WORKSPACE (GeoTIFF) file structure for ' + region)
     new_dir = os.path.join(wrksppath, region, 'wrfpr_GeoTIFFs')
     if os.path.exists(new_dir):
         shutil.rmtree(new_dir)
     os.mkdir(new_dir)
     os.chmod(new_dir, 0o777)
-    new_dir = os.path.join(wrksppath, region, 'wrfpr_GeoTIFFs_resampled')
-    if os.path.exists(new_dir):
-        shutil.rmtree(new_dir)
-    os.mkdir(new_dir)
-    os.chmod(new_dir, 0o777)
     logging.info('Creating THREDDS file structure for ' + region)
     new_dir = os.path.join(threddspath, region, 'wrfpr')
-    if os.path.exists(new_dir):
-        shutil.rmtree(new_dir)
-    os.mkdir(new_dir)
-    os.chmod(new_dir, 0o777)
+    if not os.path.exists(new_dir):
+        os.mkdir(new_dir)
+        os.chmod(new_dir, 0o777)
     new_dir = os.path.join(threddspath, region, 'wrfpr', timestamp)
     if os.path.exists(new_dir):
         shutil.rmtree(new_dir)
     os.mkdir(new_dir)
     os.chmod(new_dir, 0o777)
-    for filetype in ('gribs', 'netcdfs', 'processed'):
+    for filetype in ('gribs', 'processed'):
         new_dir = os.path.join(threddspath, region, 'wrfpr', timestamp, filetype)
         if os.path.exists(new_dir):
             shutil.rmtree(new_dir)
@@ -93,24 +111,16 @@ def setenvironment(threddspath, wrksppath):
 def download_wrfpr(threddspath, timestamp, region):
     """
     Script to download WRF-PuertoRico Grib Files.
-    Dependencies: datetime, os, requests, shutil
+    Dependencies: datetime, os, shutil, gribdownloads
     """
     logging.info('\nStarting WRF-PR Grib Downloads')
     # set filepaths
     gribsdir = os.path.join(threddspath, region, 'wrfpr', timestamp, 'gribs')
 
-    # if you already have a folder with data for this timestep, quit this function (you dont need to download it)
+    # if the gribs folder is gone the later stages already used the downloads, you dont need to download them again
     if not os.path.exists(gribsdir):
         logging.info('There is no download folder, you must have already processed them. Skipping download stage.')
         return True
-    elif len(os.listdir(gribsdir)) >= 48:
-        logging.info('There are already 48 forecast steps in here. Dont need to download them')
-        return True
-    # otherwise, remove anything in the folder before starting (in case there was a partial download)
-    else:
-        shutil.rmtree(gribsdir)
-        os.mkdir(gribsdir)
-        os.chmod(gribsdir, 0o777)
 
     # # get the parts of the timestamp to put into the url
     time = datetime.datetime.strptime(timestamp, "%Y%m%d%H").strftime("%H")
@@ -123,6 +133,7 @@ def download_wrfpr(threddspath, timestamp, region):
                 '37', '38', '39', '40', '41', '42', '43', '44', '45', '46', '47', '48']
 
     # this is where the actual downloads happen. set the url, filepath, then download
+    downloads = []
     for step in fc_steps:
         url = 'https://nomads.ncep.noaa.gov/cgi-bin/filter_hirespr.pl?file=hiresw.t' + time + 'z.arw_5km.f' + step + \
               '.pr.grib2&lev_surface=on&var_APCP=on&leftlon=0&rightlon=360&toplat=90&bottomlat=-90&dir=%2Fhiresw.' + \
@@ -133,47 +144,99 @@ def download_wrfpr(threddspath, timestamp, region):
         filename_timestep = datetime.datetime.strftime(file_timestep, "%Y%m%d%H")
 
         filename = filename_timestep + '.grb'
-        logging.info('downloading the file ' + filename)
-        filepath = os.path.join(gribsdir, filename)
-        try:
-            with requests.get(url, stream=True) as r:
-                r.raise_for_status()
-                with open(filepath, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:  # filter out keep-alive new chunks
-                            f.write(chunk)
-        except requests.HTTPError as e:
-            errorcode = e.response.status_code
-            logging.info('\nHTTPError ' + str(errorcode) + ' downloading ' + filename + ' from\n' + url)
-            if errorcode == 404:
-                logging.info('The file was not found on the server, trying an older forecast time')
-            elif errorcode == 500:
-                logging.info('Probably a problem with the URL. Check the log and try the link')
-            return False
+        downloads.append((url, os.path.join(gribsdir, filename)))
+
+    # download the steps concurrently, skipping any that a previous attempt already finished
+    failed = download_gribs(downloads, gribsdir)
+    if failed:
+        logging.info('\nCould not download ' + str(len(failed)) + ' forecast steps:')
+        for url, filepath in failed:
+            logging.info(os.path.basename(filepath) + ' from ' + url)
+        return False
     logging.info('Finished Downloads')
     return True
 
 
+def convert_step(path, past_file, geotransform, metadata, timestamp, processed, tiffs, cogs):
+    """
+    Makes the 1-hr raster of one forecast step by subtracting the previous step's accumulation (past_file, None for
+    the first step) and writes it to the THREDDS ready netcdf in the processed folder (and a GeoTIFF if WRITE_GEOTIFFS
+    is set and a cloud optimized GeoTIFF in cogs if WRITE_COGS is set). metadata is the grib_metadata shared by every
+    step.
+    Returns the raster for the zonal statistics
+    Dependencies: os, numpy, rasterio, ncwriter, cogwriter
+    """
+    i = os.path.basename(path)
+    logging.info('working on file ' + i)
+    src = rasterio.open(path)
+    file_array = src.read(1)
+    if past_file is not None:
+        past_src = rasterio.open(past_file)
+        file_array = file_array - past_src.read(1)
+
+    # write the raster straight to its final netcdf, unless every step is written to one netcdf afterwards
+    if not AGGREGATE_OUTPUT:
+        ncpath = os.path.join(processed, 'processed_' + i.replace('.grb', '.nc'))
+        logging.info('saving it to the path ' + ncpath)
+        write_netcdf(ncpath, file_array, metadata, timestamp, lead_hours(timestamp, i[:10]))
+        logging.info('created a netcdf')
+
+    if WRITE_COGS:
+        write_cog(os.path.join(cogs, i.replace('.grb', '.tif')), file_array, geotransform)
+        logging.info('wrote it to a cloud optimized GeoTIFF')
+
+    if not WRITE_GEOTIFFS:
+        return file_array
+
+    # Specify the GeoTIFF filepath
+    tif_filename = i.replace('grb', 'tif')
+    tif_filepath = os.path.join(tiffs, tif_filename)
+
+    # Save the 1-hr raster
+    with rasterio.open(
+            tif_filepath,
+            'w',
+            driver='GTiff',
+            height=file_array.shape[0],
+            width=file_array.shape[1],
+            count=1,
+            dtype=file_array.dtype,
+            nodata=numpy.nan,
+            crs='+proj=latlong',
+            transform=geotransform,
+    ) as dst:
+        dst.write(file_array, 1)
+    logging.info('wrote it to a GeoTIFF\n')
+    return file_array
+
+
 def wrfpr_tiffs(threddspath, wrksppath, timestamp, region):
     """
     Script to convert grib files with multiple variables to Total Accumulated Precipitation GeoTIFFs.
+    Returns the (timesteps, geotransform, cube) of the decoded rasters for the zonal statistics.
     Dependencies: datetime, os, shutil, numpy, rasterio
     """
     logging.info('\nStarting to process the WRF-PR gribs into GeoTIFFs')
     # declare the environment
     tiffs = os.path.join(wrksppath, region, 'wrfpr_GeoTIFFs')
     gribs = os.path.join(threddspath, region, 'wrfpr', timestamp, 'gribs')
-    netcdfs = os.path.join(threddspath, region, 'wrfpr', timestamp, 'netcdfs')
+    processed = os.path.join(threddspath, region, 'wrfpr', timestamp, 'processed')
+    cogs = os.path.join(threddspath, region, 'wrfpr', timestamp, 'cogs')
 
-    # if you already have wrf-pr netcdfs in the netcdfs folder, quit the function
+    # if the gribs are gone, the netcdfs in the processed folder are already done, quit the function
     if not os.path.exists(gribs):
         logging.info('There is no gribs folder, you must have already run this step. Skipping conversions')
         return
     # otherwise, remove anything in the folder before starting (in case there was a partial conversion)
     else:
-        shutil.rmtree(netcdfs)
-        os.mkdir(netcdfs)
-        os.chmod(netcdfs, 0o777)
+        shutil.rmtree(processed)
+        os.mkdir(processed)
+        os.chmod(processed, 0o777)
+        if WRITE_COGS:
+            if os.path.exists(cogs):
+                shutil.rmtree(cogs)
+            os.mkdir(cogs)
+            os.chmod(cogs, 0o777)
         shutil.rmtree(tiffs)
         os.mkdir(tiffs)
         os.chmod(tiffs, 0o777)
@@ -195,400 +258,68 @@ def wrfpr_tiffs(threddspath, wrksppath, timestamp, region):
 
     # Geotransform for each 24-hr raster (east, south, west, north, width, height)
     geotransform = rasterio.transform.from_bounds(lon_min, lat_min, lon_max, lat_max, width, height)
+    metadata = grib_metadata(path)
 
-    # Create 1-hr GeoTIFFs and NetCDFs
-    for i, j in zip(files, range(len(files))):
-        logging.info('working on file ' + i)
-        if j == 0:
-            path = os.path.join(gribs, i)
-            src = rasterio.open(path)
-            file_array = src.read(1)
-        else:
-            cum_file = os.path.join(gribs, i)
-            cum_src = rasterio.open(cum_file)
-            cum_array = cum_src.read(1)
-
-            past_file = os.path.join(gribs, files[j-1])
-            past_src = rasterio.open(past_file)
-            past_array = past_src.read(1)
-
-            file_array = cum_array - past_array
-
-        # using the last grib file for the day (path) convert it to a netcdf and set the variable to file_array
-        logging.info('opening grib file ' + path)
-        obj = xarray.open_dataset(path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'surface'}})
-        logging.info('converting it to a netcdf')
-        ncname = i.replace('.grb', '.nc')
-        logging.info('saving it to the path ' + path)
-        ncpath = os.path.join(netcdfs, ncname)
-        obj.to_netcdf(ncpath, mode='w')
-        logging.info('converted')
-        logging.info('writing the correct values to the tp array')
-        nc = netCDF4.Dataset(ncpath, 'a')
-        nc['tp'][:] = file_array
-        nc.close()
-        logging.info('created a netcdf')
-
-        # Specify the GeoTIFF filepath
-        tif_filename = i.replace('grb', 'tif')
-        tif_filepath = os.path.join(tiffs, tif_filename)
-
-        # Save the 24-hr raster
-        with rasterio.open(
-                tif_filepath,
-                'w',
-                driver='GTiff',
-                height=file_array.shape[0],
-                width=file_array.shape[1],
-                count=1,
-                dtype=file_array.dtype,
-                nodata=numpy.nan,
-                crs='+proj=latlong',
-                transform=geotransform,
-        ) as dst:
-            dst.write(file_array, 1)
-        logging.info('wrote it to a GeoTIFF\n')
-
-    # # clear the gribs folder now that we're done with this
-    shutil.rmtree(gribs)
-
-    return
-
-
-def zonal_statistics(wrksppath, timestamp, region, model):
-    """
-    Script to calculate average precip over FFGS polygon shapefile
-    Dependencies: datetime, os, pandas, rasterstats
-    """
-    logging.info('\nDoing Zonal Statistics on ' + region)
-    # Define app workspace and sub-paths
-    resampleds = os.path.join(wrksppath, region, model + '_GeoTIFFs_resampled')
-    shp_path = os.path.join(wrksppath, region, 'shapefiles', 'ffgs_' + region + '.shp')
-
-    stat_file = os.path.join(wrksppath, region, model + 'results.csv')
-
-    # check that there are resampled tiffs to do zonal statistics on
-    if not os.path.exists(resampleds):
-        logging.info('There are no resampled tiffs to do zonal statistics on. Skipping Zonal Statistics')
-        return
-
-    # List all Resampled GeoTIFFs
-    files = os.listdir(resampleds)
-    files = [tif for tif in files if tif.endswith('.tif')]
-    files.sort()
-
-    # do zonal statistics for each resampled tiff file and put it in the stats dataframe
-    stats_df = pd.DataFrame()
-    for i in range(len(files)):
-        logging.info('starting zonal statistics for ' + files[i])
-        ras_path = os.path.join(resampleds, files[i])
-        stats = rasterstats.zonal_stats(
-            shp_path,
-            ras_path,
-            stats=['count', 'max', 'mean'],
-            geojson_out=True
-            )
-
-        timestep = files[i][:10]
-
-        # for each stat that you get out, write it to the dataframe
-        logging.info('writing the statistics for this file to the dataframe')
-        for j in range(len(stats)):
-
-            temp_data = stats[j]['properties']
-            temp_data.update({'Forecast Timestamp': timestamp})
-            temp_data.update({'Timestep': timestep})
-
-            temp_df = pd.DataFrame([temp_data])
-            stats_df = stats_df.append(temp_df, ignore_index=True)
+    # Create 1-hr GeoTIFFs and NetCDFs in parallel, each step only needs its own and the previous accumulation
+    previous = [None] + [os.path.join(gribs, file) for file in files[:-1]]
+    with ProcessPoolExecutor(max_workers=STEP_WORKERS) as pool:
+        tasks = [pool.submit(convert_step, os.path.join(gribs, file), past_file, geotransform, metadata, timestamp,
+                             processed, tiffs, cogs) for file, past_file in zip(files, previous)]
+        rasters = [task.result() for task in tasks]
 
-    # write the resulting dataframe to a csv
-    logging.info('\ndone with zonal statistics, rounding values, writing to a csv file')
-    stats_df = stats_df.round({'max': 1, 'mean': 1})
-    stats_df.to_csv(stat_file, index=False)
+    timesteps = [file[:10] for file in files]
+    cube = numpy.stack(rasters)
+    if AGGREGATE_OUTPUT:
+        write_forecast_cube(threddspath, timestamp, region, 'wrfpr', timesteps, cube, metadata, CUBE_CHUNKS)
+    if WRITE_COGS:
+        write_cog(os.path.join(cogs, 'total.tif'), numpy.nansum(cube, axis=0), geotransform)
+    if ARCHIVE_ZARR:
+        # zarr is only needed when the archive is used
+        from zarrarchive import archive_forecast
+        archive_forecast(threddspath, timestamp, region, 'wrfpr', timesteps, cube, metadata)
 
-    # delete the resampled tiffs now that we dont need them
-    logging.info('deleting the resampled tiffs directory')
-    shutil.rmtree(resampleds)
+    # the gribs are only needed again if the statistics can't be computed from the GeoTIFFs, see cleanup
+    if WRITE_GEOTIFFS:
+        shutil.rmtree(gribs)
 
-    return
-
-
-def nc_georeference(threddspath, timestamp, region, model):
-    """
-    Description: Intended to make a THREDDS data server compatible netcdf file out of an incorrectly structured
-        netcdf file.
-    Author: Riley Hales, 2019
-    Dependencies: netCDF4, os, datetime
-    see github/rileyhales/datatools for more details
-    """
-    logging.info('\nProcessing the netCDF files')
-
-    # setting the environment file paths
-    netcdfs = os.path.join(threddspath, region, model, timestamp, 'netcdfs')
-    processed = os.path.join(threddspath, region, model, timestamp, 'processed')
-
-    # if you already have processed netcdfs files, skip this and quit the function
-    if not os.path.exists(netcdfs):
-        logging.info('There are no netcdfs to be converted. Skipping netcdf processing.')
-        return
-    # otherwise, remove anything in the folder before starting (in case there was a partial processing)
-    else:
-        shutil.rmtree(processed)
-        os.mkdir(processed)
-        os.chmod(processed, 0o777)
-
-    # list the files that need to be converted
-    net_files = os.listdir(netcdfs)
-    files = [file for file in net_files if file.endswith('.nc')]
-    logging.info('There are ' + str(len(files)) + ' compatible files.')
-
-    # read the first file that we'll copy data from in the next blocks of code
-    logging.info('Preparing the reference file')
-    path = os.path.join(netcdfs, net_files[0])
-    netcdf_obj = netCDF4.Dataset(path, 'r', clobber=False, diskless=True)
-
-    # get a dictionary of the dimensions and their size and rename the north/south and east/west ones
-    dimensions = {}
-    for dimension in netcdf_obj.dimensions.keys():
-        dimensions[dimension] = netcdf_obj.dimensions[dimension].size
-    dimensions['lat'] = dimensions['latitude']
-    dimensions['lon'] = dimensions['longitude']
-    dimensions['time'] = 1
-    del dimensions['latitude'], dimensions['longitude']
-
-    # get a list of the variables and remove the one's i'm going to 'manually' correct
-    variables = netcdf_obj.variables
-    del variables['valid_time'], variables['step'], variables['latitude'], variables['longitude'], variables['surface']
-    variables = variables.keys()
-
-    # min lat and lon and the interval between values (these are static values
-    netcdf_obj.close()
-
-    # this is where the files start getting copied
-    for file in files:
-        logging.info('Working on file ' + str(file))
-        openpath = os.path.join(netcdfs, file)
-        savepath = os.path.join(processed, 'processed_' + file)
-        # open the file to be copied
-        original = netCDF4.Dataset(openpath, 'r', clobber=False, diskless=True)
-        duplicate = netCDF4.Dataset(savepath, 'w', clobber=True, format='NETCDF4', diskless=False)
-        # set the global netcdf attributes - important for georeferencing
-        duplicate.setncatts(original.__dict__)
-
-        # specify dimensions from what we copied before
-        for dimension in dimensions:
-            duplicate.createDimension(dimension, dimensions[dimension])
-
-        # 'Manually' create the dimensions that need to be set carefully
-        duplicate.createVariable(varname='lat', datatype='f4', dimensions='lat')
-        duplicate.createVariable(varname='lon', datatype='f4', dimensions='lon')
-
-        # create the lat and lon values as a 1D array
-        duplicate['lat'][:] = original['latitude'][:]
-        duplicate['lon'][:] = original['longitude'][:]
-
-        # set the attributes for lat and lon (except fill value, you just can't copy it)
-        for attr in original['latitude'].__dict__:
-            if attr != "_FillValue":
-                duplicate['lat'].setncattr(attr, original['latitude'].__dict__[attr])
-        for attr in original['longitude'].__dict__:
-            if attr != "_FillValue":
-                duplicate['lon'].setncattr(attr, original['longitude'].__dict__[attr])
-
-        # copy the rest of the variables
-        hour = 6
-        for variable in variables:
-            # check to use the lat/lon dimension names
-            dimension = original[variable].dimensions
-            if 'latitude' in dimension:
-                dimension = list(dimension)
-                dimension.remove('latitude')
-                dimension.append('lat')
-                dimension = tuple(dimension)
-            if 'longitude' in dimension:
-                dimension = list(dimension)
-                dimension.remove('longitude')
-                dimension.append('lon')
-                dimension = tuple(dimension)
-            if len(dimension) == 2:
-                dimension = ('time', 'lat', 'lon')
-            if variable == 'time':
-                dimension = ('time',)
-
-            # create the variable
-            duplicate.createVariable(varname=variable, datatype='f4', dimensions=dimension)
-
-            # copy the arrays of data and set the timestamp/properties
-            date = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
-            date = datetime.datetime.strftime(date, "%Y-%m-%d %H:00:00")
-            if variable == 'time':
-                duplicate[variable][:] = [hour]
-                hour = hour + 6
-                duplicate[variable].long_name = original[variable].long_name
-                duplicate[variable].units = "hours since " + date
-                duplicate[variable].axis = "T"
-                # also set the begin date of this data
-                duplicate[variable].begin_date = timestamp
-            if variable == 'lat':
-                duplicate[variable][:] = original[variable][:]
-                duplicate[variable].axis = "Y"
-            if variable == 'lon':
-                duplicate[variable][:] = original[variable][:]
-                duplicate[variable].axis = "X"
-            else:
-                duplicate[variable][:] = original[variable][:]
-                duplicate[variable].axis = "lat lon"
-            duplicate[variable].long_name = original[variable].long_name
-            duplicate[variable].begin_date = timestamp
-            duplicate[variable].units = original[variable].units
-
-        # close the files, delete the one you just did, start again
-        original.close()
-        duplicate.sync()
-        duplicate.close()
-
-    # delete the netcdfs now that we're done with them triggering future runs to skip this step
-    shutil.rmtree(netcdfs)
-
-    logging.info('Finished File Conversions')
-    return
-
-
-def resample(wrksppath, region):
-    """
-    Script to resample rasters to 20x the original resolution in order for rasterstats to work
-    Dependencies: datetime, os, numpy, rasterio
-    """
-    logging.info('\nResampling the rasters for ' + region)
-    # Define app workspace and sub-paths
-    tiffs = os.path.join(wrksppath, region, 'wrfpr_GeoTIFFs')
-    resampleds = os.path.join(wrksppath, region, 'wrfpr_GeoTIFFs_resampled')
-
-    # Create directory for the resampled GeoTIFFs
-    if not os.path.exists(tiffs):
-        logging.info('There is no tiffs folder. You must have already resampled them. Skipping resampling')
-        return
-
-    # List all Resampled GeoTIFFs
-    files = os.listdir(tiffs)
-    files = [tif for tif in files if tif.endswith('.tif')]
-    files.sort()
-
-    # Read raster dimensions
-    path = os.path.join(tiffs, files[0])
-    raster_dim = rasterio.open(path)
-    width = raster_dim.width
-    height = raster_dim.height
-    lon_min = raster_dim.bounds.left
-    lon_max = raster_dim.bounds.right
-    lat_min = raster_dim.bounds.bottom
-    lat_max = raster_dim.bounds.top
-
-    # Geotransform for each resampled raster (east, south, west, north, width, height)
-    geotransform_res = rasterio.transform.from_bounds(lon_min, lat_min, lon_max, lat_max, width * 20, height * 20)
-
-    # Resample each GeoTIFF
-    for file in files:
-        path = os.path.join(tiffs, file)
-        logging.info(path)
-        with rasterio.open(path) as dataset:
-            data = dataset.read(
-                out_shape=(int(dataset.height * 20), int(dataset.width * 20)),
-                resampling=Resampling.nearest
-            )
-
-        # Convert new resampled array from 3D to 2D
-        data = numpy.squeeze(data, axis=0)
-
-        # Specify the filepath of the resampled raster
-        resample_filename = file.replace('.tif', '_resampled.tif')
-        resample_filepath = os.path.join(resampleds, resample_filename)
-
-        # Save the GeoTIFF
-        with rasterio.open(
-                resample_filepath,
-                'w',
-                driver='GTiff',
-                height=data.shape[0],
-                width=data.shape[1],
-                count=1,
-                dtype=data.dtype,
-                nodata=numpy.nan,
-                crs='+proj=latlong',
-                transform=geotransform_res,
-        ) as dst:
-            dst.write(data, 1)
-
-    # delete the non-resampled tiffs now that we dont need them
-    shutil.rmtree(tiffs)
-
-    return
+    return timesteps, geotransform, cube
 
 
 def new_ncml_wrfpr(threddspath, timestamp, region):
     logging.info('\nWriting a new ncml file for this date')
     # create a new ncml file by filling in the template with the right dates and writing to a file
-    ncml = os.path.join(threddspath, region, 'wrfpr', 'wms.ncml')
+    ncml = os.path.join(run_dir(threddspath, region, 'wrfpr', timestamp), 'wms.ncml')
     date = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
     date = datetime.datetime.strftime(date, "%Y-%m-%d %H:00:00")
-    with open(ncml, 'w') as file:
-        file.write(
-            '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2">\n'
-            '    <variable name="time" type="int" shape="time">\n'
-            '        <attribute name="units" value="hours since ' + date + '"/>\n'
+    # the ncml is in the run's folder with the files it points to, THREDDS serves it through the current link
+    if AGGREGATE_OUTPUT:
+        # every step is in one netcdf with its own time coordinate, nothing needs to be scanned or joined
+        write_atomic(ncml, (
+            '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2" '
+            'location="' + cube_name('wrfpr', timestamp) + '">\n'
+            '    <variable name="time">\n'
             '        <attribute name="_CoordinateAxisType" value="Time" />\n'
-            '        <values start="1" increment="1" />\n'
             '    </variable>\n'
-            '    <aggregation dimName="time" type="joinExisting" recheckEvery="1 hour">\n'
-            '        <scan location="' + timestamp + '/processed/"/>\n'
-            '    </aggregation>\n'
             '</netcdf>'
-        )
+        ))
+        logging.info('Wrote New .ncml')
+        return
+    write_atomic(ncml, (
+        '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2">\n'
+        '    <variable name="time" type="int" shape="time">\n'
+        '        <attribute name="units" value="hours since ' + date + '"/>\n'
+        '        <attribute name="_CoordinateAxisType" value="Time" />\n'
+        '        <values start="1" increment="1" />\n'
+        '    </variable>\n'
+        '    <aggregation dimName="time" type="joinExisting" recheckEvery="1 hour">\n'
+        '        <scan location="processed/"/>\n'
+        '    </aggregation>\n'
+        '</netcdf>'
+    ))
     logging.info('Wrote New .ncml')
     return
 
 
-def new_colorscales(wrksppath, region, model):
-    # set the environment
-    logging.info('\nGenerating a new color scale csv for the ' + model + ' results')
-    colorscales = os.path.join(wrksppath, region, model + 'colorscales.csv')
-    results = os.path.join(wrksppath, region, model + 'results.csv')
-    logging.info(results)
-    answers = pd.DataFrame(columns=['cat_id', 'cum_mean', 'mean', 'max'])
-
-    res_df = pd.read_csv(results, index_col=False)[['cat_id', 'mean', 'max']]
-    ids = res_df.cat_id.unique()
-    for catid in ids:
-        df = res_df.query("cat_id == @catid")
-        cum_mean = round(sum(df['mean'].values), 1)
-        mean = max(df['mean'].values)
-        maximum = max(df['max'].values)
-        answers = answers.append(
-            {'cat_id': catid, 'cum_mean': cum_mean, 'mean': mean, 'max': maximum},
-            ignore_index=True)
-
-    answers.to_csv(colorscales, mode='w', index=False)
-    logging.info('Wrote new rules to csv')
-    return
-
-
-def cleanup(threddspath, timestamp, region, model):
-    # delete anything that isn't the new folder of data (named for the timestamp) or the new wms.ncml file
-    logging.info('Getting rid of old ' + model + ' data folders')
-    path = os.path.join(threddspath, region, model)
-    files = os.listdir(path)
-    files.remove(timestamp)
-    files.remove('wms.ncml')
-    for file in files:
-        try:
-            shutil.rmtree(os.path.join(path, file))
-        except:
-            os.remove(os.path.join(path, file))
-    logging.info('Done')
-    return
-
-
 def run_wrfpr_workflow(threddspath):
     """
     The controller for running the workflow to download and process data
@@ -618,20 +349,17 @@ def run_wrfpr_workflow(threddspath):
     succeeded = download_wrfpr(threddspath, timestamp, region)
     if not succeeded:
         return 'Workflow Aborted- Downloading Errors Occurred'
-    wrfpr_tiffs(threddspath, wrksppath, timestamp, region)
-    resample(wrksppath, region)
+    forecast = wrfpr_tiffs(threddspath, wrksppath, timestamp, region)
     # the geoprocessing functions
-    zonal_statistics(wrksppath, timestamp, region, model)
-    nc_georeference(threddspath, timestamp, region, model)
-    # generate color scales and ncml aggregation files
+    zonal_statistics(threddspath, wrksppath, timestamp, region, model, forecast)
+    # generate the ncml aggregation files (the color scales are written with the zonal statistics)
     new_ncml_wrfpr(threddspath, timestamp, region)
-    new_colorscales(wrksppath, region, model)
-    # cleanup the workspace by removing old files
+    # switch THREDDS and the app to the new run in one step then remove the old runs
+    publish_run(threddspath, region, model, timestamp)
     cleanup(threddspath, timestamp, region, model)
 
     logging.info('\nAll regions and models finished- writing the timestamp used on this run to a txt file')
-    with open(os.path.join(threddspath, 'wrfpr_timestamp.txt'), 'w') as file:
-        file.write(timestamp)
+    write_atomic(os.path.join(threddspath, 'wrfpr_timestamp.txt'), timestamp)
 
     logging.info('WRF-PR Workflow completed successfully on ' + datetime.datetime.utcnow().strftime("%D at %R"))
     logging.info('If there are other model workflows to be processed, they will follow.\n\n\n')
@@ -0,0 +1,107 @@
+import datetime
+import logging
+import os
+
+import numcodecs
+import numpy
+import zarr
+
+# the archive keeps every forecast cycle of a model in a region as one (cycle, lead, lat, lon) array. Its chunks hold
+# all the leads of ARCHIVE_CYCLE_CHUNK cycles for a small block of cells so the history of a cell is a few chunk reads
+ARCHIVE_CYCLE_CHUNK = 32
+ARCHIVE_CELL_CHUNK = 16
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def archive_path(threddspath, region, model):
+    """
+    The zarr store archiving a model's forecasts for a region, it is kept outside the folders that cleanup deletes
+    """
+    return os.path.join(threddspath, region, model + '_archive.zarr')
+
+
+def cycle_hours(timestamp):
+    """
+    The forecast timestamp (YYYYMMDDHH) as hours since 1970-01-01, how the cycles are stored in the archive
+    """
+    return (datetime.datetime.strptime(timestamp, "%Y%m%d%H") - EPOCH) // datetime.timedelta(hours=1)
+
+
+def append_forecast(path, timestamp, leads, cube, lats, lons):
+    """
+    Adds a forecast's (lead, lat, lon) cube to the archive as a new cycle, creating the archive on its first use.
+    If the cycle is already in the archive (the workflow was rerun) it is overwritten. A cube whose leads or grid don't
+    match the archive's is not added.
+    Returns True if the cube was archived.
+    Dependencies: datetime, logging, numcodecs, numpy, zarr
+    """
+    root = zarr.open_group(path, mode='a')
+    if 'tp' not in root:
+        logging.info('creating the forecast archive ' + path)
+        chunks = (ARCHIVE_CYCLE_CHUNK, len(leads), ARCHIVE_CELL_CHUNK, ARCHIVE_CELL_CHUNK)
+        compressor = numcodecs.Blosc(cname='zstd', clevel=5, shuffle=numcodecs.Blosc.BITSHUFFLE)
+        root.create_dataset('tp', shape=(0, len(leads), len(lats), len(lons)), chunks=chunks, dtype='f4',
+                            compressor=compressor, fill_value=numpy.nan)
+        root.create_dataset('cycle', shape=(0,), chunks=(1024,), dtype='i8')
+        root.create_dataset('lead', data=numpy.asarray(leads, dtype='i4'))
+        root.create_dataset('lat', data=numpy.asarray(lats, dtype='f8'))
+        root.create_dataset('lon', data=numpy.asarray(lons, dtype='f8'))
+        root['tp'].attrs.update({'_ARRAY_DIMENSIONS': ['cycle', 'lead', 'lat', 'lon'], 'units': 'kg m**-2'})
+        root['cycle'].attrs.update({'_ARRAY_DIMENSIONS': ['cycle'], 'units': 'hours since 1970-01-01 00:00:00'})
+        root['lead'].attrs.update({'_ARRAY_DIMENSIONS': ['lead'], 'units': 'hours'})
+        root['lat'].attrs['_ARRAY_DIMENSIONS'] = ['lat']
+        root['lon'].attrs['_ARRAY_DIMENSIONS'] = ['lon']
+
+    # the cycle of a row is written after the row, a row without one is left from an append that was interrupted
+    if root['tp'].shape[0] != root['cycle'].shape[0]:
+        logging.info('removing ' + str(root['tp'].shape[0] - root['cycle'].shape[0]) + ' incomplete rows from ' + path)
+        root['tp'].resize((root['cycle'].shape[0],) + root['tp'].shape[1:])
+
+    if (root['tp'].shape[1:] != cube.shape or not numpy.array_equal(root['lead'][:], leads)
+            or not numpy.allclose(root['lat'][:], lats) or not numpy.allclose(root['lon'][:], lons)):
+        logging.info('the forecast ' + timestamp + ' has different steps or a different grid than ' + path +
+                     ', it was not archived')
+        return False
+
+    hours = cycle_hours(timestamp)
+    existing = numpy.where(root['cycle'][:] == hours)[0]
+    if len(existing):
+        logging.info('replacing the forecast ' + timestamp + ' in ' + path)
+        root['tp'][int(existing[0])] = cube.astype(numpy.float32)
+    else:
+        logging.info('appending the forecast ' + timestamp + ' to ' + path)
+        row = root['cycle'].shape[0]
+        root['tp'].resize((row + 1,) + root['tp'].shape[1:])
+        root['tp'][row] = cube.astype(numpy.float32)
+        # written last so the cycle is only in the archive once all its data are
+        root['cycle'].append(numpy.array([hours], dtype='i8'))
+    return True
+
+
+def archive_forecast(threddspath, timestamp, region, model, timesteps, cube, metadata):
+    """
+    Appends a forecast's (time, lat, lon) cube to the model's archive, what the workflows do when ARCHIVE_ZARR is set.
+    metadata is the grib_metadata (ncwriter) of the forecast's grid.
+    Dependencies: datetime, logging, os, numcodecs, numpy, zarr
+    """
+    leads = [cycle_hours(timestep) - cycle_hours(timestamp) for timestep in timesteps]
+    return append_forecast(archive_path(threddspath, region, model), timestamp, leads, cube, metadata['lat'],
+                           metadata['lon'])
+
+
+def pixel_history(path, lat, lon):
+    """
+    Reads every archived forecast of the cell nearest to a lat/lon, for analysis scripts (the app doesn't read the
+    archive, it doesn't depend on zarr)
+    Returns (cycles, leads, values) where cycles are YYYYMMDDHH timestamps and values is a (cycle, lead) array
+    Dependencies: datetime, numpy, zarr
+    """
+    root = zarr.open_group(path, mode='r')
+    lons = root['lon'][:]
+    # the GFS longitudes go from 0 to 360
+    if lons.max() > 180:
+        lon = lon % 360
+    row = int(numpy.abs(root['lat'][:] - lat).argmin())
+    col = int(numpy.abs(lons - lon).argmin())
+    cycles = [(EPOCH + datetime.timedelta(hours=int(hours))).strftime("%Y%m%d%H") for hours in root['cycle'][:]]
+    return cycles, root['lead'][:], root['tp'][:, :, row, col]
@@ -0,0 +1,176 @@
+import logging
+import os
+import shutil
+
+import fiona
+import numpy
+import rasterio
+import scipy.sparse
+from shapely.geometry import box, shape
+from shapely.prepared import prep
+
+from publish import run_dir
+from resultstore import write_pixel_cube, write_results
+
+
+def coverage_matrix(shp_path, transform, width, height):
+    """
+    Computes the fraction of every raster cell covered by every polygon in the shapefile as a sparse matrix with one
+    row per polygon and one column per cell (row major order). Polygons much smaller than a cell still get the cells
+    they touch instead of needing the raster to be resampled until they contain a cell center.
+    Returns (cat_ids, matrix)
+    Dependencies: fiona, numpy, scipy, shapely
+    """
+    cell_area = abs(transform.a * transform.e)
+    inverse = ~transform
+    cat_ids = []
+    rows = []
+    cols = []
+    fractions = []
+
+    with fiona.open(shp_path) as shapes:
+        for index, feature in enumerate(shapes):
+            cat_ids.append(int(feature['properties']['cat_id']))
+            geometry = shape(feature['geometry'])
+            if geometry.is_empty:
+                continue
+            if not geometry.is_valid:
+                geometry = geometry.buffer(0)
+            prepared = prep(geometry)
+
+            # the block of cells that the polygon's bounding box touches
+            minx, miny, maxx, maxy = geometry.bounds
+            col_a, row_a = inverse * (minx, maxy)
+            col_b, row_b = inverse * (maxx, miny)
+            col_min = max(int(numpy.floor(min(col_a, col_b))), 0)
+            col_max = min(int(numpy.ceil(max(col_a, col_b))), width)
+            row_min = max(int(numpy.floor(min(row_a, row_b))), 0)
+            row_max = min(int(numpy.ceil(max(row_a, row_b))), height)
+
+            for row in range(row_min, row_max):
+                for col in range(col_min, col_max):
+                    x0, y0 = transform * (col, row)
+                    x1, y1 = transform * (col + 1, row + 1)
+                    cell = box(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+                    if not prepared.intersects(cell):
+                        continue
+                    fraction = geometry.intersection(cell).area / cell_area
+                    if fraction > 0:
+                        rows.append(index)
+                        cols.append(row * width + col)
+                        fractions.append(fraction)
+
+    matrix = scipy.sparse.csr_matrix(
+        (numpy.array(fractions, dtype=numpy.float64), (numpy.array(rows), numpy.array(cols))),
+        shape=(len(cat_ids), width * height))
+    matrix.sort_indices()
+    return numpy.array(cat_ids, dtype=numpy.int64), matrix
+
+
+def load_coverage(cache_path, shp_path, transform, width, height):
+    """
+    Gets the coverage matrix for a grid and shapefile, computing it only when the cached copy was made for a different
+    grid or an older version of the shapefile.
+    Dependencies: logging, os, numpy, scipy
+    """
+    signature = numpy.array(list(transform)[:6] + [width, height, os.path.getmtime(shp_path)], dtype=numpy.float64)
+
+    if os.path.exists(cache_path):
+        cached = numpy.load(cache_path)
+        # the affine terms can pick up rounding, the grid size and the shapefile's mtime have to match exactly
+        previous = cached['signature']
+        if previous.shape == signature.shape and numpy.allclose(previous[:6], signature[:6]) and \
+                numpy.array_equal(previous[6:], signature[6:]):
+            logging.info('using the cached basin coverage matrix ' + cache_path)
+            matrix = scipy.sparse.csr_matrix(
+                (cached['data'], cached['indices'], cached['indptr']), shape=tuple(cached['shape']))
+            return cached['cat_ids'], matrix
+
+    logging.info('computing the basin coverage matrix for a ' + str(width) + 'x' + str(height) + ' grid')
+    cat_ids, matrix = coverage_matrix(shp_path, transform, width, height)
+    with open(cache_path, 'wb') as f:
+        numpy.savez(f, signature=signature, cat_ids=cat_ids, data=matrix.data, indices=matrix.indices,
+                    indptr=matrix.indptr, shape=numpy.array(matrix.shape))
+    return cat_ids, matrix
+
+
+def cube_statistics(matrix, cube):
+    """
+    Area weighted mean, max and count of cells for every polygon (rows of the coverage matrix) at every timestep of a
+    (time, lat, lon) cube of rasters on the matrix's grid. Cells that are nan are ignored.
+    Returns (mean, max, count) where mean and max are shaped (time, polygons)
+    Dependencies: numpy, scipy
+    """
+    values = cube.reshape(cube.shape[0], -1).astype(numpy.float64)
+    finite = numpy.isfinite(values)
+
+    # the weighted sums for all the timesteps are a single sparse matrix product
+    sums = matrix.dot(numpy.where(finite, values, 0).T).T
+    weights = matrix.dot(finite.T.astype(numpy.float64)).T
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.where(weights > 0, sums / weights, numpy.nan)
+
+    # the max is taken over the cells each polygon touches, those are consecutive in the matrix's column indices
+    count = numpy.diff(matrix.indptr)
+    maximum = numpy.full((values.shape[0], matrix.shape[0]), numpy.nan)
+    touched = count > 0
+    if touched.any():
+        with numpy.errstate(invalid='ignore'):
+            maximum[:, touched] = numpy.fmax.reduceat(values[:, matrix.indices], matrix.indptr[:-1][touched], axis=1)
+
+    return mean, maximum, count
+
+
+def zonal_statistics(threddspath, wrksppath, timestamp, region, model, forecast=None):
+    """
+    Script to calculate average precip over FFGS polygon shapefile using the fraction of each cell inside each polygon,
+    for any model's workflow.
+    forecast is the (timesteps, geotransform, cube) returned by the step that decoded the gribs. If it isn't given,
+    the cube is read from the GeoTIFFs in the app workspace.
+    Dependencies: logging, os, shutil, numpy, rasterio, publish, resultstore
+    """
+    logging.info('\nDoing Zonal Statistics on ' + region)
+    # Define app workspace and sub-paths
+    tiffs = os.path.join(wrksppath, region, model + '_GeoTIFFs')
+    shp_path = os.path.join(wrksppath, region, 'shapefiles', 'ffgs_' + region + '.shp')
+    coverage_path = os.path.join(wrksppath, region, model + '_coverage.npz')
+
+    if forecast is not None:
+        timesteps, transform, cube = forecast
+    else:
+        # check that there are tiffs to do zonal statistics on
+        files = []
+        if os.path.exists(tiffs):
+            files = [tif for tif in os.listdir(tiffs) if tif.endswith('.tif')]
+            files.sort()
+        if not files:
+            logging.info('There are no tiffs to do zonal statistics on. Skipping Zonal Statistics')
+            return
+
+        # stack every timestep into one (time, lat, lon) cube
+        logging.info('reading ' + str(len(files)) + ' GeoTIFFs into a cube')
+        rasters = []
+        for file in files:
+            with rasterio.open(os.path.join(tiffs, file)) as src:
+                transform = src.transform
+                rasters.append(src.read(1))
+        cube = numpy.stack(rasters)
+        timesteps = [file[:10] for file in files]
+
+    # get the basin/cell coverage matrix for this grid (computed once and cached) and do all the timesteps at once
+    cat_ids, matrix = load_coverage(coverage_path, shp_path, transform, cube.shape[2], cube.shape[1])
+    logging.info('computing the statistics for ' + str(len(cat_ids)) + ' basins')
+    mean, maximum, count = cube_statistics(matrix, cube)
+
+    # write all the statistics, cumulative values and color scales at once
+    logging.info('\ndone with zonal statistics, writing the results and color scales')
+    rundir = run_dir(threddspath, region, model, timestamp)
+    write_results(rundir, wrksppath, region, model, timestamp, cat_ids, timesteps, mean, maximum, count)
+    write_pixel_cube(rundir, timestamp, timesteps, cube, transform)
+
+    # delete the tiffs now that we dont need them
+    if os.path.exists(tiffs):
+        logging.info('deleting the tiffs directory')
+        shutil.rmtree(tiffs)
+
+    return
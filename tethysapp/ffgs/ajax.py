@@ -1,10 +1,23 @@
 import ast
-import calendar
+import datetime
+import json
 
 import pandas
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
 
+from .datacache import cached, current_link, current_run
+from .history import basin_history
 from .options import *
+from .resultstore import pixel_series, results_index
+from .thresholds import thresholds, thresholds_csv
+
+# how long browsers may keep the simplified watersheds, they only change when a region's shapefile is replaced
+GEOMETRY_MAX_AGE = 7 * 24 * 3600
+# the columnar color scales send the values as integers, the value times this
+COLORSCALE_SCALE = 10
 
 
 def get_customsettings(request):
@@ -15,98 +28,301 @@ def get_customsettings(request):
     return JsonResponse(app_settings())
 
 
+def watershed_geometry(request):
+    """
+    The path to the simplified watersheds of the region that fit the zoom in the request: the most detailed level made
+    by the workflow that isn't more detailed than the zoom, or the least detailed level. None if there are none.
+    Dependencies: os, app_settings (options)
+    """
+    data = request_data(request)
+    directory = os.path.join(app_settings()['app_wksp_path'], data['region'], 'geometry')
+    try:
+        levels = sorted(int(file[1:-8]) for file in os.listdir(directory) if file.endswith('.geojson'))
+    except OSError:
+        return None
+    if not levels:
+        return None
+    fitting = [level for level in levels if level <= float(data.get('zoom', levels[0]))]
+    level = fitting[-1] if fitting else levels[0]
+    return os.path.join(directory, 'z' + str(level) + '.geojson')
+
+
+def geometry_last_modified(request):
+    """
+    When the simplified watersheds the request would get were written
+    Dependencies: datetime, os
+    """
+    path = watershed_geometry(request)
+    if path is None:
+        return None
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc)
+
+
+def request_data(request):
+    """
+    The values sent with a request, the query string of a GET or the json body of a POST
+    Dependencies: ast
+    """
+    if request.method in ('GET', 'HEAD'):
+        return request.GET.dict()
+    return ast.literal_eval(request.body.decode('utf-8'))
+
+
+def run_etag(request):
+    """
+    An ETag that changes when the workflow publishes a new run of the requested model or the region's thresholds change,
+    so browsers can revalidate the data they have and get a 304 until then. None if no run has been published.
+    Dependencies: os, app_settings (options), datacache, thresholds
+    """
+    data = request_data(request)
+    try:
+        rundir = current_run(app_settings()['threddsdatadir'], data['region'], data['model'])
+        if not os.path.isdir(rundir):
+            return None
+        timestamp = os.path.basename(rundir)
+        csv_modified = os.stat(thresholds_csv(app_settings()['app_wksp_path'], data['region'])).st_mtime_ns
+    except (OSError, KeyError):
+        return None
+    return '-'.join((data['model'], data['region'], timestamp, str(csv_modified)))
+
+
+def run_last_modified(request):
+    """
+    When the workflow last published a run of the requested model or the region's thresholds last changed
+    Dependencies: datetime, os, app_settings (options), datacache, thresholds
+    """
+    data = request_data(request)
+    try:
+        modified = max(
+            os.lstat(current_link(app_settings()['threddsdatadir'], data['region'], data['model'])).st_mtime,
+            os.path.getmtime(thresholds_csv(app_settings()['app_wksp_path'], data['region'])),
+        )
+    except (OSError, KeyError):
+        return None
+    return datetime.datetime.fromtimestamp(modified, datetime.timezone.utc)
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=run_etag, last_modified_func=run_last_modified)
 def get_floodchart(request):
     """
     creates the bar chart for the watershedID in the request by reading the csv files of data
-    Dependencies: app_settings (options), ast, pandas, calendar
+    Dependencies: app_settings (options), ast, resultstore, thresholds
     """
     # read the values sent from the javascript request
-    data = ast.literal_eval(request.body.decode('utf-8'))
+    data = request_data(request)
     id = data['watershedID']
     model = data['model']
     region = data['region']
-    wrksppath = app_settings()['app_wksp_path']
-
-    # read the csv of results from the last workflow run
-    results = os.path.join(wrksppath, region, model + 'results.csv')
-    df = pandas.read_csv(results)[['cat_id', 'mean', 'max', 'Timestep']]
-    df = df.query("cat_id == @id")
-
-    # get the timeseries values from the dataframe
-    values = []
-    for row in df.iterrows():
-        time = datetime.datetime.strptime(str(int(row[1]['Timestep'])), "%Y%m%d%H")
-        time = calendar.timegm(time.utctimetuple()) * 1000
-        values.append([time, round(float(row[1]['mean']), 1)])
-
-    # extract the threshold value from it's csv file
-    threshold_table = os.path.join(wrksppath, region, 'ffgs_thresholds.csv')
-    df = pandas.read_csv(threshold_table)[['BASIN', '01FFG2018021312']]
-    df = df.query("BASIN == @id")
-    threshold = round(float(df['01FFG2018021312'].values[0]), 1)
-
-    # determine the max value the chart should be zoomed to
-    maximum = max(values)[1]
-    if threshold > maximum:
-        maximum = threshold
+    settings = app_settings()
+    wrksppath = settings['app_wksp_path']
+
+    # the workflow made the chart of every watershed with the latest 1 hour thresholds, return that one if it's wanted
+    # and the thresholds haven't changed since
+    duration = data.get('duration', 1)
+    issued = data.get('issued')
+    if int(duration) == 1 and issued is None:
+        payload = stored_chart(wrksppath, settings['threddsdatadir'], region, model, id, 'intervals')
+        if payload is not None:
+            return HttpResponse(payload, content_type='application/json')
 
-    return JsonResponse({'values': values, 'threshold': threshold, 'max': maximum})
+    # get this watershed's results from the last workflow run
+    basin = results_index(wrksppath, settings['threddsdatadir'], region, model)['basins'][int(id)]
 
+    # get the timeseries values from the results and the threshold
+    threshold = thresholds(wrksppath, region, duration, issued).get(int(id))
+    return JsonResponse(chart_data(basin['time'], basin['mean'], threshold))
 
+
+@cache_control(no_cache=True)
+@condition(etag_func=run_etag, last_modified_func=run_last_modified)
 def get_cum_floodchart(request):
     """
     creates the bar chart for the watershedID in the request by reading the csv files of data
-    Dependencies: app_settings (options), ast, pandas, calendar
+    Dependencies: app_settings (options), ast, resultstore, thresholds
     """
     # read the values sent from the javascript request
-    data = ast.literal_eval(request.body.decode('utf-8'))
+    data = request_data(request)
     id = data['watershedID']
     model = data['model']
     region = data['region']
+    settings = app_settings()
+    wrksppath = settings['app_wksp_path']
 
-    wrksppath = app_settings()['app_wksp_path']
-
-    # read the csv of results from the last workflow run
-    results = os.path.join(wrksppath, region, model + 'results.csv')
-    df = pandas.read_csv(results)[['cat_id', 'mean', 'max', 'Timestep']]
-    df = df.query("cat_id == @id")
-
-    # get the timeseries values from the dataframe
-    values = []
-    cum_values = 0
-    for row in df.iterrows():
-        time = datetime.datetime.strptime(str(int(row[1]['Timestep'])), "%Y%m%d%H")
-        time = calendar.timegm(time.utctimetuple()) * 1000
-        cum_values = round(float(cum_values + row[1]['mean']), 1)
-        values.append([time, cum_values])
-
-    # extract the threshold value from it's csv file
-    threshold_table = os.path.join(wrksppath, region, 'ffgs_thresholds.csv')
-    df = pandas.read_csv(threshold_table)[['BASIN', '01FFG2018021312']]
-    df = df.query("BASIN == @id")
-    threshold = round(float(df['01FFG2018021312'].values[0]), 1)
-
-    # determine the max value the chart should be zoomed to
-    maximum = max(values)[1]
-    if threshold > maximum:
-        maximum = threshold
+    # the workflow made the chart of every watershed with the latest 1 hour thresholds, return that one if it's wanted
+    # and the thresholds haven't changed since
+    duration = data.get('duration', 1)
+    issued = data.get('issued')
+    if int(duration) == 1 and issued is None:
+        payload = stored_chart(wrksppath, settings['threddsdatadir'], region, model, id, 'cumulative')
+        if payload is not None:
+            return HttpResponse(payload, content_type='application/json')
+
+    # get this watershed's cumulative results from the last workflow run
+    basin = results_index(wrksppath, settings['threddsdatadir'], region, model)['basins'][int(id)]
+
+    # get the timeseries values from the results and the threshold
+    threshold = thresholds(wrksppath, region, duration, issued).get(int(id))
+    return JsonResponse(chart_data(basin['time'], basin['cum_mean'], threshold))
+
+
+def get_floodcharts(request):
+    """
+    returns the interval and cumulative chart data for a list of watershedIDs, for one or several models, in a single
+    response of the form {model: {watershedID: {'values', 'cum_values', 'threshold', 'max', 'cum_max'}}}
+    Dependencies: app_settings (options), ast, resultstore, thresholds
+    """
+    # read the values sent from the javascript request
+    data = ast.literal_eval(request.body.decode('utf-8'))
+    ids = [int(id) for id in data['watershedIDs']]
+    models = data['models'] if 'models' in data else [data['model']]
+    region = data['region']
+    settings = app_settings()
+    wrksppath = settings['app_wksp_path']
+
+    # every model's results are loaded (once per run) and indexed by watershed so each chart is a lookup
+    region_thresholds = thresholds(wrksppath, region, data.get('duration', 1), data.get('issued'))
+    charts = {}
+    for model in models:
+        basins = results_index(wrksppath, settings['threddsdatadir'], region, model)['basins']
+        charts[model] = {}
+        for id in ids:
+            if id not in basins:
+                continue
+            threshold = region_thresholds.get(id)
+            intervals = chart_data(basins[id]['time'], basins[id]['mean'], threshold)
+            cumulative = chart_data(basins[id]['time'], basins[id]['cum_mean'], threshold)
+            charts[model][id] = {
+                'values': intervals['values'],
+                'cum_values': cumulative['values'],
+                'threshold': intervals['threshold'],
+                'max': intervals['max'],
+                'cum_max': cumulative['max'],
+            }
+
+    return JsonResponse(charts)
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=run_etag, last_modified_func=run_last_modified)
+def get_basinhistory(request):
+    """
+    returns every forecast of a watershed from the last days (10 by default) of the history the workflow keeps, the
+    request has region, model, watershedID and optionally days
+    Dependencies: app_settings (options), history
+    """
+    data = request_data(request)
+    cycles = basin_history(app_settings()['app_wksp_path'], data['region'], data['model'], data['watershedID'],
+                           data.get('days', 10))
+    if cycles is None:
+        return JsonResponse({'error': 'the workflow has not made the history of this region yet'}, status=404)
+    return JsonResponse({'cycles': cycles})
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=run_etag, last_modified_func=run_last_modified)
+def get_pixelseries(request):
+    """
+    returns the forecast precipitation series of the grid cell at the lat/lon in the request (region, model, lat, lon)
+    read from the memory mapped cube of the last workflow run
+    Dependencies: app_settings (options), resultstore
+    """
+    data = request_data(request)
+    settings = app_settings()
+    series = pixel_series(settings['app_wksp_path'], settings['threddsdatadir'], data['region'], data['model'],
+                          float(data['lat']), float(data['lon']))
+    if series is None:
+        return JsonResponse({'error': 'there is no forecast for this location'}, status=404)
+    return JsonResponse(series)
 
-    return JsonResponse({'values': values, 'threshold': threshold, 'max': maximum})
+
+@gzip_page
+@cache_control(public=True, max_age=GEOMETRY_MAX_AGE)
+@condition(last_modified_func=geometry_last_modified)
+def get_watersheds(request):
+    """
+    returns the region's watershed boundaries simplified for the zoom in the request (region, zoom)
+    Dependencies: app_settings (options), os
+    """
+    path = watershed_geometry(request)
+    if path is None:
+        return JsonResponse({'error': 'the simplified watersheds have not been made for this region'}, status=404)
+    with open(path, 'rb') as f:
+        return HttpResponse(f.read(), content_type='application/json')
 
 
+@gzip_page
+@cache_control(no_cache=True)
+@condition(etag_func=run_etag, last_modified_func=run_last_modified)
 def get_colorscales(request):
     """
     creates the bar chart for the watershedID in the request by reading the csv files of data
-    Dependencies: app_settings (options), ast, pandas, calendar
+    Dependencies: app_settings (options), ast, pandas, datacache
     """
     # setup the function environment
-    data = ast.literal_eval(request.body.decode('utf-8'))
+    data = request_data(request)
     model = data['model']
     region = data['region']
-    wrksppath = app_settings()['app_wksp_path']
+    settings = app_settings()
+
+    # read the published run's color scale csv, only when it has changed since this process last read it. Before the
+    # workflow has published a run the <model>colorscales.csv written by older versions of the workflow is read
+    csv = os.path.join(current_run(settings['threddsdatadir'], region, model), 'colorscales.csv')
+    legacy = os.path.join(settings['app_wksp_path'], region, model + 'colorscales.csv')
+    paths = (csv, legacy)
+    if not os.path.exists(csv):
+        csv = legacy
+    if not os.path.exists(csv):
+        return JsonResponse({'error': 'the workflow has not made the color scales of this model yet'}, status=404)
+    key = (settings['threddsdatadir'], region, model)
+    if data.get('format') == 'columnar':
+        payload = cached(('colorscales', 'columnar') + key, paths, lambda: columnar_colorscales(csv))
+        return HttpResponse(payload, content_type='application/json')
+
+    rules = cached(('colorscales',) + key, paths, lambda: pandas.read_csv(
+        csv, usecols=['cat_id', 'cum_mean', 'mean', 'max'], index_col=0).to_dict(orient='index'))
+
+    return JsonResponse(rules)
+
+
+def columnar_colorscales(csv):
+    """
+    The color scales as parallel arrays instead of one object per basin: {'scale', 'ids', 'cum_mean', 'mean', 'max'}
+    where the values are integers (null for missing values) that are divided by scale to get the precipitation
+    Dependencies: json, pandas
+    """
+    df = pandas.read_csv(csv, usecols=['cat_id', 'cum_mean', 'mean', 'max'])
+    payload = {'scale': COLORSCALE_SCALE, 'ids': df['cat_id'].astype('int64').tolist()}
+    for column in ('cum_mean', 'mean', 'max'):
+        scaled = (df[column] * COLORSCALE_SCALE).round()
+        payload[column] = [None if value != value else int(value) for value in scaled.tolist()]
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def chart_data(times, series, threshold):
+    """
+    The chart json for one watershed's series: the [time, value] pairs, the threshold and the max the chart should be
+    zoomed to (the largest value or the threshold, whichever is larger)
+    """
+    values = [[int(time), None if value != value else round(float(value), 1)] for time, value in zip(times, series)]
+    threshold = None if threshold is None or threshold != threshold else round(float(threshold), 1)
+    maximum = max([value[1] for value in values if value[1] is not None] + [0])
+    if threshold is not None and threshold > maximum:
+        maximum = threshold
+    return {'values': values, 'threshold': threshold, 'max': maximum}
 
-    # read the color scale csv
-    csv = os.path.join(wrksppath, region, model + 'colorscales.csv')
-    df = pandas.read_csv(csv, usecols=['cat_id', 'cum_mean', 'mean', 'max'], index_col=0)
 
-    return JsonResponse(df.to_dict(orient='index'))
+def stored_chart(wrksppath, threddspath, region, model, id, charttype):
+    """
+    The chart json written by the workflow for a watershed in the published run or None if the workflow didn't write
+    one or the thresholds csv has changed since (the stored chart has the threshold of when it was written)
+    Dependencies: os, datacache, thresholds
+    """
+    path = os.path.join(current_run(threddspath, region, model), 'charts', str(int(id)) + '_' + charttype + '.json')
+    try:
+        with open(path, 'rb') as f:
+            if os.stat(thresholds_csv(wrksppath, region)).st_mtime_ns > os.fstat(f.fileno()).st_mtime_ns:
+                return None
+            return f.read()
+    except FileNotFoundError:
+        return None
@@ -50,6 +50,26 @@ class Ffgs(TethysAppBase):
                 url='ffgs/ajax/getCumFloodChart',
                 controller='ffgs.ajax.get_cum_floodchart'
             ),
+            UrlMap(
+                name='getFloodCharts',
+                url='ffgs/ajax/getFloodCharts',
+                controller='ffgs.ajax.get_floodcharts'
+            ),
+            UrlMap(
+                name='getBasinHistory',
+                url='ffgs/ajax/getBasinHistory',
+                controller='ffgs.ajax.get_basinhistory'
+            ),
+            UrlMap(
+                name='getPixelSeries',
+                url='ffgs/ajax/getPixelSeries',
+                controller='ffgs.ajax.get_pixelseries'
+            ),
+            UrlMap(
+                name='getWatersheds',
+                url='ffgs/ajax/getWatersheds',
+                controller='ffgs.ajax.get_watersheds'
+            ),
             UrlMap(
                 name='getColorScales',
                 url='ffgs/ajax/getColorScales',
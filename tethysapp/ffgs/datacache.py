@@ -0,0 +1,57 @@
+import os
+import threading
+
+# the data each process has already loaded: {key: (signature of the files it was loaded from, data)}
+_CACHE = {}
+_LOCK = threading.Lock()
+
+
+def _signature(paths):
+    """
+    The modification time and size of each file, or None for files that don't exist
+    Dependencies: os
+    """
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+
+def cached(key, paths, loader):
+    """
+    Returns the data cached for the key, calling loader() to (re)load it the first time it is asked for and whenever
+    any of the files in paths has changed since it was loaded. Read the files from the folder current_run resolves
+    to so a new workflow run invalidates the data.
+    Dependencies: os, threading
+    """
+    signature = _signature(paths)
+    with _LOCK:
+        entry = _CACHE.get(key)
+    if entry is not None and entry[0] == signature:
+        return entry[1]
+
+    data = loader()
+    with _LOCK:
+        _CACHE[key] = (signature, data)
+    return data
+
+
+def current_link(threddspath, region, model):
+    """
+    The symlink the workflow points at the folder of a model's published run in a region
+    """
+    return os.path.join(threddspath, region, model, 'current')
+
+
+def current_run(threddspath, region, model):
+    """
+    The folder of a model's published run in a region, <thredds>/<region>/<model>/<forecast timestamp>. Resolve it once
+    per request and read every file from it so a run published in the middle of the request isn't mixed with the old
+    one. The folder doesn't exist if the workflow hasn't published a run.
+    Dependencies: os
+    """
+    return os.path.realpath(current_link(threddspath, region, model))
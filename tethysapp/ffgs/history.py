@@ -0,0 +1,55 @@
+import calendar
+import datetime
+import os
+import sqlite3
+
+# the workflow (data_workflow/history.py) keeps the per basin results of every model's recent forecast cycles in
+# <app workspace>/<region>/history.sqlite, in a stats table keyed by (model, cat_id, cycle, lead) where cycle is the
+# forecast timestamp as an integer YYYYMMDDHH and mean, max and cum_mean are integer tenths of a millimeter
+HISTORY_SCALE = 10
+
+
+def history_path(wrksppath, region):
+    return os.path.join(wrksppath, region, 'history.sqlite')
+
+
+def basin_history(wrksppath, region, model, cat_id, days=10):
+    """
+    Every cycle of a model in the history for a basin from the last days before the newest cycle, oldest first, as
+    [{'timestamp', 'values', 'cum_values', 'max'}] where the values are [time, value] pairs (milliseconds since the
+    epoch, millimeters). Each query is a range read of the stats table's primary key, no files are scanned.
+    Returns None if the workflow hasn't made the history yet.
+    Dependencies: calendar, datetime, os, sqlite3
+    """
+    path = history_path(wrksppath, region)
+    if not os.path.exists(path):
+        return None
+    connection = sqlite3.connect('file:' + path + '?mode=ro', uri=True, timeout=10)
+    try:
+        newest = connection.execute('SELECT MAX(cycle) FROM cycles WHERE model = ?', (model,)).fetchone()[0]
+        if newest is None:
+            return []
+        cutoff = datetime.datetime.strptime(str(newest), '%Y%m%d%H') - datetime.timedelta(days=float(days))
+        rows = connection.execute(
+            'SELECT cycle, lead, mean, max, cum_mean FROM stats WHERE model = ? AND cat_id = ? AND cycle >= ? '
+            'ORDER BY cycle, lead', (model, int(cat_id), int(cutoff.strftime('%Y%m%d%H')))).fetchall()
+    finally:
+        connection.close()
+
+    cycles = []
+    for cycle, lead, mean, maximum, cum_mean in rows:
+        if not cycles or cycles[-1]['timestamp'] != str(cycle):
+            start = datetime.datetime.strptime(str(cycle), '%Y%m%d%H')
+            start = calendar.timegm(start.utctimetuple()) * 1000
+            cycles.append({'timestamp': str(cycle), 'start': start, 'values': [], 'cum_values': [], 'max': []})
+        time = cycles[-1]['start'] + lead * 3600000
+        cycles[-1]['values'].append([time, _unscaled(mean)])
+        cycles[-1]['cum_values'].append([time, _unscaled(cum_mean)])
+        cycles[-1]['max'].append([time, _unscaled(maximum)])
+    for cycle in cycles:
+        del cycle['start']
+    return cycles
+
+
+def _unscaled(value):
+    return None if value is None else value / HISTORY_SCALE
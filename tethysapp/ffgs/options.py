@@ -59,11 +59,12 @@ def centralamerica_models():
 
 def chart_options():
     """
-    Chart options: cumulative or unique intervals
+    Chart options: cumulative, unique intervals or the intervals of the grid cell that was clicked
     """
     return [
         ('Cumulative', 'cumulative'),
-        ('Forecast Intervals', 'intervals')
+        ('Forecast Intervals', 'intervals'),
+        ('Clicked Grid Cell Intervals', 'pixel'),
     ]
 
 
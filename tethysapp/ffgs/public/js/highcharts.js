@@ -14,6 +14,8 @@ Highcharts.setOptions({
 
 let chartdata = null;
 let id = null;
+// the latlng of the last click on the map, the pixel chart shows the grid cell under it
+let point = null;
 
 // Placeholder chart
 function placeholderChart() {
@@ -139,6 +141,66 @@ function newCumHighchart() {
 }
 
 
+function newPixelHighchart() {
+    chart = Highcharts.chart('highchart', {
+        title: {
+            align: "center",
+            text: 'Forecasted Precipitation in the Grid Cell vs. Time ',
+        },
+        subtitle: {
+            align: "center",
+            text: 'Grid Cell Center: ' + chartdata['lat'].toFixed(3) + ', ' + chartdata['lon'].toFixed(3),
+        },
+        xAxis: {
+            title: {text: "Time (in UTC +0:00)"},
+            type: 'datetime',
+            units: [['hour', [6, 12, 18]], ['day', [1]]],
+        },
+        yAxis: {
+            title: {text: 'millimeters'},
+        },
+        series: [{
+            data: chartdata['values'],          // the series of data
+            type: 'column',
+            name: 'Incremental Precipitation Accumulation',            // the name of the series
+            tooltip: {
+                xDateFormat: '%a, %b %e, %Y %H:%M'
+            },
+        }],
+        chart: {
+            animation: true,
+            zoomType: 'xy',
+            borderColor: '#000000',
+            borderWidth: 2,
+        },
+
+    });
+}
+
+function getPixelChart(latlng) {
+    chart.hideNoData();
+    chart.showLoading();
+
+    let regionmodel = get_regionmodel();
+    let region = regionmodel[0];
+    let model = regionmodel[1];
+
+    $.ajax({
+        url: '/apps/ffgs/ajax/getPixelSeries/',
+        data: {region: region, model: model, lat: latlng.lat, lon: latlng.lng},
+        dataType: 'json',
+        method: 'GET',
+        success: function (result) {
+            chartdata = result;
+            newPixelHighchart();
+        },
+        error: function () {
+            chart.hideLoading();
+            chart.showNoData('No forecast data for this location');
+        }
+    })
+}
+
 function getFloodChart(ID) {
     chart.hideNoData();
     chart.showLoading();
@@ -149,10 +211,9 @@ function getFloodChart(ID) {
 
     $.ajax({
         url: '/apps/ffgs/ajax/getFloodChart/',
-        data: JSON.stringify({region: region, model: model, watershedID: ID}),
+        data: {region: region, model: model, watershedID: ID},
         dataType: 'json',
-        contentType: "application/json",
-        method: 'POST',
+        method: 'GET',
         success: function (result) {
             chartdata = result;
             newHighchart();
@@ -170,10 +231,9 @@ function getCumFloodChart(ID) {
 
     $.ajax({
         url: '/apps/ffgs/ajax/getCumFloodChart/',
-        data: JSON.stringify({region: region, model: model, watershedID: ID}),
+        data: {region: region, model: model, watershedID: ID},
         dataType: 'json',
-        contentType: "application/json",
-        method: 'POST',
+        method: 'GET',
         success: function (result) {
             chartdata = result;
             newCumHighchart();
@@ -183,6 +243,13 @@ function getCumFloodChart(ID) {
 
 function updateChart(ID) {
     let type = $("#chartoptions").val();
+    // the pixel chart is of the last point clicked on the map, which doesn't have to be in a watershed
+    if (type === 'pixel') {
+        if (point !== null) {
+            getPixelChart(point);
+        }
+        return
+    }
     if (ID !== null) {
         if (type === 'intervals') {
             getFloodChart(ID);
@@ -47,7 +47,7 @@ function newForecastLayer() {
     let regionmodel = get_regionmodel();
     let region = regionmodel[0];
     let model = regionmodel[1];
-    let wmsurl = threddsbase + '/' + region + '/' + model + '/' + 'wms.ncml';
+    let wmsurl = threddsbase + '/' + region + '/' + model + '/current/wms.ncml';
     let max = String(parseInt($("#legendintervals").val()) * 6);
     let wmsLayer = L.tileLayer.wms(wmsurl, {
         // version: '1.3.0',
@@ -80,7 +80,7 @@ forecastLegend.onAdd = function () {
     let model = regionmodel[1];
     let max = String(parseInt($("#legendintervals").val()) * 6);
     let div = L.DomUtil.create('div', 'legend');
-    let url = threddsbase + '/' + region + '/' + model + '/' + 'wms.ncml' + "?REQUEST=GetLegendGraphic&LAYER=tp" + "&PALETTE=" + $('#colorscheme').val() + "&COLORSCALERANGE=0," + max;
+    let url = threddsbase + '/' + region + '/' + model + '/current/wms.ncml' + "?REQUEST=GetLegendGraphic&LAYER=tp" + "&PALETTE=" + $('#colorscheme').val() + "&COLORSCALERANGE=0," + max;
     div.innerHTML = '<img src="' + url + '" alt="legend" style="width:100%; float:right;">';
     return div
 };
@@ -108,7 +108,10 @@ function layerPopups(feature, layer) {
     layer.bindPopup('<strong>Catchment ID: ' + watershed_id + '</strong>');
     layer.on('click', function () {
         id = watershed_id;
-        updateChart(watershed_id);
+        // the pixel chart is made by the map's click listener (main.js), the click reaches it after the watershed's
+        if ($("#chartoptions").val() !== 'pixel') {
+            updateChart(watershed_id);
+        }
     });
 }
 
@@ -122,6 +125,55 @@ let geojson_sorter = {
     // 'nepal', nepal_json,
 };
 
+// the zoom levels the workflow simplifies the watersheds for (GEOMETRY_ZOOMS in data_workflow/geometry.py)
+const geometryZooms = [4, 6, 8, 10];
+let geometryZoom;
+function geometryLevel(zoom) {
+    // the most detailed level that isn't more detailed than the zoom
+    let level = geometryZooms[0];
+    for (let i = 0; i < geometryZooms.length; i++) {
+        if (geometryZooms[i] <= zoom) {
+            level = geometryZooms[i];
+        }
+    }
+    return level;
+}
+
+function loadWatershedGeometry(region) {
+    // get the watersheds simplified for the current zoom, or the full resolution ones if they haven't been made, in
+    // the background and swap them into the watershed layers when they arrive
+    let level = geometryLevel(mapObj.getZoom());
+    geometryZoom = level;
+    let swap = function (geometry) {
+        // a response for a zoom level or region the map has since left is ignored
+        if (level !== geometryZoom || region !== get_regionmodel()[0]) {
+            return
+        }
+        watersheds_colors.clearLayers();
+        watersheds_colors.addData(geometry);
+        watersheds.clearLayers();
+        watersheds.addData(geometry);
+    };
+    $.ajax({
+        url: '/apps/ffgs/ajax/getWatersheds/',
+        data: {region: region, zoom: level},
+        dataType: 'json',
+        method: 'GET',
+        success: swap,
+        error: function () {
+            swap(geojson_sorter[region]);
+        }
+    });
+}
+
+function reloadWatersheds() {
+    // redraw the watersheds when the map is zoomed to a different level of simplification
+    if (geometryLevel(mapObj.getZoom()) === geometryZoom) {
+        return
+    }
+    loadWatershedGeometry(get_regionmodel()[0]);
+}
+
 function colorScale(value) {
     let interval = parseInt($("#legendintervals").val());
     return value >= (interval * 6) ? '#0c2c84' :
@@ -137,48 +189,65 @@ function colorScale(value) {
 let rules;
 function setColor(rules, number, resulttype) {
     let interval = parseInt($("#legendintervals").val());
-    return rules[number + '.0'][resulttype] >= (interval * 6) ? colorScale(30) :
-        rules[number + '.0'][resulttype] >= (interval * 5) ? colorScale(25) :
-        rules[number + '.0'][resulttype] >= (interval * 4) ? colorScale(20) :
-        rules[number + '.0'][resulttype] >= (interval * 3) ? colorScale(15) :
-        rules[number + '.0'][resulttype] >= (interval * 2) ? colorScale(10) :
-        rules[number + '.0'][resulttype] >= interval ? colorScale(5) :
-        rules[number + '.0'][resulttype] >= 0 ? colorScale(0) :
+    // older color scale files used float formatted ids, e.g. 2004700003.0
+    let rule = (rules[number] || rules[number + '.0'] || {})[resulttype];
+    return rule >= (interval * 6) ? colorScale(30) :
+        rule >= (interval * 5) ? colorScale(25) :
+        rule >= (interval * 4) ? colorScale(20) :
+        rule >= (interval * 3) ? colorScale(15) :
+        rule >= (interval * 2) ? colorScale(10) :
+        rule >= interval ? colorScale(5) :
+        rule >= 0 ? colorScale(0) :
         '';
 }
 
+function columnsToRules(columns) {
+    // turn the parallel arrays of the columnar color scales into {cat_id: {cum_mean, mean, max}}
+    let unscale = function (value) {return value === null ? null : value / columns.scale};
+    let rules = {};
+    for (let i = 0; i < columns.ids.length; i++) {
+        rules[columns.ids[i]] = {
+            cum_mean: unscale(columns.cum_mean[i]),
+            mean: unscale(columns.mean[i]),
+            max: unscale(columns.max[i]),
+        };
+    }
+    return rules;
+}
+
 function addFFGSlayer() {
     let regionmodel = get_regionmodel();
     let region = regionmodel[0];
     let model = regionmodel[1];
-    // add the color-coordinated watersheds layer
+    // add the color-coordinated watersheds layer, the watersheds are added to both layers by loadWatershedGeometry.
+    // the layer is made even when there are no color scales yet (the basins are left uncolored)
+    rules = {};
     $.ajax({
         url: '/apps/ffgs/ajax/getColorScales/',
         async: false,
-        data: JSON.stringify({region: region, model: model}),
+        data: {region: region, model: model, format: 'columnar'},
         dataType: 'json',
-        contentType: "application/json",
-        method: 'POST',
+        method: 'GET',
         success: function (data) {
-            rules = data;
-            watersheds_colors = L.geoJSON(geojson_sorter[region], {
-                onEachFeature: layerPopups,
-                style: (function (feature) {
-                    let number = feature.properties.cat_id;
-                    return {
-                        color: 'rgba(0,0,0,0.0)',
-                        opacity: 0,
-                        weight: 0,
-                        fillColor: setColor(rules, number, $("#resulttype").val()),
-                        fillOpacity: 1,
-                    }
-                }),
-            }).addTo(mapObj);
+            rules = columnsToRules(data);
         }
     });
+    watersheds_colors = L.geoJSON(null, {
+        onEachFeature: layerPopups,
+        style: (function (feature) {
+            let number = feature.properties.cat_id;
+            return {
+                color: 'rgba(0,0,0,0.0)',
+                opacity: 0,
+                weight: 0,
+                fillColor: setColor(rules, number, $("#resulttype").val()),
+                fillOpacity: 1,
+            }
+        }),
+    }).addTo(mapObj);
 
     // add the watershed boundaries layer
-    watersheds = L.geoJSON(geojson_sorter[region], {
+    watersheds = L.geoJSON(null, {
         onEachFeature: layerPopups,
         style: {
             color: '#000000',
@@ -190,6 +259,7 @@ function addFFGSlayer() {
         }
     }).addTo(mapObj);
 
+    loadWatershedGeometry(region);
 }
 
 ////////////////////////////////////////////////////////////////////////  MAP CONTROLS AND CLEARING
@@ -51,6 +51,16 @@ const basemapObj = basemaps();          // used in the make controls function
 mapObj.on("mousemove", function (event) {
     $("#mouse-position").html('Lat: ' + event.latlng.lat.toFixed(4) + ', Lon: ' + event.latlng.lng.toFixed(4));
 });
+mapObj.on("zoomend", function () {
+    reloadWatersheds();
+});
+mapObj.on("click", function (event) {
+    // any point on the map can be charted, inside a watershed or not
+    point = event.latlng;
+    if ($("#chartoptions").val() === 'pixel') {
+        getPixelChart(point);
+    }
+});
 
 let forecastLayerObj = newForecastLayer();              // adds the wms raster layer
 addFFGSlayer();                         // adds the ffgs watershed layer chosen by the user
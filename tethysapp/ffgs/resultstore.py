@@ -0,0 +1,134 @@
+import calendar
+import datetime
+import json
+import os
+
+import numpy
+import pandas
+
+from .datacache import cached, current_run
+
+# the results are written by the workflow (data_workflow/resultstore.py) in the folder of each run it publishes
+# (see datacache.current_run) as results.parquet with the columns
+# cat_id (int64), lead (int16, hours after the forecast timestamp), mean (float32), max (float32),
+# cum_mean (float32, the running total of mean) and count (int32)
+# the workflow also saves the run's (time, lat, lon) precipitation cube there as cube.npy with the times
+# (milliseconds since the epoch) and the affine transform of its grid in cube.json
+
+
+def read_results(wrksppath, rundir, region, model, columns=('cat_id', 'lead', 'mean', 'max'), cat_id=None):
+    """
+    Reads the results of the run in rundir, optionally only the rows of a single basin. Only the columns asked for are
+    read and the file's row groups that can't hold the basin are skipped.
+    Adds a 'time' column (milliseconds since the epoch, what highcharts uses) when the lead column is read.
+    Dependencies: calendar, datetime, os, pandas, pyarrow
+    """
+    columns = list(columns)
+    path = os.path.join(rundir, 'results.parquet')
+    if not os.path.exists(path):
+        df = _read_legacy_csv(wrksppath, region, model, columns, cat_id)
+    else:
+        filters = None if cat_id is None else [('cat_id', '=', int(cat_id))]
+        df = pandas.read_parquet(path, engine='pyarrow', columns=columns, filters=filters)
+        df.attrs['timestamp'] = os.path.basename(rundir)
+
+    if 'lead' in df.columns:
+        start = datetime.datetime.strptime(df.attrs['timestamp'], "%Y%m%d%H")
+        start = calendar.timegm(start.utctimetuple()) * 1000
+        df['time'] = start + df['lead'].astype('int64') * 3600000
+    return df
+
+
+def _read_legacy_csv(wrksppath, region, model, columns, cat_id):
+    """
+    Reads the <model>results.csv written by older versions of the workflow in the same shape as the parquet results
+    """
+    csv = os.path.join(wrksppath, region, model + 'results.csv')
+    df = pandas.read_csv(csv, usecols=['cat_id', 'mean', 'max', 'count', 'Forecast Timestamp', 'Timestep'])
+    if cat_id is not None:
+        df = df[df['cat_id'] == int(cat_id)]
+    df = df.assign(cum_mean=df.groupby('cat_id')['mean'].cumsum().round(1))
+    timestamp = str(int(df['Forecast Timestamp'].iloc[0]))
+    start = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
+    steps = pandas.to_datetime(df['Timestep'].astype('int64').astype(str), format="%Y%m%d%H")
+    df = df.assign(lead=((steps - start) // pandas.Timedelta(hours=1)).astype('int16'))[columns]
+    df.attrs['timestamp'] = timestamp
+    return df
+
+
+def results_index(wrksppath, threddspath, region, model):
+    """
+    The results of the published run of a model in a region indexed by basin, loaded once per process and reloaded
+    when the workflow publishes a new run. Returns {'timestamp': str, 'basins': {cat_id: {'time', 'mean', 'max',
+    'cum_mean'}}} where each basin's values are numpy arrays ordered by time.
+    Dependencies: numpy, pandas, datacache
+    """
+    rundir = current_run(threddspath, region, model)
+    paths = (
+        os.path.join(rundir, 'results.parquet'),
+        os.path.join(wrksppath, region, model + 'results.csv'),
+    )
+    return cached(('results', wrksppath, region, model), paths, lambda: _load_index(wrksppath, rundir, region, model))
+
+
+def _load_index(wrksppath, rundir, region, model):
+    df = read_results(wrksppath, rundir, region, model, columns=('cat_id', 'lead', 'mean', 'max', 'cum_mean'))
+    timestamp = df.attrs['timestamp']
+    df = df.sort_values(['cat_id', 'lead'], kind='mergesort')
+
+    # the rows of each basin are consecutive so each basin gets a slice of the columns
+    columns = {column: df[column].values for column in ('time', 'mean', 'max', 'cum_mean')}
+    ids, starts = numpy.unique(df['cat_id'].values, return_index=True)
+    ends = numpy.append(starts[1:], len(df))
+    basins = {}
+    for cat_id, start, end in zip(ids, starts, ends):
+        basins[int(cat_id)] = {column: values[start:end] for column, values in columns.items()}
+    return {'timestamp': timestamp, 'basins': basins}
+
+
+def pixel_cube(wrksppath, threddspath, region, model):
+    """
+    The precipitation cube of the published run memory mapped, so reading a cell's series only reads that cell from
+    disk. Opened once per process and reopened when the workflow publishes a new run.
+    Returns {'cube': (time, lat, lon) array, 'times': [ms], 'transform': (a, b, c, d, e, f)} or None if there isn't one
+    Dependencies: json, os, numpy, datacache
+    """
+    rundir = current_run(threddspath, region, model)
+    cube_path = os.path.join(rundir, 'cube.npy')
+    meta_path = os.path.join(rundir, 'cube.json')
+    return cached(('pixelcube', threddspath, region, model), (cube_path, meta_path),
+                  lambda: _map_cube(cube_path, meta_path))
+
+
+def _map_cube(cube_path, meta_path):
+    if not (os.path.exists(cube_path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path) as f:
+        metadata = json.load(f)
+    metadata['cube'] = numpy.load(cube_path, mmap_mode='r')
+    return metadata
+
+
+def pixel_series(wrksppath, threddspath, region, model, lat, lon):
+    """
+    The forecast precipitation of the grid cell holding a lat/lon as [time, value] pairs, with the cell's center.
+    Returns None if there is no cube or the point is outside the grid.
+    Dependencies: json, os, numpy, datacache
+    """
+    data = pixel_cube(wrksppath, threddspath, region, model)
+    if data is None:
+        return None
+    a, b, c, d, e, f = data['transform']
+    cube = data['cube']
+    # the GFS grid can use longitudes from 0 to 360, try the point's longitude both ways
+    for x in (lon, lon % 360, lon - 360):
+        col = int(numpy.floor((x - c) / a))
+        row = int(numpy.floor((lat - f) / e))
+        if 0 <= row < cube.shape[1] and 0 <= col < cube.shape[2]:
+            break
+    else:
+        return None
+    series = numpy.array(cube[:, row, col], dtype=numpy.float64)
+    values = [[time, None if value != value else round(value, 2)]
+              for time, value in zip(data['times'], series.tolist())]
+    return {'values': values, 'lat': f + (row + 0.5) * e, 'lon': c + (col + 0.5) * a}
@@ -0,0 +1,65 @@
+import os
+import re
+
+import pandas
+
+from .datacache import cached
+
+# ffgs_thresholds.csv has a BASIN column and one column per set of thresholds named <duration>FFG<issue time>, e.g.
+# 01FFG2018021312 is the 1 hour flash flood guidance issued 2018-02-13 12z. Any number of durations and issue times
+# can be kept in the file.
+COLUMN_PATTERN = re.compile(r'^(\d\d)FFG(\d{10})$')
+
+
+def thresholds_csv(wrksppath, region):
+    return os.path.join(wrksppath, region, 'ffgs_thresholds.csv')
+
+
+def threshold_store(wrksppath, region):
+    """
+    The thresholds of a region compiled into {(duration, issued): {BASIN: threshold}} where duration is the FFG duration
+    in hours and issued is the issue time as a YYYYMMDDHH string. Compiled once per process and again when the csv
+    changes.
+    Dependencies: os, re, pandas, datacache
+    """
+    csv = thresholds_csv(wrksppath, region)
+    return cached(('thresholds', csv), (csv,), lambda: _compile(csv))
+
+
+def _compile(csv):
+    df = pandas.read_csv(csv, index_col='BASIN')
+    store = {}
+    for column in df.columns:
+        match = COLUMN_PATTERN.match(column)
+        if match is None:
+            continue
+        values = df[column].dropna()
+        store[(int(match.group(1)), match.group(2))] = dict(zip(values.index.astype('int64').tolist(), values.tolist()))
+    return store
+
+
+def thresholds(wrksppath, region, duration=1, issued=None):
+    """
+    The {BASIN: threshold} of one duration (hours) issued at a time (YYYYMMDDHH), the most recently issued by default.
+    Returns an empty dict if there are no thresholds for that duration and issue time.
+    Dependencies: datacache
+    """
+    store = threshold_store(wrksppath, region)
+    if issued is None:
+        issued = latest_issue(store, duration)
+    return store.get((int(duration), issued), {})
+
+
+def latest_issue(store, duration=1):
+    """
+    The newest issue time in the store that has thresholds for the duration, or None
+    """
+    issues = [issued for (hours, issued) in store if hours == int(duration)]
+    return max(issues) if issues else None
+
+
+def lookup(wrksppath, region, basin, duration=1, issued=None):
+    """
+    The threshold of a single basin or None if it has none for that duration and issue time
+    """
+    return thresholds(wrksppath, region, duration, issued).get(int(basin))